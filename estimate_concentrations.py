@@ -1,55 +1,28 @@
-import subprocess
+from parkrec.pipeline import concentration_stages, run_stages
 
-from parkrec.settings import patient_data_settings
 
-
-def main(patientid: str, resolution: int = 32):
-    # Create brainmask and t1map
-    subprocess.run(
-        f"python3 parkrec/mriprocessing/t1maps.py {patientid} ", shell=True
-    ).check_returncode()
-
-    # Create concentration-images.
-    create_concentration(patientid)
-
-    # Create mesh
-    subprocess.run(
-        (
-            "python3 parkrec/mriprocessing/mesh_generation.py"
-            + f" {patientid}"
-            + f" {resolution}"
-        ),
-        shell=True,
-    ).check_returncode()
-
-    # Map concentrations to mri.
-    subprocess.run(
-        (
-            "python3 parkrec/mriprocessing/mri2fenics.py"
-            + f" {patientid}"
-            + f" DATA/{patientid}/MESH/brain{resolution}.hdf"
-        ),
-        shell=True,
-    ).check_returncode()
-
-
-def create_concentration(patientid: str):
-    paths = patient_data_settings(patientid=patientid)
-    estimate_c_cmd = (
-        "python3 parkrec/mriprocessing/estimatec.py"
-        + f" --inputfolder {paths.registered}"
-        + f" --exportfolder {paths.concentrations}"
-        + f" --t1map {paths.patient_root / 't1map.mgz'}"
-        + f" --mask {paths.patient_root / 'brainmask.mgz'}"
+def main(patientids: list[str], resolution: int = 32, max_workers=None, force=False):
+    # Create brainmask and t1map, normalize images, create concentration-images,
+    # create mesh, and map concentrations to mri.
+    stages = sum(
+        (concentration_stages(patientid, resolution) for patientid in patientids), []
     )
-    subprocess.run(estimate_c_cmd, shell=True).check_returncode()
+    status = run_stages(stages, max_workers=max_workers, force=force)
+    if any(val in ("failed", "cancelled") for val in status.values()):
+        raise RuntimeError(f"Concentration estimation failed: {status}")
 
 
 if __name__ == "__main__":
     import argparse
+    import logging
+
+    logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("patientid", type=str, help="Patient ID on format PAT_XXX")
+    parser.add_argument("patientids", type=str, nargs="+", help="Patient IDs on format PAT_XXX")
+    parser.add_argument("--resolution", type=int, default=32)
+    parser.add_argument("--max_workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="Rerun up-to-date stages.")
     args = parser.parse_args()
 
-    main(args.patientid)
+    main(args.patientids, args.resolution, args.max_workers, args.force)
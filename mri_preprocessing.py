@@ -1,27 +1,22 @@
 from argparse import ArgumentParser
-import subprocess
 import logging
 
+from parkrec.pipeline import preprocessing_stages, run_stages
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 parser = ArgumentParser()
-parser.add_argument("patientid", type=str, help="Patient ID on format PAT_XXX")
+parser.add_argument("patientids", type=str, nargs="+", help="Patient IDs on format PAT_XXX")
+parser.add_argument("--max_workers", type=int, default=None)
+parser.add_argument("--force", action="store_true", help="Rerun up-to-date stages.")
 args = parser.parse_args()
 
 
-logging.info(f"Preprocessing MR-data for patient {args.patientid}")
-logging.info(f"Converting DICOM data to .nii")
-subprocess.run(
-    f"python3 parkrec/mriprocessing/multiframe_dicom.py {args.patientid}", shell=True
-).check_returncode()
-
-logging.info(f"Resampling and converting .nii-files to .mgz")
-subprocess.run(
-    f"python3 parkrec/mriprocessing/mri_convert.py {args.patientid}", shell=True
-).check_returncode()
-
-logging.info(f"Registering within-patient MR-images to ")
-subprocess.run(
-    f"python3 parkrec/mriprocessing/mri_register.py {args.patientid}", shell=True
-).check_returncode()
+logging.info(f"Preprocessing MR-data for patients {args.patientids}")
+# Converting DICOM data to .nii, resampling and converting .nii-files to .mgz,
+# and registering within-patient MR-images.
+stages = sum((preprocessing_stages(patientid) for patientid in args.patientids), [])
+status = run_stages(stages, max_workers=args.max_workers, force=args.force)
+if any(val in ("failed", "cancelled") for val in status.values()):
+    raise RuntimeError(f"Preprocessing failed: {status}")
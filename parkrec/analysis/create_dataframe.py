@@ -2,10 +2,14 @@ import logging
 import re
 from datetime import datetime
 from pathlib import Path
+from typing import Optional
 
 import nibabel
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,7 +22,7 @@ def create_mri_dataframe(
 ):
     mri_vol = nibabel.load(filepath)
     im = mri_vol.get_fdata().astype(dtype)
-    IJK = np.array(list(np.ndindex(im.shape)))
+    IJK = np.indices(im.shape).reshape(len(im.shape), -1).T
     #    vox2ras = mri_vol.header.get_vox2ras()  # Kept until first commit, for reference
     #    XYZ = nibabel.affines.apply_affine(vox2ras, IJK)
     df = pd.DataFrame(
@@ -48,6 +52,73 @@ def read_concentrations_file(filepath: Path, *args, **kwargs):
     return pd.read_csv(concentrations_file, dtype=dtypes, *args, **kwargs)
 
 
+def create_brain_table(aseg_volume: Path, concentration_files: list[Path]) -> pa.Table:
+    """Table of all voxels with nonzero aseg-label, sorted by label such that
+    each row group of a parquet-file only covers a few labels."""
+    aseg = np.asarray(nibabel.load(aseg_volume).dataobj).astype(np.uint16)
+    IJK = np.nonzero(aseg)
+    order = np.argsort(aseg[IJK], kind="stable")
+    IJK = tuple(x[order] for x in IJK)
+    columns = {
+        **{key: IJK[num].astype(np.uint16) for num, key in enumerate(("i", "j", "k"))},
+        "aseg": aseg[IJK],
+    }
+    for concfile in concentration_files:
+        logger.info(f"Adding '{concfile}' to table")
+        timestamp = datetime.strptime(concfile.stem, "%Y%m%d_%H%M%S")
+        im = nibabel.load(concfile).get_fdata(dtype=np.single)
+        columns[str(pd.to_datetime(timestamp))] = im[IJK]
+    return pa.table(columns)
+
+
+def write_patient_table(
+    table: pa.Table, dataset_dir: Path, patientid: str, row_group_size: int = 2**16
+) -> Path:
+    """Writes the table as the partition 'patient=<patientid>' of a
+    hive-partitioned parquet dataset, replacing any existing partition."""
+    outputdir = Path(dataset_dir) / f"patient={patientid}"
+    outputdir.mkdir(exist_ok=True, parents=True)
+    outputfile = outputdir / "concentrations.parquet"
+    pq.write_table(table, outputfile, row_group_size=row_group_size)
+    return outputfile
+
+
+def concentrations_dataset(dataset_dir: Path) -> ds.Dataset:
+    """Opens the parquet dataset with one partition per patient. Since the
+    imaging times differ between patients, the schemas of the partitions are
+    unified, and missing timestamp-columns are read as nulls."""
+    files = sorted(Path(dataset_dir).glob("patient=*/*.parquet"))
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files])
+    partitioning = ds.partitioning(pa.schema([("patient", pa.string())]), flavor="hive")
+    return ds.dataset(
+        [str(f) for f in files],
+        schema=schema.append(pa.field("patient", pa.string())),
+        format="parquet",
+        partitioning=partitioning,
+        partition_base_dir=str(dataset_dir),
+    )
+
+
+def read_concentrations_dataset(
+    dataset_dir: Path,
+    aseg_labels: Optional[list[int]] = None,
+    patients: Optional[list[str]] = None,
+    columns: Optional[list[str]] = None,
+) -> pd.DataFrame:
+    """Reads the concentration dataset, only loading the row groups of the
+    requested patients and aseg-labels."""
+    dataset = concentrations_dataset(dataset_dir)
+    expression = None
+    if aseg_labels is not None:
+        expression = ds.field("aseg").isin(aseg_labels)
+    if patients is not None:
+        patient_expression = ds.field("patient").isin(patients)
+        expression = (
+            patient_expression if expression is None else expression & patient_expression
+        )
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
 def flatten_dataframe(dataframe: pd.DataFrame) -> pd.Series:
     mi = pd.MultiIndex.from_product([dataframe.columns, dataframe.index])
     return pd.Series(dataframe.to_numpy().flatten(order="F"), index=mi)
@@ -60,6 +131,13 @@ if __name__ == "__main__":
     parser.add_argument("patientid", type=str)
     parser.add_argument("concentration_dirname", type=str)
     parser.add_argument("--outputname", type=str, default="concentrations.csv")
+    parser.add_argument("--format", type=str, default="csv", choices=("csv", "parquet"))
+    parser.add_argument(
+        "--datasetdir",
+        type=str,
+        default="DATA/STATISTICS/concentrations",
+        help="Root directory of the parquet dataset, partitioned by patient.",
+    )
     args = parser.parse_args()
 
     patdir = Path("DATA") / args.patientid
@@ -67,24 +145,30 @@ if __name__ == "__main__":
     assert patdir.exists(), f"Patient dir {patdir} does not exist"
     assert concdir.exists(), f"Concentration dir {concdir} does not exist"
 
-    statsdir = patdir / "STATISTICS"
-    statsdir.mkdir(exist_ok=True)
-
     aseg_volume = patdir / "mri" / "aseg.mgz"
-    aseg_series = pd.Series(
-        nibabel.load(aseg_volume).get_fdata().astype(int).reshape(-1)
-    )
-    df = create_mri_dataframe(aseg_volume, np.ushort, "aseg")
-    for concfile in sorted(concdir.glob("*.mgz")):
-        logger.info(f"Adding '{concfile}' to dataframe")
-        timestamp = datetime.strptime(concfile.stem, "%Y%m%d_%H%M%S")
-        im = nibabel.load(concfile).get_fdata().astype(np.single)
-
-        df = df.assign(
-            **{str(pd.to_datetime(timestamp)): pd.Series(im.reshape(-1), dtype=float)}
+    if args.format == "parquet":
+        table = create_brain_table(aseg_volume, sorted(concdir.glob("*.mgz")))
+        logger.info(f"Saving table to {args.datasetdir} ...")
+        write_patient_table(table, Path(args.datasetdir), args.patientid)
+        logger.info("Done.")
+    else:
+        statsdir = patdir / "STATISTICS"
+        statsdir.mkdir(exist_ok=True)
+
+        aseg_series = pd.Series(
+            nibabel.load(aseg_volume).get_fdata().astype(int).reshape(-1)
         )
-    print(df.head())
-    logger.info(f"Saving dataframe to {statsdir / args.outputname} ...")
-    df.to_csv(statsdir / args.outputname, index=False)
-    df.head(10).to_csv(statsdir / f"concentrations_test.csv", index=False)
-    logger.info("Done.")
+        df = create_mri_dataframe(aseg_volume, np.ushort, "aseg")
+        for concfile in sorted(concdir.glob("*.mgz")):
+            logger.info(f"Adding '{concfile}' to dataframe")
+            timestamp = datetime.strptime(concfile.stem, "%Y%m%d_%H%M%S")
+            im = nibabel.load(concfile).get_fdata().astype(np.single)
+
+            df = df.assign(
+                **{str(pd.to_datetime(timestamp)): pd.Series(im.reshape(-1), dtype=float)}
+            )
+        print(df.head())
+        logger.info(f"Saving dataframe to {statsdir / args.outputname} ...")
+        df.to_csv(statsdir / args.outputname, index=False)
+        df.head(10).to_csv(statsdir / f"concentrations_test.csv", index=False)
+        logger.info("Done.")
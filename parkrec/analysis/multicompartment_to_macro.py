@@ -1,41 +1,135 @@
 import logging
+from typing import Optional
 
 import dolfin as df
+import numpy as np
 from pantarei.fenicsstorage import FenicsStorage
 
-from parkrec.models.multidiffusion_model import get_default_coefficients, print_progress
+from parkrec.models.parallel import assign_local
+from parkrec.models.timeseries import TimeSeriesStorage, timeseries_path
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 df.set_log_level(df.LogLevel.WARNING)
 
+
+class MacroReduction:
+    """Weighted sum over the compartments of a mixed function, e.g. the total
+    concentration sum_j phi_j c_j, computed directly on the local arrays of the
+    mixed vector. The dofs of each compartment are looked up once; if the dofs
+    are interleaved (compartment j at n * i + j), which is the case for the
+    mixed P1 spaces of the models, the sum is a product of the array reshaped
+    to (..., num_nodes, n) with the weights."""
+
+    def __init__(self, V: df.FunctionSpace, weights):
+        self.weights = np.asarray(weights, dtype=float)
+        n = self.weights.size
+        self.W, _ = V.sub(0).collapse(collapsed_dofs=True)
+        first, last = self.W.dofmap().ownership_range()
+        mixed_first, mixed_last = V.dofmap().ownership_range()
+        # The collapsed spaces of the compartments have the same dof numbering,
+        # so the compartment dofs of each node are found through the maps from
+        # the collapsed to the mixed dofs. The maps are in the process-local
+        # numbering, where the owned dofs come first.
+        self.indices = np.full((n, last - first), -1, dtype=np.int64)
+        for j in range(n):
+            _, mapping = V.sub(j).collapse(collapsed_dofs=True)
+            collapsed = np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))
+            mixed = np.fromiter(mapping.values(), dtype=np.int64, count=len(mapping))
+            owned = (collapsed < last - first) & (mixed < mixed_last - mixed_first)
+            self.indices[j, collapsed[owned]] = mixed[owned]
+        assert (self.indices >= 0).all(), "Compartment dofs owned by another process."
+        interleaved = n * np.arange(last - first) + np.arange(n)[:, None]
+        self.interleaved = bool(np.array_equal(self.indices, interleaved))
+
+    def __call__(self, values: np.ndarray) -> np.ndarray:
+        """Reduces local mixed arrays of shape (..., num_mixed_dofs) to arrays of
+        shape (..., num_dofs), e.g. a block of time steps at once."""
+        if self.interleaved:
+            return values.reshape(*values.shape[:-1], -1, self.weights.size) @ self.weights
+        return self.weights @ values[..., self.indices]
+
+    def function(self, u: df.Function, out: df.Function) -> df.Function:
+        assign_local(out, self(u.vector().get_local()))
+        return out
+
+
+def write_initial_total(
+    storage: FenicsStorage, funcname: str, outname: str, weights
+) -> tuple[df.Function, MacroReduction]:
+    """Writes the reduction of the initial state of `funcname`, which also
+    stores the function space of the total, and returns the initial state and
+    the reduction."""
+    u = storage.read_function(funcname, idx=0)
+    reduction = MacroReduction(u.function_space(), weights)
+    c = df.Function(reduction.W)
+    storage.write_function(reduction.function(u, c), outname, overwrite=True)
+    return u, reduction
+
+
+def macro_concentration(storage: FenicsStorage, funcname: str, outname: str, weights):
+    """Writes the weighted sum over the compartments of each checkpoint of the
+    mixed function `funcname` in the FenicsStorage as checkpoints of `outname`."""
+    timevec = storage.read_timevector(funcname)
+    u, reduction = write_initial_total(storage, funcname, outname, weights)
+    c = df.Function(reduction.W)
+    for idx, ti in enumerate(timevec[1:], start=1):
+        storage.read_checkpoint(u, funcname, idx)
+        storage.write_checkpoint(reduction.function(u, c), outname, float(ti))
+
+
+def macro_timeseries(
+    timeseries: TimeSeriesStorage,
+    funcname: str,
+    outname: str,
+    reduction: MacroReduction,
+    chunk_times: Optional[int] = None,
+):
+    """Writes the reduction of all checkpoints of `funcname` in the time-series
+    storage as `outname`, reading `chunk_times` steps at a time (by default the
+    chunk height of the dataset). The stored values are in the global dof
+    numbering, so this is done in serial."""
+    values = timeseries.values(funcname)
+    times = timeseries.read_timevector(funcname)
+    chunk_times = chunk_times or values.chunks[0]
+    for start in range(0, times.size, chunk_times):
+        block = reduction(values[start : start + chunk_times])
+        for ti, row in zip(times[start : start + chunk_times], block):
+            timeseries.write_values(row, outname, float(ti))
+
+
 if __name__ == "__main__":
-    phi = [phi_j for phi_j in get_default_coefficients()["porosity"].values()]
-    phi_tot = sum(phi)
-    compartments = ["ecs", "pvs"]
-    data_file = "DATA/PAT_002/FENICS/cdata_32.hdf"
-
-    logger.info(f"Reading 'multidiffusion' from {data_file}")
-    storage = FenicsStorage(data_file, "a")
-    timevec = storage.read_timevector("multidiffusion")
-    u = storage.read_function("multidiffusion", idx=0)
-
-    logger.info(f"Computing macroscopic concentration at t={timevec[0]}")
-    c = df.Function(u.function_space().sub(0).collapse())
-    c.vector()[:] = sum(
-        [phi[j] * uj.vector() for j, uj in enumerate(u.split(deepcopy=True))]
+    import argparse
+
+    from parkrec.models.multidiffusion_model import get_default_coefficients
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputfile", help="e.g. DATA/PAT_###/FENICS/cdata_32.hdf")
+    parser.add_argument("--compartments", type=str, nargs="+", default=["ecs", "pvs"])
+    parser.add_argument("--funcname", type=str, default="multidiffusion")
+    parser.add_argument("--output", type=str, default="multidiffusion_total")
+    parser.add_argument(
+        "--timeseries",
+        action="store_true",
+        help="Read and write the checkpoints in the time-series file of the input.",
     )
-    storage.write_function(c, "/multidiffusion_total", overwrite=True)
-
-    for idx, ti in enumerate(timevec[1:]):
-        print_progress(float(ti), timevec[-1], rank=df.MPI.comm_world.rank)
-        u = storage.read_checkpoint(u, "multidiffusion", idx=idx + 1)
-        c.vector()[:] = sum(
-            [phi[j] * uj.vector() for j, uj in enumerate(u.split(deepcopy=True))]
-        )
-        storage.write_checkpoint(c, "/multidiffusion_total", ti)
-    storage.close()
-
-    file = FenicsStorage(storage.filepath, "r")
-    file.to_xdmf("multidiffusion_total", "total")
-    file.close()
+    args = parser.parse_args()
+
+    porosity = get_default_coefficients()["porosity"]
+    weights = [porosity[j] for j in args.compartments]
+
+    logger.info(f"Reading '{args.funcname}' from {args.inputfile}")
+    storage = FenicsStorage(args.inputfile, "a")
+    if args.timeseries:
+        _, reduction = write_initial_total(storage, args.funcname, args.output, weights)
+        storage.close()
+        timeseries = TimeSeriesStorage(timeseries_path(args.inputfile), "a")
+        macro_timeseries(timeseries, args.funcname, args.output, reduction)
+        timeseries.close()
+    else:
+        macro_concentration(storage, args.funcname, args.output, weights)
+        storage.close()
+
+        file = FenicsStorage(storage.filepath, "r")
+        file.to_xdmf(args.output, "total")
+        file.close()
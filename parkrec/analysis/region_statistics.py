@@ -0,0 +1,188 @@
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import nibabel
+import numpy as np
+import pandas as pd
+
+from parkrec.analysis.seg_groups import default_segmentation_groups
+from parkrec.utils import file_hash
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LabelIndex:
+    """Flat voxel indices sorted by segmentation label, such that the voxels
+    with label l are order[offsets[l]:offsets[l+1]]."""
+
+    order: np.ndarray
+    offsets: np.ndarray
+    shape: tuple[int, ...]
+
+    def labels(self, labels: list[int]) -> list[int]:
+        """The distinct labels present in the index, such that labels listed
+        more than once in a group are only counted once."""
+        return [int(label) for label in np.unique(labels) if label < self.offsets.size - 1]
+
+    def positions(self, labels: list[int]) -> np.ndarray:
+        """Positions within `order` of the voxels with any of the labels."""
+        return np.concatenate(
+            [np.arange(self.offsets[l], self.offsets[l + 1]) for l in self.labels(labels)]
+            + [np.empty(0, dtype=np.int64)]
+        )
+
+    def voxels(self, labels: list[int]) -> np.ndarray:
+        return self.order[self.positions(labels)]
+
+    def save(self, path: Path, key: str = "") -> Path:
+        np.savez(path, order=self.order, offsets=self.offsets, shape=self.shape, key=key)
+        return Path(path)
+
+    @classmethod
+    def load(cls, path: Path) -> tuple["LabelIndex", str]:
+        with np.load(path) as f:
+            shape = tuple(int(n) for n in f["shape"])
+            return cls(f["order"], f["offsets"], shape), str(f["key"])
+
+
+def create_label_index(aseg: np.ndarray) -> LabelIndex:
+    labels = aseg.reshape(-1).astype(np.int64)
+    order = np.argsort(labels, kind="stable").astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels))))
+    return LabelIndex(order, offsets, aseg.shape)
+
+
+def cached_label_index(aseg_file: Path, cachefile: Path) -> LabelIndex:
+    """Loads the label index of the segmentation from the cachefile, recreating
+    it if the segmentation has changed."""
+    key = file_hash(aseg_file)
+    if cachefile.exists():
+        index, cached_key = LabelIndex.load(cachefile)
+        if cached_key == key:
+            return index
+    logger.info(f"Creating label index for {aseg_file}")
+    aseg = np.asarray(nibabel.load(aseg_file).dataobj)
+    index = create_label_index(aseg)
+    cachefile.parent.mkdir(exist_ok=True, parents=True)
+    index.save(cachefile, key)
+    return index
+
+
+def region_statistics(
+    data: np.ndarray,
+    index: LabelIndex,
+    groups: dict[str, list[int]],
+    percentiles: tuple[float, ...] = (10, 90),
+    voxel_volume: float = 1.0,
+) -> pd.DataFrame:
+    """Computes statistics of the data within each group of labels, ignoring
+    non-finite values. Sums are computed for all labels in one pass, while
+    medians and percentiles are computed from the gathered group values."""
+    values = data.reshape(-1)[index.order]
+    finite = np.isfinite(values)
+    values = np.where(finite, values, 0.0)
+    starts = index.offsets[:-1]
+    nonempty = np.diff(index.offsets) > 0
+    label_count = np.zeros(starts.size)
+    label_sum = np.zeros(starts.size)
+    label_sumsq = np.zeros(starts.size)
+    label_count[nonempty] = np.add.reduceat(finite, starts[nonempty])
+    label_sum[nonempty] = np.add.reduceat(values, starts[nonempty])
+    label_sumsq[nonempty] = np.add.reduceat(values**2, starts[nonempty])
+
+    records = []
+    for group, labels in groups.items():
+        labels = index.labels(labels)
+        count = label_count[labels].sum()
+        mean = label_sum[labels].sum() / count if count > 0 else np.nan
+        variance = label_sumsq[labels].sum() / count - mean**2 if count > 0 else np.nan
+        positions = index.positions(labels)
+        group_values = values[positions][finite[positions]]
+        quantiles = (
+            np.percentile(group_values, [50, *percentiles])
+            if group_values.size > 0
+            else np.full(len(percentiles) + 1, np.nan)
+        )
+        records.append(
+            {
+                "region": group,
+                "volume": np.diff(index.offsets)[labels].sum() * voxel_volume,
+                "mean": mean,
+                "std": np.sqrt(max(variance, 0.0)),
+                "median": quantiles[0],
+                **{f"p{p:g}": q for p, q in zip(percentiles, quantiles[1:])},
+            }
+        )
+    return pd.DataFrame.from_records(records)
+
+
+def patient_region_statistics(
+    patientdir: Path,
+    concentration_dirname: str,
+    groups: Optional[dict[str, list[int]]] = None,
+    percentiles: tuple[float, ...] = (10, 90),
+) -> pd.DataFrame:
+    if groups is None:
+        groups = default_segmentation_groups()
+    aseg_file = patientdir / "mri" / "aseg.mgz"
+    index = cached_label_index(aseg_file, patientdir / "STATISTICS" / "aseg_index.npz")
+    voxel_volume = float(np.prod(nibabel.load(aseg_file).header.get_zooms()[:3]))
+
+    tables = []
+    for concfile in sorted((patientdir / concentration_dirname).glob("*.mgz")):
+        logger.info(f"Computing region statistics for '{concfile}'")
+        timestamp = datetime.strptime(concfile.stem, "%Y%m%d_%H%M%S")
+        data = nibabel.load(concfile).get_fdata(dtype=np.single)
+        assert data.shape == index.shape, f"{concfile} and aseg have different shapes."
+        table = region_statistics(data, index, groups, percentiles, voxel_volume)
+        tables.append(table.assign(time=pd.to_datetime(timestamp)))
+    return pd.concat(tables, ignore_index=True).assign(patient=patientdir.name)
+
+
+def cohort_region_statistics(
+    datadir: Path,
+    concentration_dirname: str,
+    patients: Optional[list[str]] = None,
+    groups: Optional[dict[str, list[int]]] = None,
+    percentiles: tuple[float, ...] = (10, 90),
+) -> pd.DataFrame:
+    """Tidy table of region statistics for all patients, regions and
+    timepoints."""
+    if patients is None:
+        patients = sorted(
+            p.name for p in datadir.iterdir() if re.match(r"PAT_\d{3}$", p.name)
+        )
+    table = pd.concat(
+        [
+            patient_region_statistics(
+                datadir / patient, concentration_dirname, groups, percentiles
+            )
+            for patient in patients
+        ],
+        ignore_index=True,
+    )
+    columns = ["patient", "region", "time"]
+    return table[columns + [c for c in table.columns if c not in columns]]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("concentration_dirname", type=str)
+    parser.add_argument("--patients", type=str, nargs="+", default=None)
+    parser.add_argument("--datadir", type=str, default="DATA")
+    parser.add_argument("--output", type=str, default="DATA/region_statistics.csv")
+    args = parser.parse_args()
+
+    table = cohort_region_statistics(
+        Path(args.datadir), args.concentration_dirname, args.patients
+    )
+    logger.info(f"Saving region statistics to {args.output}")
+    table.to_csv(args.output, index=False)
@@ -0,0 +1,75 @@
+"""Bounded-concurrency execution of external commands (FreeSurfer, dcm2niix),
+with one logfile per job, retries, and a summary of wall times."""
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    name: str
+    cmd: str
+    logfile: Path
+
+
+@dataclass
+class JobResult:
+    name: str
+    returncode: int
+    walltime: float
+    attempts: int
+
+
+def run_job(job: Job, env: dict[str, str], retries: int = 0) -> JobResult:
+    job.logfile.parent.mkdir(exist_ok=True, parents=True)
+    tic = time.time()
+    for attempt in range(1, retries + 2):
+        with open(job.logfile, "w" if attempt == 1 else "a") as log:
+            log.write(f"# Attempt {attempt}: {job.cmd}\n")
+            log.flush()
+            returncode = subprocess.run(
+                job.cmd, shell=True, stdout=log, stderr=subprocess.STDOUT, env=env
+            ).returncode
+        if returncode == 0:
+            break
+        logger.warning(f"Job '{job.name}' failed (attempt {attempt}), see {job.logfile}")
+    return JobResult(job.name, returncode, time.time() - tic, attempt)
+
+
+def run_jobs(
+    jobs: list[Job],
+    cores: Optional[int] = None,
+    threads_per_job: int = 1,
+    retries: int = 1,
+) -> list[JobResult]:
+    """Runs the jobs concurrently, such that at most `cores` threads are in use
+    when each job is limited to `threads_per_job` OpenMP/ITK-threads. Raises a
+    RuntimeError after all jobs have finished if any of them failed."""
+    if cores is None:
+        cores = os.cpu_count()
+    max_workers = max(1, cores // threads_per_job)
+    env = {
+        **os.environ,
+        "OMP_NUM_THREADS": str(threads_per_job),
+        "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS": str(threads_per_job),
+    }
+    logger.info(f"Running {len(jobs)} jobs, {max_workers} at a time.")
+    with ThreadPoolExecutor(max_workers) as executor:
+        results = list(executor.map(lambda job: run_job(job, env, retries), jobs))
+
+    for result in results:
+        logger.info(
+            f"{result.name}: {result.walltime:.1f} s"
+            + f" ({result.attempts} attempt(s), returncode {result.returncode})"
+        )
+    failed = [result.name for result in results if result.returncode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Jobs failed: {failed}")
+    return results
@@ -1,21 +1,126 @@
 from pathlib import Path
+from typing import Optional
 
 import dolfin as df
 import numpy as np
-import pantarei.interpolator as pri
 from pantarei.fenicsstorage import FenicsStorage, delete_dataset
-from SVMTK import svmtk
+
+
+class LazyInterpolator:
+    """Linear interpolation in time of a series of functions stored in a
+    FenicsStorage-file, with the same call signature as pantarei's
+    vectordata_interpolator. Only the locally owned vector entries of the two
+    checkpoints bracketing the current time are kept in memory, and are read
+    on demand. With `prefetch`, the checkpoint following the current interval
+    is read together with the current ones, such that crossing a measurement
+    time does not require a read.
+
+    `storage` is either a path, or an open FenicsStorage, which allows
+    reading from the same file as the results are written to."""
+
+    def __init__(self, storage, funcname: str, prefetch: bool = False):
+        self.owns_storage = not isinstance(storage, FenicsStorage)
+        if self.owns_storage:
+            storage = FenicsStorage(storage, "r")
+        self.storage = storage
+        self.funcname = funcname
+        self.prefetch = prefetch
+        self.times = np.asarray(storage.read_timevector(funcname), dtype=float)
+        self.buffer = storage.read_function(funcname, idx=0)
+        self.window = {0: self.buffer.vector().get_local()}
+        self.out = np.empty(self.window[0].size)
+
+    def function_space(self) -> df.FunctionSpace:
+        return self.buffer.function_space()
+
+    def function(self, idx: int) -> df.Function:
+        u = df.Function(self.function_space())
+        u.vector().set_local(self.values(idx))
+        u.vector().apply("insert")
+        return u
+
+    def values(self, idx: int) -> np.ndarray:
+        if idx not in self.window:
+            self.storage.read_checkpoint(self.buffer, self.funcname, idx)
+            self.window[idx] = self.buffer.vector().get_local()
+        return self.window[idx]
+
+    def interval(self, t: float) -> int:
+        idx = np.searchsorted(self.times, t, side="right") - 1
+        return int(np.clip(idx, 0, self.times.size - 2))
+
+    def __call__(self, t: float) -> np.ndarray:
+        i = self.interval(t)
+        window = [i, i + 1] + ([i + 2] if self.prefetch and i + 2 < self.times.size else [])
+        for idx in list(self.window):
+            if idx not in window:
+                del self.window[idx]
+        for idx in window:
+            self.values(idx)
+
+        s = (t - self.times[i]) / (self.times[i + 1] - self.times[i])
+        s = min(max(s, 0.0), 1.0)
+        np.subtract(self.window[i + 1], self.window[i], out=self.out)
+        self.out *= s
+        self.out += self.window[i]
+        return self.out
+
+    def close(self):
+        if self.owns_storage:
+            self.storage.close()
+
+
+class TimeSeriesInterpolator(LazyInterpolator):
+    """Interpolator for repeated evaluation of a stored time series at
+    arbitrary times. The file is kept open, and the `cache_size` most recently
+    used checkpoints are kept in memory. `function_at` returns the same
+    function object at every call."""
+
+    def __init__(self, storage, funcname: str, cache_size: int = 4):
+        super().__init__(storage, funcname)
+        self.cache_size = max(cache_size, 2)
+        self.output = df.Function(self.function_space())
+
+    def values(self, idx: int) -> np.ndarray:
+        if idx in self.window:
+            self.window[idx] = self.window.pop(idx)
+            return self.window[idx]
+        values = super().values(idx)
+        while len(self.window) > self.cache_size:
+            del self.window[next(iter(self.window))]
+        return values
+
+    def __call__(self, t: float, out: Optional[np.ndarray] = None) -> np.ndarray:
+        i = self.interval(t)
+        s = (t - self.times[i]) / (self.times[i + 1] - self.times[i])
+        s = min(max(s, 0.0), 1.0)
+        out = self.out if out is None else out
+        y0 = self.values(i)
+        np.subtract(self.values(i + 1), y0, out=out)
+        out *= s
+        out += y0
+        return out
+
+    def evaluate(self, times) -> np.ndarray:
+        """(n_times, n_local_dofs)-array of the interpolated values. The times
+        are visited in increasing order, such that each checkpoint is read
+        at most once."""
+        times = np.asarray(times, dtype=float)
+        values = np.empty((times.size, self.out.size))
+        for idx in np.argsort(times, kind="stable"):
+            self(times[idx], out=values[idx])
+        return values
+
+    def function_at(self, t: float) -> df.Function:
+        self.output.vector().set_local(self(t))
+        self.output.vector().apply("insert")
+        return self.output
 
 
 def interpolate_from_file(filepath, name, t):
-    store = FenicsStorage(filepath, "r")
-    tvec = store.read_timevector(name)
-    bin = np.digitize(t, tvec) - 1
-    C = [store.read_function(name, idx=i) for i in range(tvec.size)[bin : bin + 2]]
-    interpolator = pri.vectordata_interpolator(C, tvec[bin : bin + 2])
-    u = df.Function(C[0].function_space())
-    u.vector()[:] = interpolator(t)
-    store.close()
+    interpolator = TimeSeriesInterpolator(filepath, name)
+    u = interpolator.function_at(t)
+    interpolator.close()
     return u
 
 
@@ -29,18 +134,15 @@ if __name__ == "__main__":
 
     filepath = Path("DATA/PAT_002/FENICS/cdata_32.hdf")
     store = FenicsStorage(filepath, "a")
-    tvec = store.read_timevector("cdata")
-    C = [store.read_function("cdata", idx=i) for i in range(tvec.size)]
     delete_dataset(store, "/cinterp")
-    interpolator = pri.vectordata_interpolator(C, tvec)
-    V = C[0].function_space()
-    u = df.Function(V)
-    ti = 0.0
-    dt = tvec[-1] / 10
-    while ti < tvec[-1]:
-        u.vector()[:] = interpolator(ti)  # , V)
+    interpolator = TimeSeriesInterpolator(store, "cdata")
+    tvec = interpolator.times
+    u = df.Function(interpolator.function_space())
+    times = np.arange(0.0, tvec[-1], tvec[-1] / 10)
+    for ti, values in zip(times, interpolator.evaluate(times)):
+        u.vector().set_local(values)
+        u.vector().apply("insert")
         store.write_checkpoint(u, "cinterp", ti)
-        ti += dt
     store.close()
     from mri2fenics import fenicsstorage2xdmf
 
@@ -48,8 +150,9 @@ if __name__ == "__main__":
 
     store = FenicsStorage(filepath, "a")
     delete_dataset(store, "/ccheckpoints")
+    interpolator = TimeSeriesInterpolator(store, "cinterp")
     for ti in tvec:
-        u = interpolate_from_file(filepath, "cinterp", ti)
+        u = interpolator.function_at(ti)
         store.write_checkpoint(u, "ccheckpoints", ti)
     fenicsstorage2xdmf(store.filepath, "ccheckpoints", "ccheckpoints")
     store.close()
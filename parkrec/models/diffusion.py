@@ -10,6 +10,191 @@ from fenics import *
 from measurements import MRI_Measurements
 from tqdm import tqdm
 
+from parkrec.models.parallel import is_root, owned_marked_dofs
+from parkrec.models.solvers import SOLVER_STRATEGIES, create_solver
+from parkrec.models.timestepping import AdaptiveStepper
+
+
+def root_print(*args, **kwargs):
+    if is_root():
+        print(*args, **kwargs)
+
+
+def boundary(x, on_boundary):
+    return on_boundary
+
+
+def pchip_slopes(times: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Slopes of the monotone piecewise cubic Hermite interpolant (Fritsch-Carlson,
+    as in scipy.interpolate.PchipInterpolator) through values of shape
+    (n_times, n_points)."""
+    h = np.diff(times)[:, None]
+    delta = np.diff(values, axis=0) / h
+    if len(times) == 2:
+        return np.concatenate((delta, delta))
+
+    slopes = np.zeros_like(values)
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same_sign = delta[:-1] * delta[1:] > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        whmean = (w1 / delta[:-1] + w2 / delta[1:]) / (w1 + w2)
+        slopes[1:-1] = np.where(same_sign, 1.0 / whmean, 0.0)
+
+    def edge_slope(h0, h1, delta0, delta1):
+        d = ((2 * h0 + h1) * delta0 - h0 * delta1) / (h0 + h1)
+        d = np.where(np.sign(d) != np.sign(delta0), 0.0, d)
+        overshoot = (np.sign(delta0) != np.sign(delta1)) & (np.abs(d) > np.abs(3 * delta0))
+        return np.where(overshoot, 3 * delta0, d)
+
+    slopes[0] = edge_slope(h[0], h[1], delta[0], delta[1])
+    slopes[-1] = edge_slope(h[-1], h[-2], delta[-1], delta[-2])
+    return slopes
+
+
+class BoundaryData:
+    """Interpolates the image data on the boundary degrees of freedom in time,
+    either linearly or by monotone cubic (PCHIP) interpolation. The data is
+    stored as an (n_times, n_boundary_dofs)-array, and the interpolated values
+    are written in-place into the boundary function of a persistent DirichletBC."""
+
+    def __init__(self, V, data, times, interpolation="linear"):
+        if interpolation not in ("linear", "cubic"):
+            raise ValueError(f"Unknown interpolation '{interpolation}'")
+        # Only the locally owned boundary dofs are updated; the ghost values are
+        # updated by vector().apply(). An owned dof may lie on a boundary facet
+        # of another process only, so the boundary dofs are collected from all
+        # processes, such that the ghost copies used there are up to date.
+        boundary_values = DirichletBC(V, Constant(0.0), boundary).get_boundary_values()
+        dofs = np.fromiter(boundary_values.keys(), dtype=np.intc)
+        self.dofs = owned_marked_dofs(V, dofs)
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.array([d.vector().get_local()[self.dofs] for d in data])
+        self.slopes = None
+        if interpolation == "cubic":
+            self.slopes = pchip_slopes(self.times, self.values)
+
+        self.function = Function(V)
+        self.bc = DirichletBC(V, self.function, boundary)
+        self.buffer = self.function.vector().get_local()
+        self.out = np.empty(self.dofs.size)
+        self.tmp = np.empty(self.dofs.size)
+
+    def interpolate(self, t):
+        i = np.clip(np.searchsorted(self.times, t, side="right") - 1, 0, self.times.size - 2)
+        h = self.times[i + 1] - self.times[i]
+        s = min(max((t - self.times[i]) / h, 0.0), 1.0)
+        y0, y1 = self.values[i], self.values[i + 1]
+        out, tmp = self.out, self.tmp
+        if self.slopes is None:
+            np.subtract(y1, y0, out=out)
+            out *= s
+            out += y0
+            return out
+
+        # Cubic Hermite basis functions.
+        np.multiply(y0, 2 * s**3 - 3 * s**2 + 1, out=out)
+        np.multiply(y1, -2 * s**3 + 3 * s**2, out=tmp)
+        out += tmp
+        np.multiply(self.slopes[i], h * (s**3 - 2 * s**2 + s), out=tmp)
+        out += tmp
+        np.multiply(self.slopes[i + 1], h * (s**3 - s**2), out=tmp)
+        out += tmp
+        return out
+
+    def __call__(self, t) -> DirichletBC:
+        self.buffer[self.dofs] = self.interpolate(t)
+        self.function.vector().set_local(self.buffer)
+        self.function.vector().apply("insert")
+        return self.bc
+
+
+class ObservationRecorder:
+    """Records the time, the average over the brain and its surface, and the
+    averages over each subdomain of the solution at every time step. The
+    averages are computed as dot products with precomputed weight vectors
+    (assembled test functions), and the rows are buffered in memory and
+    written to an npz-file every `flush_every` steps and when closed."""
+
+    def __init__(self, V, filename: pathlib.Path, n_steps: int, dx_SD=None, flush_every=None):
+        v = TestFunction(V)
+        measures = {"avg": dx(domain=V.mesh()), "avgds": ds(domain=V.mesh())}
+        if dx_SD is not None:
+            measures.update({"gray": dx_SD(1), "white": dx_SD(2), "brainstem": dx_SD(3)})
+        self.weights = {}
+        for name, measure in measures.items():
+            volume = assemble(Constant(1.0) * measure)
+            if volume == 0.0:
+                # E.g. a subdomain tag which is not present in the mesh.
+                root_print(f"Warning: '{name}' has zero volume, and is not recorded.")
+                continue
+            weight = assemble(v * measure)
+            weight /= volume
+            self.weights[name] = weight
+
+        self.columns = ["t", *self.weights]
+        self.filename = filename
+        self.flush_every = flush_every
+        self.rows = np.zeros((n_steps, len(self.columns)))
+        self.n = 0
+
+    def __call__(self, t, fun):
+        if self.n == self.rows.shape[0]:
+            self.rows = np.concatenate((self.rows, np.zeros_like(self.rows)))
+        row = self.rows[self.n]
+        row[0] = t
+        for j, weight in enumerate(self.weights.values(), start=1):
+            row[j] = weight.inner(fun.vector())
+        self.n += 1
+        if self.flush_every is not None and self.n % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if is_root():
+            np.savez(
+                self.filename,
+                **{name: self.rows[: self.n, j] for j, name in enumerate(self.columns)},
+            )
+
+
+class MovieWriter:
+    """Writes the state to a PVD- or XDMF-file every `stride` steps, or only at the
+    checkpoints (the time steps closest to the MRI measurement times) if `stride` is
+    'checkpoints'. A stride of 0 disables the output."""
+
+    def __init__(self, filename: pathlib.Path, stride=1, checkpoints=None):
+        self.stride = stride
+        self.checkpoints = checkpoints
+        self.file = None
+        if stride == 0:
+            return
+        if filename.suffix == ".xdmf":
+            self.file = XDMFFile(MPI.comm_world, str(filename))
+            self.file.parameters["functions_share_mesh"] = True
+            self.file.parameters["rewrite_function_mesh"] = False
+        else:
+            self.file = File(str(filename))
+
+    def is_output_step(self, step, t):
+        if self.file is None:
+            return False
+        if self.stride == "checkpoints":
+            return np.round(t, 0) in self.checkpoints
+        return step % self.stride == 0
+
+    def __call__(self, fun, step, t, force=False):
+        if not (force or self.is_output_step(step, t)):
+            return
+        fun.rename("simulation", "simulation")
+        if isinstance(self.file, XDMFFile):
+            self.file.write(fun, t)
+        else:
+            self.file << (fun, t)
+
+    def close(self):
+        if isinstance(self.file, XDMFFile):
+            self.file.close()
+
 
 class Model(object):
     def __init__(
@@ -22,8 +207,13 @@ class Model(object):
         diffusion_tensor,
         dx_SD,
         verbosity: int = 0,
+        boundary_interpolation: str = "linear",
+        flush_every=None,
+        adaptive_tol=None,
     ):
         """
+        :param adaptive_tol: if given, use adaptive time steps with this tolerance,
+            starting from dt, and landing exactly on the measurement times
         :param mesh_config: dictionary which contains ds, dx
         :param V: FunctionSpace for state variable
         :param delta: diffusion coefficient
@@ -52,9 +242,10 @@ class Model(object):
 
         self.t = 0
         self.dt = dt
+        self.adaptive_tol = adaptive_tol
         self.T = max(self.times)
 
-        print(
+        root_print(
             "Simulating for",
             format(self.T / 3600, ".0f"),
             "hours",
@@ -74,22 +265,12 @@ class Model(object):
         self.brain_volume = assemble(Constant(1) * self.dx)
         self.brain_surface_area = assemble(1 * self.ds)
 
-        if self.dx_SD is not None:
-            self.gray_volume = assemble(1 * dx_SD(1))
-            self.white_matter_volume = assemble(1 * dx_SD(2))
-            self.brain_stem_volume = assemble(1 * dx_SD(3))
-
-        self.concfile = self.outfolder / "simulated_concentration.txt"
-        with open(self.concfile, "w") as file:
-            file.write("t avg avgds ")
-            if self.dx_SD is not None:
-                file.write("gray white brainstem ")
-            file.write("\n")
-
         self.image_counter = 1
         self.image_counter_prev = 0
 
-        self.linear_interpolation = Function(V)
+        self.boundary_data = BoundaryData(
+            V, self.data, self.times, interpolation=boundary_interpolation
+        )
 
         self.simulated_tracer = []
 
@@ -103,14 +284,22 @@ class Model(object):
 
         self.checkpoints = []
         for mri_time in self.times:
-            print(
+            root_print(
                 "Data available at",
                 format(mri_time / 3600, ".0f"),
                 "hours past first image",
             )
-            self.checkpoints.append(
-                np.round(times[np.argmin(np.abs(times - mri_time))], 0).item()
-            )
+            if self.adaptive_tol is not None:
+                self.checkpoints.append(np.round(mri_time, 0).item())
+            else:
+                self.checkpoints.append(
+                    np.round(times[np.argmin(np.abs(times - mri_time))], 0).item()
+                )
+
+        self.concfile = self.outfolder / "simulated_concentration.npz"
+        self.recorder = ObservationRecorder(
+            V, self.concfile, len(times), dx_SD=self.dx_SD, flush_every=flush_every
+        )
 
     def save_predictions(
         self,
@@ -136,21 +325,22 @@ class Model(object):
 
         checkpoints = {"simulation": self.checkpoints, "data": self.times}
 
-        with open(self.outfolder / "checkpoints.json", "w") as outfile:
-            json.dump(checkpoints, outfile, sort_keys=True, indent=4)
+        if is_root():
+            with open(self.outfolder / "checkpoints.json", "w") as outfile:
+                json.dump(checkpoints, outfile, sort_keys=True, indent=4)
 
-    def advance_time(self, current_state):
+    def advance_time(self, current_state, t=None):
         """
         update of time variables and boundary conditions
         """
-        self.t += self.dt  # update time-step
+        self.t = self.t + self.dt if t is None else t  # update time-step
 
         if self.t > self.times[self.image_counter]:
             self.image_counter_prev = self.image_counter
 
             while self.t > self.times[self.image_counter]:
                 if self.verbosity == 1:
-                    print(
+                    root_print(
                         "t=",
                         format(self.t / 3600, ".2f"),
                         "Increasing image counter from",
@@ -175,7 +365,7 @@ class Model(object):
                 i = self.image_counter
 
             if self.verbosity == 1:
-                print(
+                root_print(
                     "Computing L2 error at t=",
                     format(self.t / 3600, ".2f"),
                     "(image ",
@@ -194,7 +384,7 @@ class Model(object):
             self.datanorm += datanorm
 
             if self.verbosity == 0:
-                print(
+                root_print(
                     "Rel. L2 error ||c-cdata|| / ||cdata|| at t=",
                     format(self.t / 3600, ".2f"),
                     "is",
@@ -210,82 +400,46 @@ class Model(object):
 
     def boundary_condition(self):
         """
-        Linear interpolation c_1 + (c2 - c1) / (t2 - t1) * (t - t1) of image data as boundary condition
+        Interpolation in time of the image data on the boundary, as boundary condition
         """
-
-        # print()
-
-        def boundary(x, on_boundary):
-            return on_boundary
-
         if self.verbosity == 1:
-            print(
+            root_print(
                 "time=",
                 format(self.t / 3600, ".0f"),
                 "h, image_counter=",
                 self.image_counter,
             )
 
-        self.linear_interpolation.vector()[:] = self.data[
-            self.image_counter_prev
-        ].vector()[:]
-
-        finite_difference = (
-            self.data[self.image_counter].vector()[:]
-            - self.data[self.image_counter_prev].vector()[:]
-        )
-        finite_difference /= (
-            self.times[self.image_counter] - self.times[self.image_counter_prev]
-        )
-
-        self.linear_interpolation.vector()[:] += finite_difference * (
-            self.t - self.times[self.image_counter_prev]
-        )
-
-        return DirichletBC(self.V, self.linear_interpolation, boundary)
+        return self.boundary_data(self.t)
 
     def return_value(self):
         return self.L2_error / self.datanorm
 
     def store_values(self, fun):
-        with open(self.concfile, "a") as file:
-            file.write("%g " % self.t)
-            average = assemble(fun * self.dx) / self.brain_volume
-            average_ds = assemble(fun * self.ds) / self.brain_surface_area
-
-            if self.dx_SD is not None:
-                gray_avg = assemble(fun * self.dx_SD(1)) / self.gray_volume
-                white_avg = assemble(fun * self.dx_SD(2)) / self.white_matter_volume
-                brain_stem_avg = assemble(fun * self.dx_SD(3)) / self.brain_stem_volume
-
-            file.write("%g " % average)
-            file.write("%g " % average_ds)
+        self.recorder(self.t, fun)
 
-            if self.dx_SD is not None:
-                file.write("%g " % gray_avg)
-                file.write("%g " % white_avg)
-                file.write("%g " % brain_stem_avg)
-            file.write("\n")
-
-    def forward(self, alpha=1, r=None):
+    def forward(
+        self, alpha=1, r=None, solver_strategy="auto", movie_stride=1, movie_format="pvd"
+    ):
+        """
+        :param movie_stride: write the state to the movie-file every movie_stride
+            time steps, only at the checkpoints if 'checkpoints', or never if 0.
+        """
         # Define trial and test-functions
         u = TrialFunction(self.V)
         v = TestFunction(self.V)
 
         # Solution at current and previous time
-        u_prev = self.data[0]  # Function(self.V)
-        u_next = self.data[0]  # Function(self.V)
+        u_prev = self.data[0].copy(deepcopy=True)
+        u_next = self.data[0].copy(deepcopy=True)
 
-        pvdfile = File(str(self.outfolder / "movie.pvd"))
-        # u_prev.rename("simulation", "simulation    ")
-        # pvdfile << u_prev
+        movie = MovieWriter(
+            self.outfolder / f"movie.{movie_format}", movie_stride, self.checkpoints
+        )
 
         self.simulated_tracer.append(u_prev.copy(deepcopy=True))
 
-        try:
-            self.store_values(fun=u_prev)
-        except:
-            pass
+        self.store_values(fun=u_prev)
 
         iter_k = 0
 
@@ -329,24 +483,32 @@ class Model(object):
         if r is not None:
             a += self.dt * reaction(fun=u)
 
-        A = assemble(a)
+        # The right hand side is the mass matrix applied to the previous state.
+        M = assemble(inner(u, v) * self.dx)
+
+        if self.adaptive_tol is not None:
+            k = alpha * diffusion(fun=u)
+            if r is not None:
+                k += reaction(fun=u)
+            self.forward_adaptive(M, assemble(k), u_next, movie, solver_strategy)
+            return
 
-        # breakpoint()
+        A = assemble(a)
+        b = Vector()
+        M.init_vector(b, 0)
 
-        # solver = LUSolver()
-        # solver.set_operator(A)
-        solver = PETScKrylovSolver("gmres", "amg")
-        solver.set_operators(A, A)
+        # The Dirichlet rows of A are the same at every time step, so they are
+        # only applied once, and the boundary values are inserted into b.
+        self.boundary_condition().apply(A)
+        solver = create_solver(A, solver_strategy)
 
         if self.verbosity == 0:
-            progress = tqdm(total=int(self.T / self.dt))
+            progress = tqdm(total=int(self.T / self.dt), disable=not is_root())
 
         while self.t + self.dt / 1 <= self.T:
+            movie(u_next, iter_k, self.t)
             iter_k += 1
 
-            u_prev.rename("simulation", "simulation")
-            pvdfile << u_prev
-
             u_prev.assign(u_next)
 
             self.advance_time(u_prev)
@@ -354,27 +516,59 @@ class Model(object):
             # get current BC:
             bc = self.boundary_condition()
 
-            # Assemble RHS and apply DirichletBC
-            rhs = u_prev * v * self.dx
-            b = assemble(rhs)
-            bc.apply(A, b)
+            # Compute RHS and apply DirichletBC
+            M.mult(u_prev.vector(), b)
+            bc.apply(b)
 
             # Solve A* u_current = b
             solver.solve(u_next.vector(), b)
 
             # solve(A, U.vector(), b, 'lu')
-            try:
-                self.store_values(fun=u_next)
-            except:
-                pass
+            self.store_values(fun=u_next)
             if self.verbosity == 0:
                 progress.update(1)
 
-        u_prev.assign(u_next)
-        u_prev.rename("simulation", "simulation")
-        pvdfile << u_prev
-
-        print("Done with simulation")
+        movie(u_next, iter_k, self.t, force=movie_stride != 0)
+        movie.close()
+        self.recorder.flush()
+
+        root_print("Done with simulation")
+
+    def forward_adaptive(self, M, K, u, movie, solver_strategy="auto"):
+        """Time loop with adaptive implicit Euler steps of (M + dt K) u = M u_prev.
+        The state is compared to the data directly after each step, since the
+        steps end exactly on the measurement times."""
+        stepper = AdaptiveStepper(
+            M,
+            K,
+            lambda t: [self.boundary_data(t)],
+            self.dt,
+            stop_times=self.times,
+            tol=self.adaptive_tol,
+            solver_strategy=solver_strategy,
+        )
+        progress = tqdm(total=float(self.T), disable=self.verbosity != 0 or not is_root())
+        iter_k = 0
+        while self.t < self.T:
+            movie(u, iter_k, self.t)
+            iter_k += 1
+            t = stepper.step(u, self.t)
+            progress.update(t - self.t)
+            self.dt = t - self.t
+            self.advance_time(u, t)
+            self.store_values(fun=u)
+
+        movie(u, iter_k, self.t, force=movie.file is not None)
+        movie.close()
+        self.recorder.flush()
+
+        root_print(
+            "Done with simulation,",
+            stepper.solves,
+            "solves,",
+            stepper.rejected,
+            "rejected steps",
+        )
 
 
 if __name__ == "__main__":
@@ -390,6 +584,28 @@ if __name__ == "__main__":
         help="path to mesh as .h5 file. Assuming that the file has /subdomains, /MD, /DTI",
     )
     parser.add_argument("--outfolder", default="./simulation_outputs/")
+    parser.add_argument("--solver", default="auto", choices=SOLVER_STRATEGIES)
+    parser.add_argument(
+        "--boundary_interpolation", default="linear", choices=("linear", "cubic")
+    )
+    parser.add_argument(
+        "--movie_stride",
+        default="1",
+        help="Write the state to the movie file every n-th time step, or only at the MRI times if 'checkpoints'. 0 disables the movie.",
+    )
+    parser.add_argument("--movie_format", default="pvd", choices=("pvd", "xdmf"))
+    parser.add_argument(
+        "--adaptive_tol",
+        type=float,
+        default=None,
+        help="Use adaptive time steps with this (relative) tolerance for the local error.",
+    )
+    parser.add_argument(
+        "--flush_every",
+        type=int,
+        default=None,
+        help="Write the recorded concentrations to file every n-th time step, and not only at the end.",
+    )
     parserargs = vars(parser.parse_args())
 
     mean_diffusivity_water = 3e-3
@@ -422,7 +638,7 @@ if __name__ == "__main__":
             # GRAY = 1. WHITE = 2. BRAIN STEM = 3.
             dx_SD = Measure("dx")(domain=brainmesh, subdomain_data=subdomains)
         except:
-            print("No subdomains found")
+            root_print("No subdomains found")
             dx_SD = None
 
     V = FunctionSpace(brainmesh, "CG", 1)
@@ -436,7 +652,7 @@ if __name__ == "__main__":
         diffusion_tensor = Function(diffusiontensor_Space)
         hdf.read(diffusion_tensor, "/DTI")
     except:
-        print(
+        root_print(
             "No DTI found, using D=1.3e-3 mm^2/s, taken from https://pubmed.ncbi.nlm.nih.gov/32514105/"
         )
         mean_diffusivity = Constant(1.3e-3)
@@ -460,12 +676,20 @@ if __name__ == "__main__":
         verbosity=0,
         diffusion_tensor=diffusion_tensor,
         mean_diffusivity=mean_diffusivity,
+        boundary_interpolation=parserargs["boundary_interpolation"],
+        flush_every=parserargs["flush_every"],
+        adaptive_tol=parserargs["adaptive_tol"],
     )
 
-    diffusion_model.forward()
+    movie_stride = parserargs["movie_stride"]
+    diffusion_model.forward(
+        solver_strategy=parserargs["solver"],
+        movie_stride=movie_stride if movie_stride == "checkpoints" else int(movie_stride),
+        movie_format=parserargs["movie_format"],
+    )
 
     mismatch = diffusion_model.L2_error
 
-    print("Simulation done, mismatch=", format(mismatch, ".2f"))
+    root_print("Simulation done, mismatch=", format(mismatch, ".2f"))
 
     diffusion_model.save_predictions()
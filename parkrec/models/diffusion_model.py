@@ -2,9 +2,14 @@ import dolfin as df
 from dolfin import grad, inner
 from pantarei.boundary import DirichletBoundary, process_dirichlet
 from pantarei.fenicsstorage import FenicsStorage
-from pantarei.interpolator import vectordata_interpolator
 from pantarei.timekeeper import TimeKeeper
 
+from parkrec.models.data_interpolator import LazyInterpolator
+from parkrec.models.parallel import assign_local
+from parkrec.models.sweep import SweepProblem
+from parkrec.models.timeseries import TimeSeriesStorage, timeseries_path
+from parkrec.models.timestepping import AdaptiveStepper
+
 
 def print_progress(t, T, rank=0):
     if rank != 0:
@@ -23,18 +28,62 @@ def read_concentration_data(filepath, funcname="data") -> list[df.Function]:
     return tvec, C
 
 
+def diffusion_sweep_problem(inputfile, funcname="data", dt=3600) -> SweepProblem:
+    """Diffusion problem with the diffusion coefficient 'D' as parameter."""
+    interpolator = LazyInterpolator(inputfile, funcname)
+    V = interpolator.function_space()
+    u_interp = df.Function(V)
+    bcs = process_dirichlet(V, V.mesh(), [DirichletBoundary(u_interp, "everywhere")])
+
+    dx = df.Measure("dx", V.mesh())
+    u = df.TrialFunction(V)
+    v = df.TestFunction(V)
+
+    def boundary_conditions(t, params):
+        assign_local(u_interp, interpolator(t))
+        return bcs
+
+    return SweepProblem(
+        M=df.assemble(u * v * dx),
+        K={"D": df.assemble(inner(grad(u), grad(v)) * dx)},
+        data=interpolator,
+        dt=dt,
+        coefficients=lambda params: {"D": params["D"]},
+        boundary_conditions=boundary_conditions,
+        initial=lambda params: interpolator.function(0),
+        observe=lambda u, params: u,
+    )
+
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument("patientid", help="Patient ID on the form PAT_###")
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Use adaptive time steps, landing exactly on the MRI acquisition times.",
+    )
+    parser.add_argument("--tol", type=float, default=1e-3)
+    parser.add_argument(
+        "--timeseries",
+        action="store_true",
+        help="Store the checkpoints as one compressed time x dof dataset.",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Store the time series in single precision.",
+    )
     args = parser.parse_args()
 
     datapath = f"data/{args.patientid}/FENICS/data.hdf"
-    timevec, data = read_concentration_data(datapath)
-    u0 = data[0].copy(deepcopy=True)
+    storage = FenicsStorage(datapath, "a")
+    interpolator = LazyInterpolator(storage, "data", prefetch=True)
+    timevec = interpolator.times
+    u0 = interpolator.function(0)
     u_interp = u0.copy(deepcopy=True)
-    interpolator = vectordata_interpolator(data, timevec)
 
     V = u0.function_space()
     domain = V.mesh()
@@ -57,21 +106,48 @@ if __name__ == "__main__":
 
     u = df.Function(V)
     u.assign(u0)
-    storage = FenicsStorage(datapath, "a")
     storage.write_function(u, "diffusion", overwrite=True)
+    checkpoints = storage
+    if args.timeseries:
+        checkpoints = TimeSeriesStorage(
+            timeseries_path(datapath), "a", dtype="float32" if args.float32 else "float64"
+        )
+        checkpoints.write_checkpoint(u, "diffusion", float(timevec[0]))
+
+    if args.adaptive:
+
+        def boundary_conditions(t):
+            assign_local(u_interp, interpolator(t))
+            return bcs
 
-    time.reset()
-    for ti in time:
-        print_progress(float(ti), time.endtime, rank=df.MPI.comm_world.rank)
-        u_interp.vector()[:] = interpolator(float(ti))
-        b = df.assemble(l)
-        for bc in bcs:
-            bc.apply(A, b)
-        df.solve(A, u.vector(), b, "gmres", "hypre_amg")
-        storage.write_checkpoint(u, "diffusion", float(ti))
-        u0.assign(u)
+        M = df.assemble(df.TrialFunction(V) * v * dx)
+        K = df.assemble(inner(D * grad(df.TrialFunction(V)), grad(v)) * dx)
+        stepper = AdaptiveStepper(
+            M, K, boundary_conditions, dt, stop_times=timevec[1:], tol=args.tol
+        )
+        ti = float(timevec[0])
+        while ti < T:
+            ti = stepper.step(u, ti)
+            print_progress(ti, T, rank=df.MPI.comm_world.rank)
+            checkpoints.write_checkpoint(u, "diffusion", ti)
+        if df.MPI.comm_world.rank == 0:
+            print(f"\n{stepper.solves} solves, {stepper.rejected} rejected steps.")
+    else:
+        time.reset()
+        for ti in time:
+            print_progress(float(ti), time.endtime, rank=df.MPI.comm_world.rank)
+            assign_local(u_interp, interpolator(float(ti)))
+            b = df.assemble(l)
+            for bc in bcs:
+                bc.apply(A, b)
+            df.solve(A, u.vector(), b, "gmres", "hypre_amg")
+            checkpoints.write_checkpoint(u, "diffusion", float(ti))
+            u0.assign(u)
+    if args.timeseries:
+        checkpoints.close()
     storage.close()
 
-    file = FenicsStorage(storage.filepath, "r")
-    file.to_xdmf("diffusion", "diffusion")
-    file.close()
+    if not args.timeseries:
+        file = FenicsStorage(storage.filepath, "r")
+        file.to_xdmf("diffusion", "diffusion")
+        file.close()
@@ -4,6 +4,7 @@ from pathlib import Path
 from typing import Any
 
 import dolfin as df
+import numpy as np
 import ufl
 from dolfin import grad, inner
 from pantarei.boundary import (
@@ -12,10 +13,17 @@ from pantarei.boundary import (
     process_dirichlet,
 )
 from pantarei.fenicsstorage import FenicsStorage, delete_dataset
-from pantarei.interpolator import vectordata_interpolator
 from pantarei.timekeeper import TimeKeeper
 from pantarei.utils import assign_mixed_function
 
+from parkrec.analysis.multicompartment_to_macro import MacroReduction
+from parkrec.models.data_interpolator import LazyInterpolator
+from parkrec.models.parallel import assign_local, mpi_rank, root_logging
+from parkrec.models.solvers import CompartmentSolver
+from parkrec.models.sweep import SweepProblem
+from parkrec.models.timeseries import TimeSeriesStorage, timeseries_path
+from parkrec.models.timestepping import AdaptiveStepper, stiffness_matrix
+
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -108,17 +116,121 @@ def get_default_coefficients() -> dict[str, Any]:
     }
 
 
-def main(compartments, coefficients, inputfile, outputfile=None):
+def flat_coefficients(coefficients: dict[str, Any]) -> dict[str, float]:
+    """Coefficients as a flat dict, with keys 'phi_<compartment>',
+    'D_<compartment>', 'alpha' and 'permeability'."""
+    return {
+        **{f"phi_{j}": phi_j for j, phi_j in coefficients["porosity"].items()},
+        **{f"D_{j}": D_j for j, D_j in coefficients["diffusion_coefficient"].items()},
+        "alpha": coefficients["alpha"],
+        "permeability": coefficients["permeability"],
+    }
+
+
+def multidiffusion_sweep_problem(inputfile, compartments, dt=3600) -> SweepProblem:
+    """Multicompartment problem with the flat coefficients as parameters. The
+    system matrix is M + dt * sum_j (D_j K_D_j + (alpha P / phi_j) K_exchange_j)."""
+    interpolator = LazyInterpolator(inputfile, "cdata")
+    el = read_function_element(inputfile, "cdata")
+    V_data = interpolator.function_space()
+    domain = V_data.mesh()
+    V = df.FunctionSpace(domain, df.MixedElement([el] * len(compartments)))
+
+    u_interp = {compartment: df.Function(V_data) for compartment in compartments}
+    boundary_data = {
+        idx: [DirichletBoundary(u_interp[compartment], "everywhere")]
+        for idx, compartment in enumerate(compartments)
+    }
+    bcs = process_dirichlet(V, domain, indexed_boundary_conditions(boundary_data))
+
+    dx = df.Measure("dx", domain=domain)
+    u = df.TrialFunction(V)
+    v = df.TestFunction(V)
+    K = {}
+    for idx_j, j in enumerate(compartments):
+        K[f"D_{j}"] = df.assemble(inner(grad(u[idx_j]), grad(v[idx_j])) * dx)
+        K[f"exchange_{j}"] = df.assemble(
+            -sum(u[idx_i] - u[idx_j] for idx_i in range(len(compartments)) if idx_i != idx_j)
+            * v[idx_j]
+            * dx
+        )
+
+    def coefficients(params):
+        return {
+            **{f"D_{j}": params[f"D_{j}"] for j in compartments},
+            **{
+                f"exchange_{j}": params["alpha"] * params["permeability"] / params[f"phi_{j}"]
+                for j in compartments
+            },
+        }
+
+    def boundary_conditions(t, params):
+        phi_tot = sum(params[f"phi_{j}"] for j in compartments)
+        boundary_values = (1.0 / phi_tot) * interpolator(t)
+        for uj in u_interp.values():
+            assign_local(uj, boundary_values)
+        return bcs
+
+    def initial(params):
+        boundary_conditions(interpolator.times[0], params)
+        return assign_mixed_function(u_interp, V, compartments)
+
+    assigners = [df.FunctionAssigner(V_data, V.sub(idx)) for idx in range(len(compartments))]
+    uj = df.Function(V_data)
+    total = df.Function(V_data)
+
+    def observe(u, params):
+        total.vector().zero()
+        for idx, j in enumerate(compartments):
+            assigners[idx].assign(uj, u.sub(idx))
+            total.vector().axpy(params[f"phi_{j}"], uj.vector())
+        return total
+
+    return SweepProblem(
+        M=df.assemble(inner(u, v) * dx),
+        K=K,
+        data=interpolator,
+        dt=dt,
+        coefficients=coefficients,
+        boundary_conditions=boundary_conditions,
+        initial=initial,
+        observe=observe,
+        solver_factory=lambda A: CompartmentSolver(A, V, compartments),
+    )
+
+
+def main(
+    compartments,
+    coefficients,
+    inputfile,
+    outputfile=None,
+    adaptive=False,
+    tol=1e-3,
+    timeseries=False,
+    dtype=np.float64,
+    total=False,
+):
+    """Runs the model, and writes the checkpoints to the FenicsStorage
+    `outputfile`, or with `timeseries`, to a TimeSeriesStorage next to it with
+    values of the given dtype. With `total`, the porosity-weighted sum over the
+    compartments is written alongside as 'multidiffusion_total'."""
     if outputfile is None:
         outputfile = Path(inputfile)
+    el = read_function_element(inputfile, "cdata")
+
+    # The data is read from the output storage if they are the same file, since
+    # the file can not be opened both for reading and writing.
     logger.info(f"Reading data from {inputfile}")
-    timevec, data = read_concentration_data(inputfile)
-    interpolator = vectordata_interpolator(data, timevec)
-    c0 = data[0].copy(deepcopy=True)
+    storage = FenicsStorage(outputfile, "a")
+    if Path(outputfile).resolve() == Path(inputfile).resolve():
+        interpolator = LazyInterpolator(storage, "cdata", prefetch=True)
+    else:
+        interpolator = LazyInterpolator(inputfile, "cdata", prefetch=True)
+    timevec = interpolator.times
+    c0 = interpolator.function(0)
 
     domain = c0.function_space().mesh()
-    el = read_function_element(inputfile, "cdata")
-    element = df.MixedElement([el] * 2)
+    element = df.MixedElement([el] * len(compartments))
     V = df.FunctionSpace(domain, element)
 
     dt = 3600
@@ -130,7 +242,7 @@ def main(compartments, coefficients, inputfile, outputfile=None):
     phi = coefficients["porosity"]
     phi_tot = sum(phi.values())
     for val in u_interp.values():
-        val.vector()[:] = (1.0 / phi_tot) * interpolator(0.0)
+        assign_local(val, (1.0 / phi_tot) * interpolator(0.0))
 
     boundary_data = {
         idx: [DirichletBoundary(u_interp[compartment], "everywhere")]
@@ -139,6 +251,12 @@ def main(compartments, coefficients, inputfile, outputfile=None):
     boundaries = indexed_boundary_conditions(boundary_data)
     bcs = process_dirichlet(V, domain, boundaries)
 
+    def boundary_conditions(t):
+        boundary_values = (1.0 / phi_tot) * interpolator(t)
+        for uj in u_interp.values():
+            assign_local(uj, boundary_values)
+        return bcs
+
     # Define variational problem
     u0 = assign_mixed_function(u_interp, V, compartments)
     F = multicomp_diffusion_form(V, coefficients, u0, compartments, dt)
@@ -148,47 +266,134 @@ def main(compartments, coefficients, inputfile, outputfile=None):
 
     u = df.Function(V)
     u.assign(u0)
-    storage = FenicsStorage(outputfile, "a")
     storage.write_function(u, "multidiffusion", overwrite=True)
+    checkpoints = storage
+    if timeseries:
+        checkpoints = TimeSeriesStorage(timeseries_path(outputfile), "a", dtype=dtype)
+    if total:
+        reduction = MacroReduction(V, [phi[j] for j in compartments])
+        c = df.Function(reduction.W)
+        storage.write_function(
+            reduction.function(u, c), "multidiffusion_total", overwrite=True
+        )
+
+    def write_checkpoint(t):
+        checkpoints.write_checkpoint(u, "multidiffusion", t)
+        if total:
+            c_total = reduction.function(u, c)
+            checkpoints.write_checkpoint(c_total, "multidiffusion_total", t)
+
+    if timeseries:
+        # The time series starts with the initial state, as the checkpoints of
+        # the FenicsStorage do.
+        write_checkpoint(float(timevec[0]))
 
     logger.info("Starting time loop...")
     tic = pytime.time()
-    time.reset()
-    for ti in time:
-        print_progress(float(ti), time.endtime, rank=df.MPI.comm_world.rank)
-        for j, uj in u_interp.items():
-            uj.vector()[:] = ((1.0 / phi_tot)) * interpolator(float(ti))
-        b = df.assemble(l)
+    if adaptive:
+        M = df.assemble(inner(df.TrialFunction(V), df.TestFunction(V)) * df.dx(domain))
+        K = stiffness_matrix(
+            df.lhs(multicomp_diffusion_form(V, coefficients, u0, compartments, 1.0)), M
+        )
+        stepper = AdaptiveStepper(
+            M,
+            K,
+            boundary_conditions,
+            dt,
+            stop_times=timevec[1:],
+            tol=tol,
+            solver_factory=lambda A: CompartmentSolver(A, V, compartments),
+        )
+        ti = float(timevec[0])
+        while ti < T:
+            ti = stepper.step(u, ti)
+            print_progress(ti, T, rank=mpi_rank())
+            write_checkpoint(ti)
+        logger.info(f"{stepper.solves} solves, {stepper.rejected} rejected steps.")
+    else:
+        # The Dirichlet rows of A are the same at every time step, so they are
+        # only applied once, and the preconditioner is reused in every step.
         for bc in bcs:
-            bc.apply(A, b)
-        df.solve(A, u.vector(), b, "gmres", "hypre_amg")
-        storage.write_checkpoint(u, "multidiffusion", float(ti))
-        u0.assign(u)
+            bc.apply(A)
+        solver = CompartmentSolver(A, V, compartments)
+        time.reset()
+        for ti in time:
+            print_progress(float(ti), time.endtime, rank=mpi_rank())
+            boundary_conditions(float(ti))
+            b = df.assemble(l)
+            for bc in bcs:
+                bc.apply(b)
+            solver.solve(u.vector(), b)
+            write_checkpoint(float(ti))
+            u0.assign(u)
+        logger.info(
+            f"Krylov iterations per step: mean {np.mean(solver.iterations):.1f},"
+            + f" max {max(solver.iterations)}."
+        )
+    interpolator.close()
+    if timeseries:
+        checkpoints.close()
     storage.close()
     logger.info("Time loop finished.")
     toc = pytime.time()
 
     df.MPI.comm_world.barrier()
-    if df.MPI.comm_world.rank == 0:
-        logger.info(f"Elapsed time in loop: {toc - tic:.2f} seconds.")
+    logger.info(f"Elapsed time in loop: {toc - tic:.2f} seconds.")
     return storage.filepath
 
 
 if __name__ == "__main__":
     import argparse
 
+    root_logging()
+
     parser = argparse.ArgumentParser()
     parser.add_argument("patientid", help="Patient ID on the form PAT_###")
     parser.add_argument("resolution", help="SVMTK mesh resolution.", type=int)
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Use adaptive time steps, landing exactly on the MRI acquisition times.",
+    )
+    parser.add_argument("--tol", type=float, default=1e-3)
+    parser.add_argument(
+        "--timeseries",
+        action="store_true",
+        help="Store the checkpoints as one compressed time x dof dataset.",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Store the time series in single precision.",
+    )
+    parser.add_argument(
+        "--total",
+        action="store_true",
+        help="Also write the porosity-weighted total concentration.",
+    )
     args = parser.parse_args()
     data_file = f"DATA/{args.patientid}/FENICS/cdata_{args.resolution}.hdf"
 
     compartments = ["ecs", "pvs"]
     coefficients = get_default_coefficients()
 
-    results_path = main(compartments, coefficients, data_file)
+    results_path = main(
+        compartments,
+        coefficients,
+        data_file,
+        adaptive=args.adaptive,
+        tol=args.tol,
+        timeseries=args.timeseries,
+        dtype=np.float32 if args.float32 else np.float64,
+        total=args.total,
+    )
 
-    logger.info("Writing XDMF files for each compartment.")
-    file = FenicsStorage(results_path, "r")
-    file.to_xdmf("multidiffusion", compartments)
-    file.close()
+    if args.timeseries:
+        logger.info(f"Checkpoints stored in {timeseries_path(results_path)}")
+    else:
+        logger.info("Writing XDMF files for each compartment.")
+        file = FenicsStorage(results_path, "r")
+        file.to_xdmf("multidiffusion", compartments)
+        if args.total:
+            file.to_xdmf("multidiffusion_total", "total")
+        file.close()
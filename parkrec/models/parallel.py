@@ -0,0 +1,49 @@
+"""Utilities for running the models with mpirun, e.g.
+
+    mpirun -n 16 python parkrec/models/multidiffusion_model.py PAT_002 32
+
+Each process owns a partition of the mesh and of the degrees of freedom, and
+all array operations on function vectors act on the locally owned entries only.
+Reading and writing of FenicsStorage-files is collective (parallel HDF5)."""
+import logging
+
+import dolfin as df
+import numpy as np
+
+
+def mpi_rank() -> int:
+    return df.MPI.comm_world.rank
+
+
+def is_root() -> bool:
+    return mpi_rank() == 0
+
+
+class RootFilter(logging.Filter):
+    def filter(self, record):
+        return is_root()
+
+
+def root_logging():
+    """Drops log records on all processes but rank 0."""
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RootFilter())
+
+
+def assign_local(function: df.Function, values: np.ndarray):
+    function.vector().set_local(values)
+    function.vector().apply("insert")
+
+
+def owned_marked_dofs(V: df.FunctionSpace, local_dofs) -> np.ndarray:
+    """Local indices of the owned dofs which are marked on any process. Each
+    process only finds the dofs of its own cells, e.g. the dofs of its local
+    boundary facets in DirichletBC.get_boundary_values(), which misses owned
+    dofs where the boundary facet belongs to a cell of another process. The
+    marked dofs are therefore exchanged in the global numbering."""
+    local_to_global = V.dofmap().tabulate_local_to_global_dofs()
+    local_dofs = np.asarray(local_dofs, dtype=np.int64)
+    marked = np.concatenate(V.mesh().mpi_comm().allgather(local_to_global[local_dofs]))
+    first, last = V.dofmap().ownership_range()
+    owned = marked[(marked >= first) & (marked < last)]
+    return np.unique(owned - first).astype(np.intc)
@@ -0,0 +1,296 @@
+"""Reduced-order (POD-Galerkin) models for the parameter sweep problems.
+
+Offline, the state is decomposed as u(t) = g(t) + u_0(t), where the lifting
+g(t) = sum_k w_k(t) G_k interpolates the boundary data linearly in time between
+the measurement times (G_k is zero in the interior and equal to the boundary
+data of measurement k on the boundary), and u_0 vanishes on the Dirichlet
+boundary. A POD basis for u_0 is computed from snapshots of full solves with a
+set of training parameters, using the method of snapshots in the inner product
+of the mass matrix.
+
+Online, each implicit Euler step solves an r x r system, where r is the size
+of the basis, such that the cost per step is independent of the mesh size. The
+full state is only reconstructed at the measurement times, where the relative
+residual of the full system serves as an error indicator, and the full model is
+used instead if the indicator exceeds the tolerance."""
+import logging
+from pathlib import Path
+from typing import Callable, Optional
+
+import dolfin as df
+import numpy as np
+import scipy.linalg
+
+from parkrec.models.sweep import SweepProblem
+
+logger = logging.getLogger(__name__)
+
+
+def hat_weights(times: np.ndarray, t: float) -> np.ndarray:
+    """Weights of the linear interpolation in time between the measurements."""
+    weights = np.zeros(times.size)
+    i = int(np.clip(np.searchsorted(times, t, side="right") - 1, 0, times.size - 2))
+    s = min(max((t - times[i]) / (times[i + 1] - times[i]), 0.0), 1.0)
+    weights[i] = 1.0 - s
+    weights[i + 1] = s
+    return weights
+
+
+def lifting_vectors(problem: SweepProblem, params: dict[str, float]) -> list[df.GenericVector]:
+    """G_k, the boundary data at measurement k on the boundary, zero elsewhere."""
+    lifts = []
+    for t in problem.data.times:
+        G = df.Vector()
+        problem.M.init_vector(G, 0)
+        for bc in problem.boundary_conditions(t, params):
+            bc.apply(G)
+        lifts.append(G)
+    return lifts
+
+
+def combine(vectors: list[df.GenericVector], weights, out: df.GenericVector) -> df.GenericVector:
+    out.zero()
+    for vector, weight in zip(vectors, weights):
+        if weight != 0.0:
+            out.axpy(weight, vector)
+    return out
+
+
+def pod_basis(
+    M: df.Matrix,
+    snapshots: list[df.GenericVector],
+    energy: float = 1 - 1e-8,
+    max_rank: Optional[int] = None,
+) -> tuple[list[df.GenericVector], np.ndarray]:
+    """M-orthonormal POD basis of the snapshots, by the method of snapshots.
+    The basis is truncated to capture the given fraction of the snapshot energy.
+    Returns the basis and the eigenvalues of the correlation matrix, and raises
+    a ValueError if the snapshots are all zero."""
+    Ms = [M * s for s in snapshots]
+    n = len(snapshots)
+    correlation = np.array([[snapshots[i].inner(Ms[j]) for j in range(n)] for i in range(n)])
+    eigenvalues, eigenvectors = scipy.linalg.eigh(correlation)
+    eigenvalues, eigenvectors = eigenvalues[::-1], eigenvectors[:, ::-1]
+    eigenvalues = np.maximum(eigenvalues, 0.0)
+    if eigenvalues[0] <= 0.0:
+        raise ValueError(
+            "The snapshots have zero energy, e.g. from zero initial and boundary"
+            + " data, so there is no POD basis."
+        )
+    captured = np.cumsum(eigenvalues) / eigenvalues.sum()
+    rank = int(np.searchsorted(captured, energy) + 1)
+    rank = min(rank, n, max_rank or n, int(np.sum(eigenvalues > 1e-14 * eigenvalues[0])))
+
+    basis = []
+    for j in range(rank):
+        phi = combine(snapshots, eigenvectors[:, j] / np.sqrt(eigenvalues[j]), snapshots[0].copy())
+        basis.append(phi)
+    return basis, eigenvalues
+
+
+class ReducedModel:
+    """POD-Galerkin reduced model of a SweepProblem, with a fallback to the full
+    problem where the error indicator exceeds `indicator_tol`."""
+
+    def __init__(
+        self,
+        problem: SweepProblem,
+        basis: list[df.GenericVector],
+        indicator_tol: float = 1e-2,
+    ):
+        self.problem = problem
+        self.basis = basis
+        self.indicator_tol = indicator_tol
+        self.Mr = self.project(problem.M)
+        self.Kr = {name: self.project(K) for name, K in problem.K.items()}
+        self.fallbacks = 0
+        self.interior = None
+
+    @classmethod
+    def train(
+        cls,
+        problem: SweepProblem,
+        training_params: list[dict[str, float]],
+        energy: float = 1 - 1e-8,
+        max_rank: Optional[int] = None,
+        snapshot_stride: int = 1,
+        indicator_tol: float = 1e-2,
+    ) -> "ReducedModel":
+        """Builds the basis from the homogeneous part u - g(t) of full solves
+        with each of the training parameters, using every `snapshot_stride`-th
+        time step."""
+        snapshots = []
+        for params in training_params:
+            lifts = lifting_vectors(problem, params)
+            for step, t, u in problem.forward(params):
+                if step % snapshot_stride != 0:
+                    continue
+                g = combine(lifts, hat_weights(problem.data.times, t), lifts[0].copy())
+                snapshot = u.vector().copy()
+                snapshot.axpy(-1.0, g)
+                snapshots.append(snapshot)
+        basis, _ = pod_basis(problem.M, snapshots, energy, max_rank)
+        logger.info(f"POD basis of size {len(basis)} from {len(snapshots)} snapshots.")
+        return cls(problem, basis, indicator_tol)
+
+    def save(self, path) -> Path:
+        """Stores the basis, such that the sweep workers can load it instead of
+        training (in serial)."""
+        np.savez(
+            path,
+            basis=np.array([phi.get_local() for phi in self.basis]),
+            indicator_tol=self.indicator_tol,
+        )
+        return Path(path)
+
+    @classmethod
+    def load(cls, problem: SweepProblem, path) -> "ReducedModel":
+        basis = []
+        with np.load(path) as f:
+            for values in f["basis"]:
+                phi = df.Vector()
+                problem.M.init_vector(phi, 0)
+                phi.set_local(values)
+                phi.apply("insert")
+                basis.append(phi)
+            return cls(problem, basis, float(f["indicator_tol"]))
+
+    def project(self, A: df.Matrix) -> np.ndarray:
+        """Phi^T A Phi"""
+        return self.project_vectors(A, self.basis)
+
+    def project_vectors(self, A: df.Matrix, vectors: list[df.GenericVector]) -> np.ndarray:
+        """Phi^T A [v_1, ..., v_n]"""
+        Av = [A * v for v in vectors]
+        return np.array([[phi.inner(w) for w in Av] for phi in self.basis])
+
+    def reconstruct(self, coefficients: np.ndarray, g: df.GenericVector, out: df.GenericVector):
+        out.zero()
+        out.axpy(1.0, g)
+        for phi, a in zip(self.basis, coefficients):
+            out.axpy(a, phi)
+        return out
+
+    def interior_indicator(self, params: dict[str, float]) -> np.ndarray:
+        """Local array which is zero at the dofs with Dirichlet conditions, and
+        one elsewhere."""
+        if self.interior is None:
+            interior = np.ones(self.basis[0].local_size())
+            for bc in self.problem.boundary_conditions(self.problem.data.times[0], params):
+                dofs = np.fromiter(bc.get_boundary_values().keys(), dtype=np.intc)
+                interior[dofs[dofs < interior.size]] = 0.0
+            self.interior = interior
+        return self.interior
+
+    def relative_residual(
+        self,
+        A: df.Matrix,
+        u: df.GenericVector,
+        u_prev: df.GenericVector,
+        params: dict[str, float],
+    ) -> float:
+        """||A u - M u_prev|| / ||M u_prev|| over the dofs without Dirichlet
+        conditions."""
+        interior = self.interior_indicator(params)
+        Mu_prev = (self.problem.M * u_prev).get_local() * interior
+        residual = (A * u).get_local() * interior - Mu_prev
+        comm = df.MPI.comm_world
+        return np.sqrt(
+            df.MPI.sum(comm, float(residual @ residual))
+            / max(df.MPI.sum(comm, float(Mu_prev @ Mu_prev)), 1e-300)
+        )
+
+    def forward(self, params: dict[str, float]):
+        """Yields the step number, time and the reduced coefficients after each
+        time step, and a function `state(out)` reconstructing the full state."""
+        problem = self.problem
+        times = problem.data.times
+        dt = problem.dt
+        coefficients = problem.coefficients(params)
+        Ar = self.Mr + dt * sum(theta * self.Kr[name] for name, theta in coefficients.items())
+        factorization = scipy.linalg.lu_factor(Ar)
+
+        lifts = lifting_vectors(problem, params)
+        lift_M = self.project_vectors(problem.M, lifts)
+        lift_A = lift_M + dt * sum(
+            theta * self.project_vectors(problem.K[name], lifts)
+            for name, theta in coefficients.items()
+        )
+        g = lifts[0].copy()
+
+        u0 = problem.initial(params).vector().copy()
+        u0.axpy(-1.0, combine(lifts, hat_weights(times, times[0]), g))
+        a = np.array([phi.inner(problem.M * u0) for phi in self.basis])
+        w = hat_weights(times, times[0])
+
+        def state(coefficients, t, out):
+            return self.reconstruct(coefficients, combine(lifts, hat_weights(times, t), g), out)
+
+        yield 0, times[0], a, state
+        for step in range(1, problem.observation_steps()[-1] + 1):
+            t = times[0] + step * dt
+            w_next = hat_weights(times, t)
+            rhs = self.Mr @ a + lift_M @ w - lift_A @ w_next
+            a = scipy.linalg.lu_solve(factorization, rhs)
+            w = w_next
+            yield step, t, a, state
+
+    def misfit(self, params: dict[str, float]) -> float:
+        """Misfit as in SweepProblem.misfit, computed with the reduced model, or
+        with the full model if the error indicator at any of the measurement
+        times exceeds the tolerance."""
+        problem = self.problem
+        observation_steps = problem.observation_steps()
+        A = problem.system_matrix(params)
+        u = problem.initial(params)
+        u_prev = u.vector().copy()
+        a_prev = None
+        error, norm = 0.0, 0.0
+        for step, t, a, state in self.forward(params):
+            indices = np.flatnonzero(observation_steps[1:] == step) + 1
+            if indices.size > 0 and step > 0:
+                # The state at step 0 is the projected initial state, which has
+                # no time step to check.
+                state(a_prev, t - problem.dt, u_prev)
+                state(a, t, u.vector())
+                indicator = self.relative_residual(A, u.vector(), u_prev, params)
+                if indicator > self.indicator_tol:
+                    logger.warning(
+                        f"Error indicator {indicator:.2e} at t={t:.0f} s exceeds the"
+                        + f" tolerance for {params}, using the full model."
+                    )
+                    self.fallbacks += 1
+                    return problem.misfit(params)
+            for idx in indices:
+                error_idx, norm_idx = problem.observation_error(u, params, idx)
+                error += error_idx
+                norm += norm_idx
+            a_prev = a
+        return error / norm
+
+    def write(
+        self,
+        params: dict[str, float],
+        storage,
+        funcname: str,
+        stride: int = 1,
+    ):
+        """Writes the reconstructed state every `stride` steps as checkpoints of
+        `funcname` in the FenicsStorage, as the full models do."""
+        u = self.problem.initial(params)
+        for step, t, a, state in self.forward(params):
+            if step == 0:
+                storage.write_function(u, funcname, overwrite=True)
+            elif step % stride == 0:
+                state(a, t, u.vector())
+                storage.write_checkpoint(u, funcname, float(t))
+
+
+def reduced_problem(
+    builder: Callable[..., SweepProblem], builder_kwargs: dict, basisfile
+) -> ReducedModel:
+    """Builds the problem with `builder(**builder_kwargs)`, and the reduced model
+    with the basis stored in `basisfile` by ReducedModel.save, for use with
+    run_sweep. The basis is trained once, before the sweep, and each worker
+    only projects the matrices onto it."""
+    return ReducedModel.load(builder(**builder_kwargs), basisfile)
@@ -0,0 +1,95 @@
+import logging
+
+import dolfin as df
+import numpy as np
+from petsc4py import PETSc
+
+logger = logging.getLogger(__name__)
+
+SOLVER_STRATEGIES = ("auto", "lu", "gmres_amg")
+
+# Use a direct solver for meshes with fewer degrees of freedom than this.
+LU_MAX_DOFS = 200_000
+
+
+def create_solver(A, strategy="auto"):
+    """Creates a solver for the constant system matrix A, such that the LU
+    factorization or the AMG hierarchy is only computed once and reused in
+    every time step."""
+    if strategy == "auto":
+        strategy = "lu" if A.size(0) < LU_MAX_DOFS else "gmres_amg"
+    if strategy == "lu":
+        solver = df.LUSolver(A)
+    elif strategy == "gmres_amg":
+        solver = df.PETScKrylovSolver("gmres", "amg")
+        solver.set_operator(A)
+        solver.set_reuse_preconditioner(True)
+        solver.parameters["nonzero_initial_guess"] = True
+    else:
+        raise ValueError(f"Unknown solver strategy '{strategy}', use one of {SOLVER_STRATEGIES}")
+    return solver
+
+
+FIELDSPLIT_TYPES = {
+    "additive": PETSc.PC.CompositeType.ADDITIVE,
+    "multiplicative": PETSc.PC.CompositeType.MULTIPLICATIVE,
+}
+
+
+class CompartmentSolver:
+    """Krylov solver for the coupled system of an N-compartment exchange
+    problem on a mixed space V = V_1 x ... x V_N. The preconditioner is a
+    field split over the compartments, applying one AMG V-cycle to each
+    diagonal block, such that the cost scales with the number of compartments
+    times the cost of a scalar diffusion problem. The KSP and the
+    preconditioner are set up once for the constant system matrix A, and the
+    iteration counts of each solve are stored in `iterations`."""
+
+    def __init__(
+        self,
+        A: df.Matrix,
+        V: df.FunctionSpace,
+        compartments: list[str],
+        fieldsplit_type: str = "multiplicative",
+        ksp_type: str = "gmres",
+        rtol: float = 1e-8,
+    ):
+        comm = V.mesh().mpi_comm()
+        self.ksp = PETSc.KSP().create(comm)
+        self.ksp.setOperators(df.as_backend_type(A).mat())
+        self.ksp.setType(ksp_type)
+        self.ksp.setTolerances(rtol=rtol)
+        self.ksp.setInitialGuessNonzero(True)
+
+        pc = self.ksp.getPC()
+        pc.setType(PETSc.PC.Type.FIELDSPLIT)
+        pc.setFieldSplitType(FIELDSPLIT_TYPES[fieldsplit_type])
+        pc.setFieldSplitIS(
+            *[
+                (name, PETSc.IS().createGeneral(compartment_dofs(V, j), comm=comm))
+                for j, name in enumerate(compartments)
+            ]
+        )
+        self.ksp.setUp()
+        for subksp in pc.getFieldSplitSubKSP():
+            subksp.setType(PETSc.KSP.Type.PREONLY)
+            subpc = subksp.getPC()
+            subpc.setType(PETSc.PC.Type.HYPRE)
+            subpc.setHYPREType("boomeramg")
+        self.iterations = []
+
+    def solve(self, x: df.GenericVector, b: df.GenericVector) -> int:
+        self.ksp.solve(df.as_backend_type(b).vec(), df.as_backend_type(x).vec())
+        df.as_backend_type(x).update_ghost_values()
+        if self.ksp.getConvergedReason() < 0:
+            raise RuntimeError(
+                f"Compartment solver diverged with reason {self.ksp.getConvergedReason()}"
+            )
+        self.iterations.append(self.ksp.getIterationNumber())
+        logger.debug(f"Compartment solver converged in {self.iterations[-1]} iterations.")
+        return self.iterations[-1]
+
+
+def compartment_dofs(V: df.FunctionSpace, idx: int) -> np.ndarray:
+    """Global indices of the locally owned dofs of compartment idx."""
+    return np.asarray(V.sub(idx).dofmap().dofs(), dtype=PETSc.IntType)
@@ -0,0 +1,225 @@
+"""Parameter sweeps for the diffusion models. The mass matrix and one matrix
+K_i for each parameter are assembled once per worker process, and the system
+matrix of each parameter set is formed as A(theta) = M + dt sum_i theta_i K_i.
+Each worker runs the forward model for its share of the parameter sets, and
+the misfit to the data of each set is collected into one table."""
+import itertools
+import logging
+import time as pytime
+from dataclasses import dataclass
+from multiprocessing import get_context
+from multiprocessing.pool import Pool
+from typing import Any, Callable, Optional
+
+import dolfin as df
+import numpy as np
+import pandas as pd
+
+from parkrec.models.data_interpolator import LazyInterpolator
+from parkrec.models.solvers import create_solver
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SweepProblem:
+    """Linear diffusion problem with parameter-affine system matrix.
+
+    - `coefficients(params)` maps a parameter set to the coefficient of each
+      matrix in K.
+    - `boundary_conditions(t, params)` updates the boundary data to time t, and
+      returns the boundary conditions.
+    - `initial(params)` returns the initial state.
+    - `observe(u, params)` maps the state to a function in the data space.
+    """
+
+    M: df.Matrix
+    K: dict[str, df.Matrix]
+    data: LazyInterpolator
+    dt: float
+    coefficients: Callable[[dict[str, float]], dict[str, float]]
+    boundary_conditions: Callable[[float, dict[str, float]], list[df.DirichletBC]]
+    initial: Callable[[dict[str, float]], df.Function]
+    observe: Callable[[df.Function, dict[str, float]], df.Function]
+    solver_factory: Optional[Callable[[df.Matrix], Any]] = None
+
+    def __post_init__(self):
+        V_data = self.data.function_space()
+        u, v = df.TrialFunction(V_data), df.TestFunction(V_data)
+        self.data_mass = df.assemble(u * v * df.dx(V_data.mesh()))
+        self.observations = [self.data.function(idx) for idx in range(self.data.times.size)]
+        if self.solver_factory is None:
+            self.solver_factory = create_solver
+
+    def system_matrix(self, params: dict[str, float]) -> df.Matrix:
+        A = self.M.copy()
+        for name, coefficient in self.coefficients(params).items():
+            A.axpy(self.dt * coefficient, self.K[name], False)
+        return A
+
+    def squared_norm(self, vector: df.GenericVector) -> float:
+        return vector.inner(self.data_mass * vector)
+
+    def observation_steps(self) -> np.ndarray:
+        """Index of the time step closest to each measurement time."""
+        times = self.data.times
+        return np.round((times - times[0]) / self.dt).astype(int)
+
+    def forward(self, params: dict[str, float]):
+        """Yields the step number, time and state after each time step, starting
+        with the initial state. The same state function is updated in-place."""
+        times = self.data.times
+        u = self.initial(params)
+        yield 0, times[0], u
+
+        bcs = self.boundary_conditions(times[0], params)
+        A = self.system_matrix(params)
+        for bc in bcs:
+            bc.apply(A)
+        solver = self.solver_factory(A)
+        b = df.Vector()
+        self.M.init_vector(b, 0)
+        for step in range(1, self.observation_steps()[-1] + 1):
+            t = times[0] + step * self.dt
+            bcs = self.boundary_conditions(t, params)
+            self.M.mult(u.vector(), b)
+            for bc in bcs:
+                bc.apply(b)
+            solver.solve(u.vector(), b)
+            yield step, t, u
+
+    def observation_error(self, u: df.Function, params: dict[str, float], idx: int):
+        """Squared norms of the difference between the observed state and the
+        data at measurement idx, and of the data."""
+        difference = self.observe(u, params).vector().copy()
+        difference.axpy(-1.0, self.observations[idx].vector())
+        return (
+            self.squared_norm(difference),
+            self.squared_norm(self.observations[idx].vector()),
+        )
+
+    def misfit(self, params: dict[str, float]) -> float:
+        """Sum over the measurement times of ||c - c_data||^2, relative to the
+        sum of ||c_data||^2. The state is compared to the data at the time step
+        closest to each measurement time."""
+        observation_steps = self.observation_steps()
+        error, norm = 0.0, 0.0
+        for step, _, u in self.forward(params):
+            for idx in np.flatnonzero(observation_steps[1:] == step) + 1:
+                error_idx, norm_idx = self.observation_error(u, params, idx)
+                error += error_idx
+                norm += norm_idx
+        return error / norm
+
+
+def parameter_grid(grid: dict[str, list[float]], base: Optional[dict] = None) -> list[dict]:
+    """All combinations of the values in the grid, with the remaining
+    parameters from `base`."""
+    base = {} if base is None else base
+    names = list(grid)
+    return [
+        {**base, **dict(zip(names, values))}
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+_PROBLEM: Optional[SweepProblem] = None
+
+
+def _init_worker(builder: Callable[..., SweepProblem], kwargs: dict):
+    global _PROBLEM
+    _PROBLEM = builder(**kwargs)
+
+
+def _run(params: dict[str, float]) -> dict[str, Any]:
+    tic = pytime.time()
+    misfit = _PROBLEM.misfit(params)
+    return {**params, "misfit": misfit, "walltime": pytime.time() - tic}
+
+
+def run_sweep(
+    builder: Callable[..., SweepProblem],
+    builder_kwargs: dict,
+    parameter_sets: list[dict[str, float]],
+    n_jobs: Optional[int] = None,
+) -> pd.DataFrame:
+    """Computes the misfit of each parameter set in a pool of `n_jobs` processes,
+    where each process builds the problem once with `builder(**builder_kwargs)`.
+    The builder must be importable from the worker processes."""
+    logger.info(f"Running {len(parameter_sets)} parameter sets.")
+    context = get_context("spawn")
+    with Pool(
+        n_jobs, initializer=_init_worker, initargs=(builder, builder_kwargs), context=context
+    ) as pool:
+        records = pool.map(_run, parameter_sets, chunksize=1)
+    return pd.DataFrame.from_records(records).sort_values("misfit", ignore_index=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from parkrec.models.diffusion_model import diffusion_sweep_problem
+    from parkrec.models.multidiffusion_model import (
+        flat_coefficients,
+        get_default_coefficients,
+        multidiffusion_sweep_problem,
+    )
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", choices=("diffusion", "multidiffusion"))
+    parser.add_argument("inputfile", type=str)
+    parser.add_argument(
+        "--grid",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Parameter values on the form name=value1,value2,... e.g. alpha=1,5,10",
+    )
+    parser.add_argument("--dt", type=float, default=3600)
+    parser.add_argument("--n_jobs", type=int, default=None)
+    parser.add_argument("--output", type=str, default="sweep.csv")
+    parser.add_argument(
+        "--reduced",
+        type=int,
+        default=None,
+        help="Use a reduced-order model trained on this number of evenly spaced parameter sets from the grid.",
+    )
+    args = parser.parse_args()
+
+    grid = {
+        name: [float(value) for value in values.split(",")]
+        for name, values in (item.split("=") for item in args.grid)
+    }
+    if args.model == "diffusion":
+        builder, base = diffusion_sweep_problem, {"D": 1.65e-4}
+        builder_kwargs = {"inputfile": args.inputfile, "dt": args.dt}
+    else:
+        builder, base = multidiffusion_sweep_problem, flat_coefficients(get_default_coefficients())
+        builder_kwargs = {
+            "inputfile": args.inputfile,
+            "compartments": ["ecs", "pvs"],
+            "dt": args.dt,
+        }
+    parameter_sets = parameter_grid(grid, base)
+    if args.reduced is not None:
+        from pathlib import Path
+
+        from parkrec.models.reduced import ReducedModel, reduced_problem
+
+        # The basis is trained once here, and loaded by the workers.
+        training = np.unique(np.linspace(0, len(parameter_sets) - 1, args.reduced).round())
+        model = ReducedModel.train(
+            builder(**builder_kwargs),
+            [parameter_sets[int(idx)] for idx in training],
+        )
+        basisfile = model.save(Path(args.output).with_suffix(".basis.npz"))
+        builder_kwargs = {
+            "builder": builder,
+            "builder_kwargs": builder_kwargs,
+            "basisfile": basisfile,
+        }
+        builder = reduced_problem
+    table = run_sweep(builder, builder_kwargs, parameter_sets, args.n_jobs)
+    logger.info(f"Saving results to {args.output}")
+    table.to_csv(args.output, index=False)
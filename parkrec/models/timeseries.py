@@ -0,0 +1,180 @@
+"""Time-series layout for the checkpoints of the models. All checkpoints of a
+function are stored as one 2D dataset (time x dof) in an HDF5-file next to the
+FenicsStorage file, with the time vector alongside:
+
+    /<name>/values   (num_times, num_dofs), chunked and compressed
+    /<name>/times    (num_times,)
+
+The chunks span `chunk_times` consecutive times and a block of dofs of about
+`chunk_bytes`, such that reading all dofs at one time, and all times at a few
+dofs, both read a limited number of chunks. The checkpoints are buffered and
+written one block of `chunk_times` rows at a time, such that each compressed
+chunk is written only once. The function space is not stored; the initial
+state is also written with FenicsStorage.write_function as before, and is the
+first row of the time series, such that index k refers to the same time in
+both layouts. The values are in the global dof numbering of the function
+space of the run, so reading into functions requires the same number of
+processes as the run."""
+import logging
+from pathlib import Path
+from typing import Optional
+
+import dolfin as df
+import h5py
+import numpy as np
+
+from parkrec.models.parallel import assign_local, is_root
+
+logger = logging.getLogger(__name__)
+
+
+def timeseries_path(filepath) -> Path:
+    """The time-series file next to a FenicsStorage file."""
+    return Path(filepath).with_suffix(".timeseries.hdf")
+
+
+def chunk_shape(num_dofs: int, itemsize: int, chunk_times: int, chunk_bytes: int):
+    chunk_dofs = int(np.clip(chunk_bytes // (chunk_times * itemsize), 1, num_dofs))
+    return (chunk_times, chunk_dofs)
+
+
+def nearest_dofs(V: df.FunctionSpace, points: np.ndarray) -> np.ndarray:
+    """Dofs with coordinates closest to the points, e.g. for reading the time
+    series in probe points with TimeSeriesStorage.read_dofs (in serial)."""
+    from scipy.spatial import cKDTree
+
+    _, dofs = cKDTree(V.tabulate_dof_coordinates()).query(np.atleast_2d(points))
+    return dofs
+
+
+class TimeSeriesStorage:
+    """Reads and writes checkpoints in the time-series layout, with the same
+    checkpoint methods as FenicsStorage, and NumPy-readers of the values.
+    Writing is done by rank 0, after gathering the owned values of each
+    process, while each process reads its owned values.
+
+    `dtype=np.float32` halves the size of the file. `compression` is passed to
+    h5py, e.g. "gzip" or "lzf", with the shuffle filter, which improves the
+    compression of floating point data."""
+
+    def __init__(
+        self,
+        filepath,
+        mode: str = "r",
+        dtype=np.float64,
+        compression: Optional[str] = "gzip",
+        chunk_times: int = 16,
+        chunk_bytes: int = 2**20,
+        cache_bytes: int = 2**28,
+    ):
+        self.filepath = Path(filepath)
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.chunk_times = chunk_times
+        self.chunk_bytes = chunk_bytes
+        self.comm = df.MPI.comm_world
+        self.buffers = {}
+        self.file = None
+        if mode == "r" or is_root():
+            # The chunk cache should hold one row of chunks, such that reading
+            # the times in order decompresses each chunk only once.
+            self.file = h5py.File(
+                self.filepath, mode, rdcc_nbytes=cache_bytes, rdcc_nslots=10007
+            )
+
+    def _gather(self, function: df.Function) -> Optional[np.ndarray]:
+        local = function.vector().get_local()
+        if self.comm.size == 1:
+            return local
+        chunks = self.comm.gather(local, root=0)
+        return np.concatenate(chunks) if is_root() else None
+
+    def _create(self, name: str, num_dofs: int):
+        if name in self.file:
+            del self.file[name]
+        group = self.file.create_group(name)
+        chunks = chunk_shape(
+            num_dofs, self.dtype.itemsize, self.chunk_times, self.chunk_bytes
+        )
+        group.create_dataset(
+            "values",
+            shape=(0, num_dofs),
+            maxshape=(None, num_dofs),
+            dtype=self.dtype,
+            chunks=chunks,
+            compression=self.compression,
+            shuffle=self.compression is not None,
+        )
+        group.create_dataset("times", shape=(0,), maxshape=(None,), dtype=np.float64)
+        self.buffers[name] = ([], [])
+
+    def write_checkpoint(self, function: df.Function, name: str, t: float):
+        self.write_values(self._gather(function), name, t)
+
+    def write_values(self, values: Optional[np.ndarray], name: str, t: float):
+        """Appends the values of all dofs at time t (only used on rank 0)."""
+        if not is_root():
+            return
+        if name not in self.buffers:
+            self._create(name, values.size)
+        times, rows = self.buffers[name]
+        times.append(t)
+        rows.append(values.astype(self.dtype))
+        if len(rows) == self.chunk_times:
+            self.flush(name)
+
+    def flush(self, name: Optional[str] = None):
+        if not is_root():
+            return
+        for key in [name] if name is not None else list(self.buffers):
+            times, rows = self.buffers[key]
+            if not rows:
+                continue
+            values, timevec = self.file[key]["values"], self.file[key]["times"]
+            n = timevec.shape[0]
+            values.resize(n + len(rows), axis=0)
+            values[n:] = np.stack(rows)
+            timevec.resize(n + len(times), axis=0)
+            timevec[n:] = times
+            times.clear()
+            rows.clear()
+        self.file.flush()
+
+    def read_timevector(self, name: str) -> np.ndarray:
+        return self.file[name]["times"][:]
+
+    def values(self, name: str) -> h5py.Dataset:
+        """The (num_times, num_dofs) dataset, which is read by NumPy-indexing."""
+        return self.file[name]["values"]
+
+    def read_values(
+        self, name: str, idx: int, out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Values of all dofs at time index idx, optionally read into `out`."""
+        values = self.values(name)
+        if out is None:
+            out = np.empty(values.shape[1], dtype=values.dtype)
+        values.read_direct(out, np.s_[idx, :])
+        return out
+
+    def read_dofs(self, name: str, dofs) -> np.ndarray:
+        """Values of the given dofs at all times, as a (num_times, len(dofs))
+        array."""
+        dofs = np.asarray(dofs)
+        unique, inverse = np.unique(dofs, return_inverse=True)
+        return self.values(name)[:, unique][:, inverse]
+
+    def read_checkpoint(
+        self, function: df.Function, name: str, idx: int
+    ) -> df.Function:
+        first, last = function.vector().local_range()
+        assign_local(function, self.values(name)[idx, first:last])
+        return function
+
+    def close(self):
+        if self.file is not None:
+            if self.mode != "r":
+                self.flush()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,163 @@
+"""Adaptive implicit Euler time stepping for linear problems on the form
+
+    M du/dt + K u = 0,    u = g(t) on the Dirichlet boundary,
+
+where each step solves (M + dt K) u_new = M u_old. The local error is
+estimated by comparing the step to the linear extrapolation of the two
+previous states, or by step doubling (one step of size dt against two steps of
+size dt/2) when there are no previous states. The step size is halved if the
+estimated relative error exceeds the tolerance, and doubled when it is well
+below, such that the step sizes stay on a few levels and the solvers (LU
+factorizations or AMG hierarchies) of recently used step sizes can be reused.
+Steps are shortened to land exactly on the stop times, e.g. the MRI
+acquisition times."""
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+import dolfin as df
+import numpy as np
+
+from parkrec.models.solvers import create_solver
+
+logger = logging.getLogger(__name__)
+
+
+def stiffness_matrix(a1: df.Form, M: df.Matrix) -> df.Matrix:
+    """Extracts K = A(1) - M from the bilinear form of a unit time step."""
+    K = df.assemble(a1)
+    K.axpy(-1.0, M, False)
+    return K
+
+
+class AdaptiveStepper:
+    def __init__(
+        self,
+        M: df.Matrix,
+        K: df.Matrix,
+        boundary_conditions: Callable[[float], list[df.DirichletBC]],
+        dt: float,
+        stop_times=(),
+        tol: float = 1e-3,
+        dt_min: Optional[float] = None,
+        dt_max: Optional[float] = None,
+        solver_strategy: str = "auto",
+        cache_size: int = 6,
+        solver_factory: Optional[Callable[[df.Matrix], Any]] = None,
+    ):
+        """`boundary_conditions(t)` updates the boundary data to time t, and
+        returns the boundary conditions. `solver_factory(A)` creates the solver
+        for the system matrix A, with create_solver(A, solver_strategy) as the
+        default."""
+        self.M = M
+        self.K = K
+        self.boundary_conditions = boundary_conditions
+        self.dt = dt
+        self.dt_min = dt / 64 if dt_min is None else dt_min
+        self.dt_max = 16 * dt if dt_max is None else dt_max
+        self.stop_times = np.unique(np.asarray(stop_times, dtype=float))
+        self.tol = tol
+        self.solver_factory = solver_factory
+        if solver_factory is None:
+            self.solver_factory = lambda A: create_solver(A, solver_strategy)
+        self.cache_size = cache_size
+        self.solvers = OrderedDict()
+        self.b = df.Vector()
+        M.init_vector(self.b, 0)
+        self.u_full = None
+        self.u_new = None
+        self.u_old = None
+        self.dt_old = None
+        self.solves = 0
+        self.rejected = 0
+
+    def solver(self, dt: float, bcs: list[df.DirichletBC]):
+        if dt in self.solvers:
+            self.solvers.move_to_end(dt)
+            return self.solvers[dt]
+        A = self.M.copy()
+        A.axpy(dt, self.K, False)
+        for bc in bcs:
+            bc.apply(A)
+        self.solvers[dt] = self.solver_factory(A)
+        while len(self.solvers) > self.cache_size:
+            self.solvers.popitem(last=False)
+        return self.solvers[dt]
+
+    def solve(self, u0: df.Function, t: float, dt: float, out: df.Function):
+        """Implicit Euler step of size dt from u0 at time t, stored in out.
+        out may be the same function as u0."""
+        bcs = self.boundary_conditions(t + dt)
+        self.M.mult(u0.vector(), self.b)
+        for bc in bcs:
+            bc.apply(self.b)
+        self.solver(dt, bcs).solve(out.vector(), self.b)
+        self.solves += 1
+
+    def next_stop(self, t: float) -> float:
+        idx = np.searchsorted(self.stop_times, t, side="right")
+        return self.stop_times[idx] if idx < self.stop_times.size else np.inf
+
+    def relative_norm(self, vector: df.GenericVector, reference: df.Function) -> float:
+        return vector.norm("l2") / max(reference.vector().norm("l2"), 1e-300)
+
+    def error_estimate(self, u: df.Function, t: float, dt: float) -> float:
+        """Computes the step from u into self.u_new and returns an estimate of
+        the relative local error."""
+        if self.u_old is None:
+            # Step doubling, comparing one step to two half steps.
+            self.solve(u, t, dt, self.u_full)
+            self.solve(u, t, dt / 2, self.u_new)
+            self.solve(self.u_new, t + dt / 2, dt / 2, self.u_new)
+            difference = self.u_new.vector().copy()
+            difference.axpy(-1.0, self.u_full.vector())
+            return self.relative_norm(difference, self.u_new)
+
+        # Comparison to the linear extrapolation from the two previous states.
+        # The difference holds both the local error of the implicit Euler step,
+        # dt^2 / 2 u'', and the error of the extrapolation, dt (dt + dt_old) / 2
+        # u'', so it is (2 dt + dt_old) / dt times the local error.
+        self.solve(u, t, dt, self.u_new)
+        difference = self.u_new.vector().copy()
+        difference.axpy(-1.0 - dt / self.dt_old, u.vector())
+        difference.axpy(dt / self.dt_old, self.u_old.vector())
+        return dt / (2 * dt + self.dt_old) * self.relative_norm(difference, self.u_new)
+
+    def step(self, u: df.Function, t: float) -> float:
+        """Advances u in-place from time t, and returns the new time."""
+        if self.u_full is None:
+            self.u_full = u.copy(deepcopy=True)
+            self.u_new = u.copy(deepcopy=True)
+
+        stop = self.next_stop(t)
+        while True:
+            dt = min(self.dt, stop - t)
+            error = self.error_estimate(u, t, dt)
+            if error <= self.tol or dt <= self.dt_min:
+                break
+            self.rejected += 1
+            # Halving self.dt rather than a step shortened to the stop time
+            # keeps the step sizes on the levels of the solver cache.
+            self.dt = max(self.dt / 2, self.dt_min)
+            while self.dt >= dt and self.dt > self.dt_min:
+                self.dt = max(self.dt / 2, self.dt_min)
+            logger.debug(f"Rejected step at t={t:.0f} s, reducing dt to {self.dt:.0f} s.")
+
+        # The local error is of second order in dt, so doubling the step is
+        # expected to stay within the tolerance if the error is below tol / 4.
+        if error < self.tol / 4 and dt == self.dt:
+            self.dt = min(2 * self.dt, self.dt_max)
+
+        if dt == stop - t:
+            # The boundary data is only piecewise smooth in time, with kinks at
+            # the stop times, so the extrapolation is restarted.
+            self.u_old = None
+            t_new = stop
+        else:
+            if self.u_old is None:
+                self.u_old = u.copy(deepcopy=True)
+            self.u_old.assign(u)
+            self.dt_old = dt
+            t_new = t + dt
+        u.assign(self.u_new)
+        return t_new
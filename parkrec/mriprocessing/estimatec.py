@@ -2,6 +2,11 @@ import argparse
 import os
 import pathlib
 import warnings
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing.pool import Pool
+from pathlib import Path
+from typing import Optional
 
 import nibabel
 import numpy
@@ -100,12 +105,152 @@ def signal_to_T1(
     T_1 = T_1_0 - numpy.log(S_t / S_0) / b
 
     # Threshold unreasably high / low T1 values (noise)
-    T_1 = numpy.where(T_1 < T_min, T_min, T_1)
-    T_1 = numpy.where(T_1 > T_max, T_max, T_1)
+    T_1 = numpy.clip(T_1, T_min, T_max)
 
     return T_1
 
 
+@dataclass
+class Baseline:
+    """Baseline data restricted to the voxels of interest. The voxels are
+    stored as sorted flat indices in Fortran-order, such that each slab of
+    image planes along the last axis corresponds to a contiguous range of
+    indices."""
+
+    affine: numpy.ndarray
+    shape: tuple[int, ...]
+    indices: numpy.ndarray
+    T_1_0: numpy.ndarray
+    log_S_0: Optional[numpy.ndarray] = None
+
+
+def load_baseline(
+    baseline_path: Path,
+    t1map_path: Optional[Path] = None,
+    mask_path: Optional[Path] = None,
+    T_min: float = TMIN,
+    T_max: float = TMAX,
+) -> Baseline:
+    baseline_img = nibabel.load(baseline_path)
+    affine = baseline_img.affine
+    baseline = baseline_img.get_fdata(dtype=numpy.float32).reshape(-1, order="F")
+
+    if mask_path is not None:
+        mask = nibabel.load(mask_path)
+        assert numpy.allclose(
+            affine, mask.affine
+        ), "Affine transformations differ, are you sure the baseline and T1 Map are registered properly?"
+        indices = numpy.flatnonzero(mask.get_fdata().astype(bool).reshape(-1, order="F"))
+    else:
+        indices = numpy.arange(baseline.size)
+
+    if t1map_path is None:
+        return Baseline(affine, baseline_img.shape, indices, baseline[indices])
+
+    t1map = nibabel.load(t1map_path)
+    assert numpy.allclose(
+        affine, t1map.affine
+    ), "Affine transformations differ, are you sure the images are registered properly?"
+    T_1_0 = t1map.get_fdata(dtype=numpy.float32).reshape(-1, order="F")[indices]
+    if T_1_0.max() > 100:
+        print("Assuming T1 Map is given in milliseconds, converting to seconds")
+        T_1_0 /= 1e3
+    # Treshold extreme values (probably noise / artefacts):
+    numpy.clip(T_1_0, T_min, T_max, out=T_1_0)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        log_S_0 = numpy.log(baseline[indices])
+    return Baseline(affine, baseline_img.shape, indices, T_1_0, log_S_0)
+
+
+def masked_concentration(
+    S_t: numpy.ndarray,
+    baseline: Baseline,
+    chunk: slice,
+    b: float = 1.48087682,
+    r_1: float = 3.2,
+    T_min: float = TMIN,
+    T_max: float = TMAX,
+) -> numpy.ndarray:
+    """Computes the concentration in-place in the array `S_t` holding the signal
+    (or T1 if the baseline has no signal) in the voxels baseline.indices[chunk].
+    Equivalent to signal_to_T1 followed by concentration_from_T1."""
+    T_1_0 = baseline.T_1_0[chunk]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        if baseline.log_S_0 is not None:
+            numpy.log(S_t, out=S_t)
+            S_t -= baseline.log_S_0[chunk]
+            S_t /= -b
+            S_t += T_1_0
+            numpy.clip(S_t, T_min, T_max, out=S_t)
+        numpy.reciprocal(S_t, out=S_t)
+        S_t -= 1.0 / T_1_0
+    S_t /= r_1
+    return S_t
+
+
+_BASELINE: Optional[Baseline] = None
+
+
+def _init_worker(baseline: Baseline):
+    global _BASELINE
+    _BASELINE = baseline
+
+
+def estimate_image_concentration(
+    imagepath: Path, exportfolder: Path, chunksize: int = 2**22
+) -> Path:
+    """Estimate concentrations for a single image using the baseline of the
+    worker process. The image is read in slabs of at most `chunksize` voxels
+    (but at least one image plane)."""
+    baseline = _BASELINE
+    print("Converting", imagepath)
+    image = nibabel.load(imagepath, keep_file_open=True)
+    assert numpy.allclose(
+        baseline.affine, image.affine
+    ), "Affine transformations differ, are you sure the images are registered properly?"
+
+    concentration = numpy.full(baseline.shape, numpy.nan, dtype=numpy.float32, order="F")
+    concentration_flat = concentration.reshape(-1, order="F")
+    planesize = baseline.shape[0] * baseline.shape[1]
+    slabsize = max(1, chunksize // planesize)
+    for k0 in range(0, baseline.shape[2], slabsize):
+        k1 = min(baseline.shape[2], k0 + slabsize)
+        lo, hi = numpy.searchsorted(baseline.indices, [k0 * planesize, k1 * planesize])
+        if lo == hi:
+            continue
+        slab = numpy.asarray(image.dataobj[..., k0:k1], dtype=numpy.float32)
+        indices = baseline.indices[lo:hi]
+        S_t = slab.reshape(-1, order="F")[indices - k0 * planesize]
+        concentration_flat[indices] = masked_concentration(S_t, baseline, slice(lo, hi))
+
+    print("Storing to", str(exportfolder / imagepath.name))
+    nibabel.save(
+        nibabel.Nifti1Image(concentration, baseline.affine),
+        str(exportfolder / imagepath.name),
+    )
+    return exportfolder / imagepath.name
+
+
+def estimate_concentrations(
+    images: list[Path],
+    exportfolder: Path,
+    t1map: Optional[Path] = None,
+    mask: Optional[Path] = None,
+    n_jobs: Optional[int] = None,
+    chunksize: int = 2**22,
+) -> list[Path]:
+    """Estimate concentrations for a series of images, where the first image is
+    the baseline, in parallel over a pool of `n_jobs` processes."""
+    print("Loading baseline image", images[0])
+    baseline = load_baseline(images[0], t1map, mask)
+    task = partial(
+        estimate_image_concentration, exportfolder=exportfolder, chunksize=chunksize
+    )
+    with Pool(n_jobs, initializer=_init_worker, initargs=(baseline,)) as pool:
+        return pool.map(task, images, chunksize=1)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -125,6 +270,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "--mask", type=str, default=None, help="Path to mask for the brain"
     )
+    parser.add_argument(
+        "--n_jobs", type=int, default=None, help="Number of worker processes."
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=2**22,
+        help="Maximum number of voxels read at once by each worker.",
+    )
 
     parserargs = vars(parser.parse_args())
 
@@ -133,74 +287,20 @@ if __name__ == "__main__":
 
     os.makedirs(exportfolder, exist_ok=True)
 
-    images = sorted(filter(is_T1_mgz, parserargs["inputfolder"].iterdir()))
-
-    print("Loading baseline image", images[0])
-
-    baseline_img = nibabel.load(images[0])
-    affine = baseline_img.affine
-    baseline = baseline_img.get_fdata()
-
-    if parserargs["mask"] is not None:
-        mask = nibabel.load(parserargs["mask"])
-
-        assert numpy.allclose(
-            affine, mask.affine
-        ), "Affine transformations differ, are you sure the baseline and T1 Map are registered properly?"
-
-        mask = mask.get_fdata().astype(bool)
-
-        baseline *= mask
-
-    if parserargs["t1map"] is not None:
-        baseline_t1_map = nibabel.load(parserargs["t1map"])
-        t1_map_affine = baseline_t1_map.affine
-        baseline_t1_map = baseline_t1_map.get_fdata()
-        assert numpy.allclose(
-            affine, t1_map_affine
-        ), "Affine transformations differ, are you sure the images are registered properly?"
-
-        if baseline_t1_map.max() > 100:
-            print("Assuming T1 Map is given in milliseconds, converting to seconds")
-            baseline_t1_map /= 1e3
-
-        # Treshold extreme values (probably noise / artefacts):
-        baseline_t1_map = numpy.where(baseline_t1_map < TMIN, TMIN, baseline_t1_map)
-        baseline_t1_map = numpy.where(baseline_t1_map > TMAX, TMAX, baseline_t1_map)
+    images = sorted(filter(is_T1_mgz, inputfolder.iterdir()))
 
-    else:
+    if parserargs["t1map"] is None:
         print("*" * 80)
         print(
             "Argument --t1map not specified, assuming the image images in --inputfolder are T1 maps (not T1-weighted images!)"
         )
         print("*" * 80)
-        baseline_t1_map = baseline
-
-    for imagepath in images:
-        assert imagepath.is_file()
-
-        print("Converting", imagepath)
-
-        image = nibabel.load(imagepath)
-
-        assert numpy.allclose(
-            affine, image.affine
-        ), "Affine transformations differ, are you sure the images are registered properly?"
-
-        image = image.get_fdata()
-
-        if parserargs["mask"] is not None:
-            image *= mask
-
-        if parserargs["t1map"] is not None:
-            T_1_t = signal_to_T1(S_t=image, S_0=baseline, T_1_0=baseline_t1_map)
-        else:
-            T_1_t = image
 
-        concentration = concentration_from_T1(T_1_t=T_1_t, T_1_0=baseline_t1_map)
-
-        print("Storing to", str(exportfolder / imagepath.name))
-        nibabel.save(
-            nibabel.Nifti1Image(concentration, affine),
-            str(exportfolder / imagepath.name),
-        )
+    estimate_concentrations(
+        images,
+        exportfolder,
+        t1map=parserargs["t1map"],
+        mask=parserargs["mask"],
+        n_jobs=parserargs["n_jobs"],
+        chunksize=parserargs["chunksize"],
+    )
@@ -1,90 +1,178 @@
 import argparse
-import itertools
 import logging
 from pathlib import Path
-from typing import Tuple
+from typing import Optional, Tuple
 
+import dolfin as df
 import nibabel
 import numpy as np
+import scipy.sparse
 from nibabel.affines import apply_affine
 from pantarei.fenicsstorage import FenicsStorage
-from tqdm import tqdm
+from scipy.spatial import cKDTree
 
-from parkrec.models.data_interpolator import interpolate_from_file
+from parkrec.models.data_interpolator import TimeSeriesInterpolator
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def function_to_image(
-    function, template_image, extrapolation_value, mask
-) -> Tuple[nibabel.Nifti1Image, np.ndarray]:
-    shape = template_image.get_fdata().shape
-    output_data = np.zeros(shape) + extrapolation_value
-    vox2ras = template_image.header.get_vox2ras_tkr()
-    V = function.function_space()
-    ## Code to get a bounding box for the mesh, used to not iterate over all the voxels in the image
-    if mask is None:
-        imap = V.dofmap().index_map()
-        num_dofs_local = imap.local_range()[1] - imap.local_range()[0]
-        xyz = V.tabulate_dof_coordinates()
-        xyz = xyz.reshape((num_dofs_local, -1))
-        image_coords = apply_affine(np.linalg.inv(vox2ras), xyz)
-
-        lower_bounds = np.maximum(0, np.floor(image_coords.min(axis=0)).astype(int))
-        upper_bounds = np.minimum(shape, np.ceil(image_coords.max(axis=0)).astype(int))
-
-        all_relevant_indices = itertools.product(
-            *(range(start, stop + 1) for start, stop in zip(lower_bounds, upper_bounds))
+def load_mask(
+    mask_file: Path,
+    skip_value: float = float("nan"),
+    allow_full_mask: bool = False,
+) -> np.ndarray:
+    """Read a mask-image, where voxels with value `skip_value` should not be
+    evaluated."""
+    mask = nibabel.load(mask_file).get_fdata()
+    if np.isnan(skip_value):
+        mask = ~np.isnan(mask)
+    else:
+        mask = ~np.isclose(mask, skip_value)
+    if mask.all() and not allow_full_mask:
+        raise ValueError(
+            "The supplied mask covers the whole image so you are probably doing something wrong."
+            + " To allow for this behaviour, run with --allow_full_mask"
         )
-        num_voxels_in_mask = np.product(1 + upper_bounds - lower_bounds)
-        fraction_of_image = num_voxels_in_mask / np.product(shape)
-        print(
-            f"Computed mesh bounding box, evaluating {fraction_of_image:.0%} of all image voxels"
+    return mask
+
+
+def mesh_bounding_box(mesh: df.Mesh, vox2ras: np.ndarray, shape) -> np.ndarray:
+    """Returns the voxel-indices of all voxels within the bounding box of the
+    mesh, as an (N, 3)-array."""
+    image_coords = apply_affine(np.linalg.inv(vox2ras), mesh.coordinates())
+    lower_bounds = np.maximum(0, np.floor(image_coords.min(axis=0)).astype(int))
+    upper_bounds = np.minimum(
+        np.array(shape) - 1, np.ceil(image_coords.max(axis=0)).astype(int)
+    )
+    grid = np.mgrid[
+        tuple(slice(start, stop + 1) for start, stop in zip(lower_bounds, upper_bounds))
+    ]
+    return grid.reshape(3, -1).T
+
+
+class CellLocator:
+    """Vectorized point location in a tetrahedral mesh. Candidate cells for
+    each point are found through a KD-tree over the cell midpoints, and
+    verified using barycentric coordinates. Points which are not resolved among
+    the candidates, but still are close enough to the mesh to possibly be
+    inside it, are handed to the DOLFIN bounding box tree."""
+
+    def __init__(self, mesh: df.Mesh, num_candidates: int = 8, tol: float = 1e-10):
+        self.mesh = mesh
+        self.num_candidates = num_candidates
+        self.tol = tol
+        self.cells = mesh.cells()
+        vertices = mesh.coordinates()[self.cells]
+        self.origins = vertices[:, 0]
+        self.inverse_transforms = np.linalg.inv(
+            (vertices[:, 1:] - vertices[:, :1]).transpose(0, 2, 1)
+        )
+        midpoints = vertices.mean(axis=1)
+        self.cell_radius = np.linalg.norm(
+            vertices - midpoints[:, None], axis=2
+        ).max()
+        self.tree = cKDTree(midpoints)
+        self.bbtree = mesh.bounding_box_tree()
+
+    def barycentric(self, points: np.ndarray, cells: np.ndarray) -> np.ndarray:
+        lambdas = np.einsum(
+            "...ij,...j->...i", self.inverse_transforms[cells], points - self.origins[cells]
+        )
+        return np.concatenate((1.0 - lambdas.sum(axis=-1, keepdims=True), lambdas), axis=-1)
+
+    def locate(self, points: np.ndarray, chunksize: int = 2**18) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the cell containing each of the points (-1 if outside the
+        mesh), together with the barycentric coordinates within that cell."""
+        cells = np.full(len(points), -1, dtype=np.int64)
+        weights = np.zeros((len(points), 4))
+        for start in range(0, len(points), chunksize):
+            chunk = slice(start, start + chunksize)
+            cells[chunk], weights[chunk] = self._locate_chunk(points[chunk])
+        return cells, weights
+
+    def _locate_chunk(self, points):
+        k = min(self.num_candidates, self.cells.shape[0])
+        distance, candidates = self.tree.query(points, k=k)
+        candidates = candidates.reshape(len(points), k)
+        lambdas = self.barycentric(points[:, None, :], candidates)
+        inside = lambdas.min(axis=-1) >= -self.tol
+        found = inside.any(axis=1)
+        first = inside.argmax(axis=1)
+        idx = np.arange(len(points))
+        cells = np.where(found, candidates[idx, first], -1)
+        weights = lambdas[idx, first]
+
+        nearest = distance.reshape(len(points), k)[:, 0]
+        unresolved = np.flatnonzero(~found & (nearest <= self.cell_radius))
+        num_cells = self.mesh.num_cells()
+        for i in unresolved:
+            cell = self.bbtree.compute_first_entity_collision(df.Point(*points[i]))
+            if cell < num_cells:
+                cells[i] = cell
+                weights[i] = self.barycentric(points[i], cell)
+        weights[cells < 0] = 0.0
+        return cells, weights
+
+
+class VoxelRasterizer:
+    """Linear map from the degrees of freedom of a P1-function to the values in
+    the image voxel centers. The voxels are located in the mesh only once, such
+    that rasterizing a function at subsequent timepoints is a single sparse
+    matrix-vector product."""
+
+    def __init__(
+        self,
+        V: df.FunctionSpace,
+        template_image: nibabel.spatialimages.SpatialImage,
+        mask: Optional[np.ndarray] = None,
+    ):
+        if V.ufl_element().family() != "Lagrange" or V.ufl_element().degree() != 1:
+            raise NotImplementedError("Rasterization requires a scalar CG1-space.")
+        self.V = V
+        self.shape = template_image.shape
+        vox2ras = template_image.header.get_vox2ras_tkr()
+        mesh = V.mesh()
+
+        ijk = mesh_bounding_box(mesh, vox2ras, self.shape)
+        if mask is not None:
+            ijk = ijk[mask[tuple(ijk.T)]]
+        fraction_of_image = len(ijk) / np.prod(self.shape)
+        logger.info(
+            f"Evaluating {len(ijk)} voxels ({fraction_of_image:.0%} of all image voxels)"
         )
-        print(f"There are {num_voxels_in_mask} voxels in the bounding box")
-    else:
-        raise NotImplementedError
-        #     mask = nibabel.load(args.mask).get_fdata()
-        #     # breakpoint()
-        #     if args.skip_value is None:
-        #         skip_value = args.extrapolation_value
-        #     else:
-        #         skip_value = args.skip_value
-        #     if np.isnan(skip_value):
-        #         print("Extrapolation value is NaN")
-        #         mask = ~np.isnan(mask)
-        #     else:
-        #         mask = ~np.isclose(mask, skip_value)
-        #     nonzeros = np.nonzero(mask)
-        #     num_voxels_in_mask = len(nonzeros[0])
-        #     all_relevant_indices = zip(*nonzeros)
-        #     fraction_of_image = num_voxels_in_mask / np.product(output_data.shape)
-        #     print(f"Using mask, evaluating {fraction_of_image:.0%} of all image voxels")
-        #     print(f"There are {num_voxels_in_mask} voxels in the mask")
-        #     if fraction_of_image > 1 - 1e-10 and not args.allow_full_mask:
-        #         raise ValueError("The supplied mask covers the whole image so you are probably doing something wrong." /
-        #                         " To allow for this behaviour, run with --allow_full_mask")
-
-    # Populate image
-    def eval_fenics(f, coords, extrapolation_value):
-        try:
-            return f(*coords)
-        except RuntimeError:
-            return extrapolation_value
 
-    eps = 1e-12
+        cells, weights = CellLocator(mesh).locate(apply_affine(vox2ras, ijk))
+        found = cells >= 0
+        logger.info(f"Located {found.sum()} / {len(ijk)} voxels within the mesh.")
+
+        vertex_dofs = df.vertex_to_dof_map(V)[mesh.cells()[cells[found]]]
+        rows = np.repeat(np.arange(found.sum()), vertex_dofs.shape[1])
+        self.operator = scipy.sparse.csr_matrix(
+            (weights[found].ravel(), (rows, vertex_dofs.ravel())),
+            shape=(found.sum(), V.dim()),
+        )
+        self.voxels = tuple(ijk[found].T)
 
-    progress = tqdm(total=num_voxels_in_mask)
+    def __call__(self, function: df.Function, extrapolation_value: float) -> np.ndarray:
+        output_data = np.full(self.shape, extrapolation_value)
+        output_data[self.voxels] = self.operator @ function.vector().get_local()
+        return output_data
 
-    for xyz_vox in all_relevant_indices:
-        xyz_ras = apply_affine(
-            vox2ras, xyz_vox
-        )  # transform_coords(coords, vox2ras, inverse=True)
-        output_data[xyz_vox] = eval_fenics(function, xyz_ras, extrapolation_value)
-        progress.update(1)
 
+def function_to_image(
+    function,
+    template_image,
+    extrapolation_value,
+    mask=None,
+    rasterizer: Optional[VoxelRasterizer] = None,
+) -> Tuple[nibabel.Nifti1Image, np.ndarray]:
+    if rasterizer is None:
+        rasterizer = VoxelRasterizer(function.function_space(), template_image, mask)
+    output_data = rasterizer(function, extrapolation_value)
+
+    eps = 1e-12
     output_data = np.where(output_data < eps, eps, output_data)
     # Save output
     output_nii = nibabel.Nifti1Image(
@@ -109,6 +197,7 @@ if __name__ == "__main__":
         type=float,
         help="Voxel value indicating that a voxel should be skipped in the mask. If unspecified, it's the same as the extrapolation value.",
     )
+    parser.add_argument("--allow_full_mask", action="store_true")
 
     # parser.add_argument("--image", type=str, help="MRI file to get transformation matrix from")
     # parser.add_argument("--function_space", type=str, default="CG")
@@ -122,15 +211,23 @@ if __name__ == "__main__":
 
     storage = FenicsStorage(patientpath / "FENICS/cdata_32.hdf", "r")
     timevec = storage.read_timevector("cdata")
+
+    mask = None
+    if args.mask is not None:
+        skip_value = args.extrapolation_value if args.skip_value is None else args.skip_value
+        mask = load_mask(args.mask, skip_value, args.allow_full_mask)
+
+    interpolator = TimeSeriesInterpolator(storage, args.hdf5_name)
+    rasterizer = VoxelRasterizer(interpolator.function_space(), nii_img, mask)
     for idx, ti in enumerate(timevec):
-        ci = interpolate_from_file(storage.filepath, args.hdf5_name, ti)
+        ci = interpolator.function_at(ti)
         hours = int(round(ti / 3600))
         logging.info(f"Processing time {hours} hours")
         output_volume, output_arry = function_to_image(
             function=ci,
             template_image=nii_img,
             extrapolation_value=args.extrapolation_value,
-            mask=args.mask,
+            rasterizer=rasterizer,
         )
         output_path = patientpath / f"SIMULATION/{args.hdf5_name}_{hours:02d}.nii.gz"
         nibabel.save(output_volume, output_path)
@@ -1,45 +1,102 @@
 import logging
+import shutil
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Optional
 
-from pantarei.meshprocessing import mesh2xdmf, xdmf2hdf
 import SVMTK as svmtk
 
+from parkrec.mriprocessing.meshprocessing import mesh2hdf
+from parkrec.utils import file_hash
+
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SURFACES = ("lh.pial", "rh.pial", "lh.white", "rh.white")
+VENTRICLE_SCRIPT = Path("scripts/extract-ventricles.sh")
 
-def create_patient_mesh(patientdir, resolution):
-    meshpath = patientdir / "MESH"
-    meshpath.mkdir(exist_ok=True)
-    surfaces = ("lh.pial", "rh.pial", "lh.white", "rh.white", "ventricles")
-    surfaces = [patientdir / "surf" / surf for surf in surfaces]
-    stls = [meshpath / f"{surf.name}.stl" for surf in surfaces]
-
-    for surface, stl in zip(surfaces, stls):
-        if "ventricles" in surface.name:
-            continue
-        subprocess.run(f"mris_convert {surface} {stl}", shell=True)
+
+def cache_dir(patientdir: Path) -> Path:
+    return patientdir / "MESH" / "cache"
+
+
+def cached_output(cachedir: Path, name: str, key: str, command: str) -> Path:
+    """Runs the command with '{output}' replaced by a temporary path, unless the
+    output for this key already exists in the cache directory."""
+    output = cachedir / f"{name}.{key[:16]}.stl"
+    if output.exists():
+        logger.info(f"Using cached {output}")
+        return output
+    cachedir.mkdir(exist_ok=True, parents=True)
+    tmp = output.with_suffix(".tmp.stl")
+    subprocess.run(command.format(output=tmp), shell=True, check=True)
+    tmp.rename(output)
+    for stale in cachedir.glob(f"{name}.*.stl"):
+        if stale != output:
+            stale.unlink()
+    return output
+
+
+def surface_stl(surface: Path, cachedir: Path) -> Path:
+    """STL-conversion of the FreeSurfer surface, cached by the hash of the surface."""
     # Should add one of these. Not sure if surf or tkr
     #   --to-surf surfcoords : copy coordinates from surfcoords to output (good for patches)
     #   --to-tkr : convert coordinates from scanner coords to native FS (tkr) coords
+    return cached_output(
+        cachedir, surface.name, file_hash(surface), f"mris_convert {surface} {{output}}"
+    )
+
+
+def create_ventricle_surface(patientdir: Path) -> Path:
+    """Ventricle surface extracted from wmparc.mgz, cached by the hash of the
+    segmentation and the extraction script. Also copied to MESH/ventricles.stl."""
+    input = patientdir / "mri/wmparc.mgz"
+    key = file_hash(input)[:32] + file_hash(VENTRICLE_SCRIPT)[:32]
+    cached = cached_output(
+        cache_dir(patientdir),
+        "ventricles",
+        key,
+        f"bash {VENTRICLE_SCRIPT} {input} {{output}}",
+    )
+    output = patientdir / "MESH/ventricles.stl"
+    shutil.copyfile(cached, output)
+    return output
+
+
+def patient_stls(patientdir: Path) -> list[Path]:
+    cachedir = cache_dir(patientdir)
+    stls = [surface_stl(patientdir / "surf" / surf, cachedir) for surf in SURFACES]
+    return stls + [create_ventricle_surface(patientdir)]
 
+
+def create_patient_mesh(patientdir, resolution):
+    meshpath = patientdir / "MESH"
+    meshpath.mkdir(exist_ok=True)
     return create_brain_mesh(
-        stls,
+        patient_stls(patientdir),
         meshpath / f"brain{resolution}.mesh",
         resolution,
         remove_ventricles=True,
     )
 
 
-def create_ventricle_surface(patientdir):
-    input = patientdir / "mri/wmparc.mgz"
-    output = patientdir / "MESH/ventricles.stl"
-    if not output.exists():
-        subprocess.run(
-            f"bash scripts/extract-ventricles.sh {input} {output}", shell=True
-        )
+def create_patient_meshes(
+    patientdir: Path, resolutions: list[int], max_workers: Optional[int] = None
+) -> list[Path]:
+    """Creates meshes of several resolutions in separate processes. The surface
+    conversions are done once, before the meshes are generated."""
+    meshpath = patientdir / "MESH"
+    meshpath.mkdir(exist_ok=True)
+    stls = patient_stls(patientdir)
+    outputs = [meshpath / f"brain{resolution}.mesh" for resolution in resolutions]
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(create_brain_mesh, stls, output, resolution, True)
+            for output, resolution in zip(outputs, resolutions)
+        ]
+        return [future.result() for future in futures]
 
 
 def create_brain_mesh(stls, output, resolution=32, remove_ventricles=True):
@@ -77,10 +134,7 @@ def create_brain_mesh(stls, output, resolution=32, remove_ventricles=True):
 
     # Save mesh
     domain.save(str(output))
-    xdmfdir = patientdir / "MESH/xdmf"
-    xdmfdir.mkdir(exist_ok=True)
-    mesh2xdmf(output, xdmfdir)
-    return xdmf2hdf(xdmfdir, output.with_suffix(".hdf"))
+    return mesh2hdf(output, output.with_suffix(".hdf"))
 
 
 if __name__ == "__main__":
@@ -89,11 +143,13 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("patientid", help="Patient ID on the form PAT_###")
-    parser.add_argument("resolution", help="SVMTK mesh resolution.", type=int)
+    parser.add_argument(
+        "resolutions", help="SVMTK mesh resolutions.", type=int, nargs="+"
+    )
+    parser.add_argument("--max_workers", type=int, default=None)
     args = parser.parse_args()
 
     patientdir = Path("DATA") / args.patientid
     logger.info(f"Working in {patientdir}")
-    create_ventricle_surface(patientdir)
-    meshfile = create_patient_mesh(patientdir, args.resolution)
-    logger.info(f"Generated mesh in file {meshfile}")
+    meshfiles = create_patient_meshes(patientdir, args.resolutions, args.max_workers)
+    logger.info(f"Generated meshes in files {meshfiles}")
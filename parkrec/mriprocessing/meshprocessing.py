@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 import logging
+import os
+import resource
+import shutil
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional
 
+import h5py
 import meshio
-from dolfin import HDF5File, Mesh, MeshFunction, MeshValueCollection, XDMFFile
+import numpy as np
+from dolfin import (
+    MPI,
+    HDF5File,
+    Mesh,
+    MeshFunction,
+    MeshValueCollection,
+    XDMFFile,
+)
 from dolfin.cpp.mesh import MeshFunctionSizet
 
 
@@ -22,6 +37,15 @@ def unpack_domain(domain: Domain):
     return domain.mesh, domain.subdomains, domain.boundaries
 
 
+@contextmanager
+def report(stage: str):
+    """Logs the wall time and the peak memory usage of the process after the stage."""
+    tic = time.perf_counter()
+    yield
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+    logger.info(f"{stage}: {time.perf_counter() - tic:.2f} s, peak memory {peak:.2f} GB")
+
+
 def mesh2xdmf(meshfile, xdmfdir):
     mesh = meshio.read(meshfile)
     logger.info(f"Converting {meshfile} to {xdmfdir}/xxxxx.xdmf")
@@ -56,6 +80,98 @@ def meshio2xdmf(mesh, xdmfdir):
     return xdmfdir
 
 
+def cell_data_name(mesh: meshio.Mesh) -> str:
+    return "gmsh:physical" if "gmsh:physical" in mesh.cell_data_dict else "medit:ref"
+
+
+def tetrahedron_facets(cells: np.ndarray) -> np.ndarray:
+    """Unique facets of the tetrahedra, as rows of sorted vertex indices."""
+    facets = cells[:, [[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]]].reshape(-1, 3)
+    return np.unique(np.sort(facets, axis=1), axis=0)
+
+
+def facet_keys(facets: np.ndarray) -> np.ndarray:
+    """Sortable key of each facet (given as rows of sorted vertex indices). The
+    big-endian byte representation of the rows makes the ordering of the keys
+    lexicographic, as the rows from np.unique(..., axis=0)."""
+    rows = np.ascontiguousarray(facets.astype(">i8"))
+    return rows.view(np.dtype((np.void, rows.shape[1] * 8))).ravel()
+
+
+def facet_markers(facets: np.ndarray, marked_facets: np.ndarray, markers: np.ndarray) -> np.ndarray:
+    """Marker value of each of the facets (rows of vertex indices in any order),
+    with 0 for facets which are not marked."""
+    facets = np.sort(facets, axis=1)
+    marked_facets = np.sort(marked_facets, axis=1)
+    keys = facet_keys(facets)
+    order = np.argsort(keys)
+    position = np.searchsorted(keys[order], facet_keys(marked_facets))
+    idx = order[np.minimum(position, facets.shape[0] - 1)]
+    found = (facets[idx] == marked_facets).all(axis=1)
+    if not found.all():
+        logger.warning(f"{(~found).sum()} marked facets are not facets of the mesh.")
+    values = np.zeros(facets.shape[0], dtype=np.uint64)
+    values[idx[found]] = markers[found]
+    return values
+
+
+def write_hdf_mesh(group: h5py.Group, topology: np.ndarray, celltype: str):
+    topology = group.create_dataset("topology", data=topology.astype(np.int64))
+    topology.attrs["celltype"] = np.bytes_(celltype)
+    topology.attrs["partition"] = np.array([0], dtype=np.uint64)
+
+
+def meshio2hdf(mesh: meshio.Mesh, hdf5file: Path) -> Path:
+    """Writes the tetrahedral mesh, with subdomains from the cell markers, and
+    boundaries from the triangle markers, into the DOLFIN HDF5 layout read by
+    hdf2fenics. Facets without markers get the value 0."""
+    cells = mesh.cells_dict["tetra"]
+    label = cell_data_name(mesh)
+    with report("Computing facet markers"):
+        facets = tetrahedron_facets(cells)
+        boundaries = facet_markers(
+            facets,
+            mesh.cells_dict["triangle"],
+            mesh.cell_data_dict[label]["triangle"],
+        )
+    with h5py.File(hdf5file, "w") as f:
+        domain = f.create_group("domain")
+        meshgroup = domain.create_group("mesh")
+        meshgroup.create_dataset("coordinates", data=mesh.points.astype(np.float64))
+        write_hdf_mesh(meshgroup, cells, "tetrahedron")
+
+        subdomains = domain.create_group("subdomains")
+        subdomains["coordinates"] = meshgroup["coordinates"]
+        write_hdf_mesh(subdomains, cells, "tetrahedron")
+        subdomains.create_dataset(
+            "values", data=mesh.cell_data_dict[label]["tetra"].astype(np.uint64)
+        )
+
+        boundarygroup = domain.create_group("boundaries")
+        boundarygroup["coordinates"] = meshgroup["coordinates"]
+        write_hdf_mesh(boundarygroup, facets, "triangle")
+        boundarygroup.create_dataset("values", data=boundaries)
+    return Path(hdf5file)
+
+
+def mesh2hdf(meshfile, hdf5file) -> Path:
+    """Converts a mesh file readable by meshio (e.g. SVMTK's .mesh) into the
+    HDF5 layout read by hdf2fenics, without intermediate XDMF files."""
+    with report(f"Reading {meshfile}"):
+        mesh = meshio.read(meshfile)
+    with report(f"Writing {hdf5file}"):
+        return meshio2hdf(mesh, hdf5file)
+
+
+def write_domain(domain: Domain, hdf5file) -> Path:
+    mesh, subdomains, boundaries = unpack_domain(domain)
+    with HDF5File(mesh.mpi_comm(), str(hdf5file), "w") as f:
+        f.write(mesh, "/domain/mesh")
+        f.write(subdomains, "/domain/subdomains")
+        f.write(boundaries, "/domain/boundaries")
+    return Path(hdf5file)
+
+
 def xdmf2hdf(xdmfdir, hdf5file):
     # Read xdmf-file into a FEniCS mesh
     dirpath = Path(xdmfdir)
@@ -76,16 +192,17 @@ def xdmf2hdf(xdmfdir, hdf5file):
     boundaries = MeshFunction("size_t", mesh, bdrycollection)
 
     # Write all files into a single h5-file.
-    with HDF5File(mesh.mpi_comm(), str(hdf5file), "w") as f:
-        f.write(mesh, "/domain/mesh")
-        f.write(subdomains, "/domain/subdomains")
-        f.write(boundaries, "/domain/boundaries")
-    return Path(hdf5file)
+    return write_domain(Domain(mesh, subdomains, boundaries), hdf5file)
 
 
-def hdf2fenics(hdf5file, pack=False):
+def hdf2fenics(hdf5file, pack=False, cache=False):
     """Function to read h5-file with annotated mesh, subdomains
-    and boundaries into fenics mesh"""
+    and boundaries into fenics mesh. With `cache`, the markers are loaded from
+    the domain cache next to the file (see cached_domain)."""
+    if cache:
+        domain = cached_domain(hdf5file)
+        return domain if pack else unpack_domain(domain)
+
     mesh = Mesh()
     with HDF5File(mesh.mpi_comm(), str(hdf5file), "r") as hdf:
         hdf.read(mesh, "/domain/mesh", False)
@@ -100,3 +217,128 @@ def hdf2fenics(hdf5file, pack=False):
         return Domain(mesh, subdomains, boundaries)
 
     return mesh, subdomains, boundaries
+
+
+DOMAIN_CACHE_ARRAYS = (
+    "coordinates",
+    "cells",
+    "subdomains",
+    "boundaries",
+    "dof_coordinates",
+    "vertex_to_dof",
+)
+
+
+@dataclass
+class DomainCache:
+    """Arrays of a (serial) domain stored as .npy-files in a directory, which
+    are memory-mapped on load, such that repeated loads, and processes on the
+    same node, share the pages of the file system cache. The markers are stored
+    in the DOLFIN cell and facet numbering, and the P1 arrays in the dof
+    numbering of FunctionSpace(mesh, "CG", 1), as used by the image samplers
+    in mri2fenics."""
+
+    coordinates: np.ndarray
+    cells: np.ndarray
+    subdomains: np.ndarray
+    boundaries: np.ndarray
+    dof_coordinates: np.ndarray
+    vertex_to_dof: np.ndarray
+
+    @classmethod
+    def create(cls, domain: Domain, directory: Path) -> "DomainCache":
+        from dolfin import FunctionSpace, vertex_to_dof_map
+
+        mesh, subdomains, boundaries = unpack_domain(domain)
+        V = FunctionSpace(mesh, "CG", 1)
+        arrays = {
+            "coordinates": mesh.coordinates(),
+            "cells": mesh.cells(),
+            "subdomains": subdomains.array(),
+            "boundaries": boundaries.array(),
+            "dof_coordinates": V.tabulate_dof_coordinates(),
+            "vertex_to_dof": vertex_to_dof_map(V),
+        }
+        # Written to a temporary directory first, such that concurrent
+        # processes never see a partially written cache. The prefix keeps it
+        # out of the stale-cache cleanup in cached_domain.
+        directory = Path(directory)
+        tmpdir = directory.with_name(f".tmp{os.getpid()}_{directory.name}")
+        tmpdir.mkdir(parents=True, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(tmpdir / f"{name}.npy", np.ascontiguousarray(array))
+        try:
+            tmpdir.rename(directory)
+        except OSError:
+            # Another process created the cache first.
+            shutil.rmtree(tmpdir)
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory: Path) -> "DomainCache":
+        return cls(
+            **{
+                name: np.load(Path(directory) / f"{name}.npy", mmap_mode="r")
+                for name in DOMAIN_CACHE_ARRAYS
+            }
+        )
+
+    def matches(self, mesh: Mesh) -> bool:
+        return (
+            self.coordinates.shape == mesh.coordinates().shape
+            and self.cells.shape[0] == mesh.num_cells()
+            and self.boundaries.shape[0] == mesh.num_facets()
+        )
+
+
+def domain_cache_dir(hdf5file: Path) -> Path:
+    """Cache directory next to the file, keyed by the size and modification
+    time of the file, such that a rewritten mesh file gets a new cache."""
+    hdf5file = Path(hdf5file)
+    stat = hdf5file.stat()
+    return hdf5file.parent / f"{hdf5file.stem}_cache_{stat.st_size}_{stat.st_mtime_ns}"
+
+
+def load_domain_cache(hdf5file) -> Optional[DomainCache]:
+    """The domain cache of the h5-file if it exists, and None in parallel, where
+    the cached arrays do not apply."""
+    directory = domain_cache_dir(hdf5file)
+    if MPI.comm_world.size > 1 or not directory.exists():
+        return None
+    return DomainCache.load(directory)
+
+
+def cached_domain(hdf5file) -> Domain:
+    """Reads the mesh from the h5-file, and the subdomains and boundaries from
+    the domain cache, which is created on first use. Assigning the marker
+    arrays directly avoids the matching of the marked entities to the mesh done
+    by HDF5File.read, which dominates the load time of large meshes. In
+    parallel the markers are read from the h5-file as in hdf2fenics, since the
+    cached arrays are in the serial numbering."""
+    mesh = Mesh()
+    if mesh.mpi_comm().size > 1:
+        return hdf2fenics(hdf5file, pack=True)
+
+    directory = domain_cache_dir(hdf5file)
+    if not directory.exists():
+        logger.info(f"Creating domain cache {directory}")
+        domain = hdf2fenics(hdf5file, pack=True)
+        for stale in directory.parent.glob(f"{Path(hdf5file).stem}_cache_*"):
+            if stale.is_dir() and stale != directory:
+                shutil.rmtree(stale, ignore_errors=True)
+        DomainCache.create(domain, directory)
+        return domain
+
+    with report(f"Loading cached domain {directory}"):
+        cache = DomainCache.load(directory)
+        with HDF5File(mesh.mpi_comm(), str(hdf5file), "r") as hdf:
+            hdf.read(mesh, "/domain/mesh", False)
+        n = mesh.topology().dim()
+        mesh.init(n - 1)
+        if not cache.matches(mesh):
+            raise ValueError(f"Domain cache {directory} does not match {hdf5file}.")
+        subdomains = MeshFunction("size_t", mesh, n, 0)
+        subdomains.array()[:] = cache.subdomains
+        boundaries = MeshFunction("size_t", mesh, n - 1, 0)
+        boundaries.array()[:] = cache.boundaries
+    return Domain(mesh, subdomains, boundaries)
@@ -2,60 +2,263 @@ import argparse
 
 # from dolfin_adjoint import *
 import datetime
+import hashlib
 import logging
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import TYPE_CHECKING, List, Optional
 
 import dolfin as df
 
 # from datetime import datetime
 import nibabel
 import numpy
+import scipy.sparse
 from nibabel.affines import apply_affine
 from pantarei.fenicsstorage import FenicsStorage
 
+from parkrec.models.parallel import assign_local
+from parkrec.utils import file_hash
+
+if TYPE_CHECKING:
+    from parkrec.mriprocessing.meshprocessing import DomainCache
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+SAMPLING_METHODS = ("nearest", "trilinear", "average")
+
+
+@dataclass
+class ImageSampler:
+    """Sparse operator mapping the voxel values of an image with a given
+    vox2ras-tkr affine and shape to the degrees of freedom of a function space."""
+
+    operator: scipy.sparse.csr_matrix
+    vox2ras: numpy.ndarray
+    shape: tuple[int, ...]
+
+    def __call__(self, voxeldata: numpy.ndarray) -> numpy.ndarray:
+        return self.operator @ voxeldata.reshape(-1)
+
+    def matches(self, mri_volume) -> bool:
+        return tuple(mri_volume.shape) == tuple(self.shape) and numpy.allclose(
+            mri_volume.header.get_vox2ras_tkr(), self.vox2ras
+        )
+
+    def save(self, path: Path) -> Path:
+        numpy.savez(
+            path,
+            data=self.operator.data,
+            indices=self.operator.indices,
+            indptr=self.operator.indptr,
+            operator_shape=self.operator.shape,
+            vox2ras=self.vox2ras,
+            shape=self.shape,
+        )
+        return Path(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "ImageSampler":
+        with numpy.load(path) as f:
+            operator = scipy.sparse.csr_matrix(
+                (f["data"], f["indices"], f["indptr"]),
+                shape=tuple(f["operator_shape"]),
+            )
+            return cls(operator, f["vox2ras"], tuple(int(n) for n in f["shape"]))
+
+
+def voxel_stencil(ijk: numpy.ndarray, shape, method: str):
+    """Returns voxel indices and weights, each with shape (N, stencilsize), of
+    the voxels used to sample the image in the (continuous) voxel coordinates
+    ijk."""
+    if method == "nearest":
+        indices = numpy.rint(ijk).astype(int)[:, None, :]
+        weights = numpy.ones((ijk.shape[0], 1))
+    elif method == "trilinear":
+        base = numpy.floor(ijk).astype(int)
+        offsets = numpy.array(numpy.unravel_index(numpy.arange(8), (2, 2, 2))).T
+        indices = base[:, None, :] + offsets
+        fraction = (ijk - base)[:, None, :]
+        weights = numpy.where(offsets, fraction, 1 - fraction).prod(axis=-1)
+    else:
+        raise ValueError(f"Unknown voxel stencil '{method}'.")
+    indices = numpy.clip(indices, 0, numpy.array(shape) - 1)
+    return numpy.ravel_multi_index(tuple(numpy.moveaxis(indices, -1, 0)), shape), weights
+
+
+def point_sampling_operator(points, vox2ras, shape, method) -> scipy.sparse.csr_matrix:
+    ijk = apply_affine(numpy.linalg.inv(vox2ras), points)
+    indices, weights = voxel_stencil(ijk, shape, method)
+    rows = numpy.repeat(numpy.arange(len(points)), indices.shape[1])
+    return scipy.sparse.csr_matrix(
+        (weights.ravel(), (rows, indices.ravel())),
+        shape=(len(points), numpy.prod(shape)),
+    )
+
 
-def read_image(filename, functionspace, data_filter=None):
+def is_p1(functionspace) -> bool:
+    element = functionspace.ufl_element()
+    return element.family() == "Lagrange" and element.degree() == 1 and element.value_shape() == ()
+
+
+def p1_arrays(functionspace, domain_cache: Optional["DomainCache"] = None):
+    """Vertex coordinates, cells, dof coordinates and vertex-to-dof map of a
+    scalar CG1-space. They are read from the (memory-mapped) domain cache of the
+    mesh if given, instead of computed from the function space."""
+    if domain_cache is not None:
+        return (
+            domain_cache.coordinates,
+            domain_cache.cells,
+            domain_cache.dof_coordinates,
+            domain_cache.vertex_to_dof,
+        )
+    mesh = functionspace.mesh()
+    return (
+        mesh.coordinates(),
+        mesh.cells(),
+        functionspace.tabulate_dof_coordinates(),
+        df.vertex_to_dof_map(functionspace),
+    )
+
+
+def patch_average_operator(
+    coordinates: numpy.ndarray,
+    cells: numpy.ndarray,
+    vertex_to_dof: numpy.ndarray,
+    num_owned_dofs: int,
+) -> scipy.sparse.csr_matrix:
+    """Volume-weighted average over the cells in the support of each P1 basis
+    function, mapping cell values to the owned degrees of freedom."""
+    vertices = coordinates[cells]
+    volumes = numpy.abs(numpy.linalg.det(vertices[:, 1:] - vertices[:, :1])) / 6.0
+    patches = scipy.sparse.csr_matrix(
+        (
+            numpy.repeat(volumes, cells.shape[1]),
+            (cells.ravel(), numpy.repeat(numpy.arange(len(cells)), cells.shape[1])),
+        ),
+        shape=(coordinates.shape[0], len(cells)),
+    )
+    patches = scipy.sparse.diags(1.0 / numpy.asarray(patches.sum(axis=1)).ravel()) @ patches
+    dof_to_vertex = numpy.empty_like(vertex_to_dof)
+    dof_to_vertex[vertex_to_dof] = numpy.arange(vertex_to_dof.size)
+    return patches[dof_to_vertex[:num_owned_dofs]].tocsr()
+
+
+def create_sampler(
+    functionspace,
+    mri_volume,
+    method="nearest",
+    domain_cache: Optional["DomainCache"] = None,
+) -> ImageSampler:
+    """Creates an image sampler for the degrees of freedom of the function space.
+    'nearest' and 'trilinear' samples the image in the dof-coordinates, while
+    'average' samples the image trilinearly in the cell midpoints, and averages
+    over the support of each (P1) basis function to account for partial volumes.
+    The domain cache of the mesh may only be given for scalar CG1-spaces."""
+    vox2ras = mri_volume.header.get_vox2ras_tkr()
+    shape = tuple(mri_volume.shape)
+    if domain_cache is not None and not is_p1(functionspace):
+        raise ValueError("The domain cache only holds the arrays of scalar CG1-spaces.")
+    if method == "average":
+        if not is_p1(functionspace):
+            raise ValueError("Cell-averaged sampling requires a scalar CG1-space.")
+        coordinates, cells, _, vertex_to_dof = p1_arrays(functionspace, domain_cache)
+        first, last = functionspace.dofmap().ownership_range()
+        midpoints = coordinates[cells].mean(axis=1)
+        operator = patch_average_operator(
+            coordinates, cells, vertex_to_dof, last - first
+        ) @ point_sampling_operator(midpoints, vox2ras, shape, "trilinear")
+    else:
+        if domain_cache is not None:
+            xyz = domain_cache.dof_coordinates
+        else:
+            xyz = functionspace.tabulate_dof_coordinates()
+        operator = point_sampling_operator(xyz, vox2ras, shape, method)
+    return ImageSampler(operator.tocsr(), vox2ras, shape)
+
+
+def sampler_cache_path(meshfile: Path, functionspace, mri_volume, method: str) -> Path:
+    sha = hashlib.sha256(file_hash(meshfile).encode())
+    sha.update(str(functionspace.ufl_element()).encode())
+    sha.update(numpy.ascontiguousarray(mri_volume.header.get_vox2ras_tkr()).tobytes())
+    sha.update(str(tuple(mri_volume.shape)).encode())
+    sha.update(method.encode())
+    # The sampler maps to the locally owned dofs, which depend on the partition.
+    comm = df.MPI.comm_world
+    if comm.size > 1:
+        sha.update(f"{comm.rank}/{comm.size}".encode())
+    return meshfile.parent / f"{meshfile.stem}_sampler_{sha.hexdigest()[:16]}.npz"
+
+
+def cached_sampler(
+    meshfile: Path,
+    functionspace,
+    mri_volume,
+    method="nearest",
+    domain_cache: Optional["DomainCache"] = None,
+) -> ImageSampler:
+    """Loads the image sampler stored next to the meshfile, or creates and stores
+    it if no sampler for this mesh, image grid and method exists."""
+    cachefile = sampler_cache_path(Path(meshfile), functionspace, mri_volume, method)
+    if cachefile.exists():
+        logger.info(f"Loading image sampler from {cachefile}")
+        return ImageSampler.load(cachefile)
+    sampler = create_sampler(functionspace, mri_volume, method, domain_cache)
+    logger.info(f"Storing image sampler to {cachefile}")
+    sampler.save(cachefile)
+    return sampler
+
+
+def read_image(
+    filename, functionspace, data_filter=None, sampler: Optional[ImageSampler] = None
+):
     mri_volume = nibabel.load(filename)
     voxeldata = mri_volume.get_fdata()
 
     c_data = df.Function(functionspace, name="concentration")
+    if data_filter is None:
+        if sampler is None:
+            sampler = create_sampler(functionspace, mri_volume)
+        assert sampler.matches(
+            mri_volume
+        ), f"Image grid of {filename} differs from the image sampler."
+        assign_local(c_data, sample_image(voxeldata, sampler))
+        return c_data
+
     ras2vox_tkr_inv = numpy.linalg.inv(mri_volume.header.get_vox2ras_tkr())
 
     xyz = functionspace.tabulate_dof_coordinates()
     ijk = apply_affine(ras2vox_tkr_inv, xyz).T
     i, j, k = numpy.rint(ijk).astype("int")
 
-    if data_filter is not None:
-        voxeldata = data_filter(voxeldata, ijk, i, j, k)
-        c_data.vector()[:] = voxeldata[i, j, k]
-    else:
-        if numpy.where(numpy.isnan(voxeldata[i, j, k]), 1, 0).sum() > 0:
-            print(
-                "No filter used, setting",
-                numpy.where(numpy.isnan(voxeldata[i, j, k]), 1, 0).sum(),
-                "/",
-                i.size,
-                " nan voxels to 0",
-            )
-            voxeldata[i, j, k] = numpy.where(
-                numpy.isnan(voxeldata[i, j, k]), 0, voxeldata[i, j, k]
-            )
-        if numpy.where(voxeldata[i, j, k] < 0, 1, 0).sum() > 0:
-            print(
-                "No filter used, setting",
-                numpy.where(voxeldata[i, j, k] < 0, 1, 0).sum(),
-                "/",
-                i.size,
-                " voxels in mesh have value < 0",
-            )
+    voxeldata = data_filter(voxeldata, ijk, i, j, k)
+    assign_local(c_data, voxeldata[i, j, k])
+    return c_data
 
-        c_data.vector()[:] = voxeldata[i, j, k]
 
-    return c_data
+def sample_image(voxeldata: numpy.ndarray, sampler: ImageSampler) -> numpy.ndarray:
+    isnan = numpy.isnan(voxeldata)
+    num_nan = (sampler(isnan) > 0).sum()
+    if num_nan > 0:
+        print(
+            "No filter used, setting",
+            num_nan,
+            "/",
+            sampler.operator.shape[0],
+            " nan voxels to 0",
+        )
+        voxeldata = numpy.where(isnan, 0, voxeldata)
+    values = sampler(voxeldata)
+    if (values < 0).sum() > 0:
+        print(
+            "No filter used, setting",
+            (values < 0).sum(),
+            "/",
+            values.size,
+            " voxels in mesh have value < 0",
+        )
+    return values
 
 
 def image_timestamp(p: Path) -> datetime.datetime:
@@ -74,30 +277,24 @@ def fenicsstorage2xdmf(filepath, funcname: str, subnames: str | List[str]) -> No
     file.close()
 
 
-if __name__ == "__main__":
-    import argparse
-    from pathlib import Path
-
-    from pantarei.fenicsstorage import FenicsStorage
-    from parkrec.mriprocessing.meshprocessing import hdf2fenics
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("patientid", help="PatientID on the form PAT_XXX")
-    parser.add_argument("meshfile", type=str, help="Mesh to use.")
-    parser.add_argument("--concentrationdir", type=str, default="CONCENTRATIONS")
-    parser.add_argument("--femfamily", type=str, default="CG")
-    parser.add_argument("--femdegree", type=int, default=1)
-    args = parser.parse_args()
+def patient_concentrations_to_fenics(
+    patientdir: Path,
+    meshfile: Path,
+    concentrationdir: str = "CONCENTRATIONS",
+    femfamily: str = "CG",
+    femdegree: int = 1,
+    sampling: str = "nearest",
+) -> Path:
+    from parkrec.mriprocessing.meshprocessing import hdf2fenics, load_domain_cache
 
-    patientdir = Path("data") / args.patientid
-    meshfile = Path(args.meshfile)
+    meshfile = Path(meshfile)
+    mesh, _, _ = hdf2fenics(meshfile, cache=True)
 
-    mesh, _, _ = hdf2fenics(meshfile)
-
-    V = df.FunctionSpace(mesh, args.femfamily, args.femdegree)
+    V = df.FunctionSpace(mesh, femfamily, femdegree)
+    domain_cache = load_domain_cache(meshfile) if is_p1(V) else None
 
     output = patientdir / f"FENICS/data.hdf"
-    concentration_data = sorted((patientdir / args.concentrationdir).iterdir())  # [1:]
+    concentration_data = sorted((patientdir / concentrationdir).iterdir())  # [1:]
     outfile = FenicsStorage(str(output), "w")
     outfile.write_domain(mesh)
 
@@ -105,9 +302,36 @@ if __name__ == "__main__":
     injection_time_of_day = injection_timestamp(patientdir / "injection_time.txt")
     t0 = datetime.datetime.combine(start_date, injection_time_of_day)
 
+    sampler = cached_sampler(
+        meshfile, V, nibabel.load(concentration_data[0]), sampling, domain_cache
+    )
     for cfile in concentration_data:
-        c_data_fenics = read_image(filename=cfile, functionspace=V, data_filter=None)
+        c_data_fenics = read_image(filename=cfile, functionspace=V, sampler=sampler)
         ti = max(0, (image_timestamp(cfile) - t0).total_seconds())
         outfile.write_checkpoint(c_data_fenics, name="data", t=ti)
     outfile.close()
     fenicsstorage2xdmf(outfile.filepath, "data", "data")
+    return Path(outfile.filepath)
+
+
+if __name__ == "__main__":
+    import argparse
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("patientid", help="PatientID on the form PAT_XXX")
+    parser.add_argument("meshfile", type=str, help="Mesh to use.")
+    parser.add_argument("--concentrationdir", type=str, default="CONCENTRATIONS")
+    parser.add_argument("--femfamily", type=str, default="CG")
+    parser.add_argument("--femdegree", type=int, default=1)
+    parser.add_argument("--sampling", type=str, default="nearest", choices=SAMPLING_METHODS)
+    args = parser.parse_args()
+
+    patient_concentrations_to_fenics(
+        Path("data") / args.patientid,
+        Path(args.meshfile),
+        args.concentrationdir,
+        args.femfamily,
+        args.femdegree,
+        args.sampling,
+    )
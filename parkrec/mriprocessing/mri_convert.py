@@ -1,9 +1,10 @@
-import subprocess
 import logging
 
 from pathlib import Path
+from typing import Optional
 
-from multiframe_dicom import is_niifile
+from parkrec.filters import is_niifile
+from parkrec.jobs import Job, run_jobs
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -13,24 +14,34 @@ def patient_reconstruct(
     t1_raw_dir: Path,
     t2_raw_dir: Path,
     outputdir: Path,
+    cores: Optional[int] = None,
+    threads_per_job: int = 1,
 ):
     outputdir.mkdir(exist_ok=True, parents=False)
-
-    for file in filter(is_niifile, t1_raw_dir.iterdir()):
-        subprocess.run(
-            f"mri_convert --conform -odt float {file} {outputdir/f'{file.stem}'}.mgz",
-            shell=True,
-        )
+    logdir = outputdir.parent / "logs" / "mri_convert"
 
     try:
         t2 = next(filter(is_niifile, t2_raw_dir.iterdir()))
-        subprocess.run(
-            f"mri_convert --conform -odt float {t2} {outputdir / 'T2.mgz'}",
-            shell=True,
-        )
     except StopIteration:
         raise RuntimeError(f"No nii-file found in {t2_raw_dir}")
 
+    jobs = [
+        Job(
+            file.name,
+            f"mri_convert --conform -odt float {file} {outputdir/f'{file.stem}'}.mgz",
+            logdir / file.with_suffix(".log").name,
+        )
+        for file in filter(is_niifile, t1_raw_dir.iterdir())
+    ]
+    jobs.append(
+        Job(
+            t2.name,
+            f"mri_convert --conform -odt float {t2} {outputdir / 'T2.mgz'}",
+            logdir / "T2.log",
+        )
+    )
+    run_jobs(jobs, cores=cores, threads_per_job=threads_per_job)
+
 
 if __name__ == "__main__":
     import argparse
@@ -38,6 +49,8 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("patientid", help="Patient ID on the form PAT_XXX")
+    parser.add_argument("--cores", type=int, default=None, help="Core budget.")
+    parser.add_argument("--threads", type=int, default=1, help="Threads per job.")
     args = parser.parse_args()
     paths = patient_data_settings(patientid=args.patientid)
 
@@ -45,4 +58,6 @@ if __name__ == "__main__":
         paths.t1raw,
         paths.t2,
         paths.resampled,
+        cores=args.cores,
+        threads_per_job=args.threads,
     )
@@ -2,9 +2,10 @@ import subprocess
 import logging
 
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, Optional
 
 from parkrec.filters import is_T1_mgz
+from parkrec.jobs import Job, run_jobs
 
 
 logger = logging.getLogger(__name__)
@@ -47,10 +48,14 @@ def patient_register(
     input_dir: Path,
     registered_dir: Path,
     template: Path,
-    lta_dir: Path
+    lta_dir: Path,
+    cores: Optional[int] = None,
+    threads_per_job: int = 1,
 ) -> Path:
     lta_dir.mkdir(exist_ok=True)
+    registered_dir.mkdir(exist_ok=True)
     volumes = sorted(filter(is_T1_mgz, input_dir.iterdir()))
+    jobs = []
     for volume in volumes:
         register_command = (
             f"mri_robust_register"
@@ -63,9 +68,12 @@ def patient_register(
             +  " --maxit 10"
         )
         logger.info(register_command)
-        subprocess.run(register_command, shell=True).check_returncode()
+        logfile = lta_dir.parent / "logs" / "mri_register" / volume.with_suffix(".log").name
+        jobs.append(Job(volume.name, register_command, logfile))
+    run_jobs(jobs, cores=cores, threads_per_job=threads_per_job)
     return registered_dir
 
+
 if __name__ == "__main__":
     import argparse
     from parkrec.settings import patient_data_settings
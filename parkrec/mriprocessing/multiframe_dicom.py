@@ -3,6 +3,8 @@ import logging
 import re
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
@@ -18,6 +20,14 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 
+@dataclass
+class Conversion:
+    studydir: Path
+    sequencedir: Path
+    outputdir: Path
+    label: str
+
+
 def patient_dicom2nii(
     dicom_patientdir: Path,
     t1dir: Path,
@@ -25,44 +35,146 @@ def patient_dicom2nii(
     looklockerdir: Path,
     patterns: dict[str, str],
     dtidir: Optional[Path] = None,
+    n_jobs: Optional[int] = None,
 ):
+    conversions = plan_patient_conversions(
+        dicom_patientdir, t1dir, t2dir, looklockerdir, patterns, dtidir
+    )
+    return run_conversions(conversions, n_jobs)
+
+
+def plan_patient_conversions(
+    dicom_patientdir: Path,
+    t1dir: Path,
+    t2dir: Path,
+    looklockerdir: Path,
+    patterns: dict[str, str],
+    dtidir: Optional[Path] = None,
+) -> list[Conversion]:
+    conversions = []
     for idx, studydir in enumerate(study_iterator(dicom_patientdir)):
-        dicom2nii(studydir, t1dir, "T1", patterns["T1"])
-        dicom2nii(studydir, looklockerdir, "LookLocker", patterns["LookLocker"])
+        targets = [(t1dir, "T1"), (looklockerdir, "LookLocker")]
         if idx == 0:
-            dicom2nii(studydir, t2dir, "T2", patterns["T2"])
+            targets.append((t2dir, "T2"))
         if dtidir is not None:
             raise NotImplementedError("Need to find correct DTI sequence.")
+        for outputdir, label in targets:
+            path = find_dicom_sequence_dir(studydir, patterns[label])
+            conversions.append(Conversion(studydir, path, Path(outputdir), label))
+    return conversions
+
+
+def plan_batch_conversions(patientids: list[str]) -> list[Conversion]:
+    conversions = []
+    for patientid in patientids:
+        paths = patient_data_settings(patientid=patientid)
+        conversions += plan_patient_conversions(
+            paths.dicompath,
+            paths.t1raw,
+            paths.t2,
+            paths.looklocker,
+            DICOMSettings(paths=paths).patterns,
+        )
+    return conversions
+
+
+def run_conversions(
+    conversions: list[Conversion], n_jobs: Optional[int] = None, force: bool = False
+) -> list[Path]:
+    """Runs the conversions concurrently, skipping those that have already been
+    converted unless `force` is given."""
+    if not force:
+        conversions = [c for c in conversions if not is_converted(c)]
+    logger.info(f"Running {len(conversions)} DICOM conversions.")
+    with ThreadPoolExecutor(n_jobs) as executor:
+        results = executor.map(
+            lambda c: convert_sequence(c.studydir, c.sequencedir, c.outputdir, c.label),
+            conversions,
+        )
+        return [nii_file for files in results for nii_file in files]
+
+
+def series_uid(sequencedir: Path) -> str:
+    dicomfile = next(p for p in sorted((sequencedir / "DICOM").iterdir()) if p.is_file())
+    with pydicom.dcmread(
+        dicomfile, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"]
+    ) as f:
+        return str(f.SeriesInstanceUID)
+
+
+def conversion_sidecar(outputdir: Path, uid: str) -> Path:
+    return outputdir / f".{uid}.converted.json"
+
+
+def is_converted(conversion: Conversion) -> bool:
+    """Checks whether the conversion sidecar of the series exists, which is
+    written once all output files of the series are in place, and that the
+    files it lists still exist."""
+    sidecar = conversion_sidecar(conversion.outputdir, series_uid(conversion.sequencedir))
+    if not sidecar.exists():
+        return False
+    with open(sidecar) as f:
+        outputs = json.load(f)["outputs"]
+    if not all((conversion.outputdir / name).exists() for name in outputs):
+        return False
+    logger.info(f"Skipping {conversion.sequencedir}, already converted.")
+    return True
 
 
 def dicom2nii(dicom_studydir: Path, outputdir: Path, label: str, pattern: str):
+    path = find_dicom_sequence_dir(dicom_studydir, pattern)
+    return convert_sequence(dicom_studydir, path, outputdir, label)
+
+
+def convert_sequence(
+    dicom_studydir: Path, path: Path, outputdir: Path, label: str
+) -> list[Path]:
     outputdir.mkdir(exist_ok=True, parents=True)
     tempdir = Path(f"/tmp/parkrec_convert-{dicom_studydir.stem}-{uuid4()}")
     tempdir.mkdir()
-
-    path = find_dicom_sequence_dir(dicom_studydir, pattern)
-    cmd = (
-        "dcm2niix"
-        + f" -f {label}"
-        + f" -o '{tempdir}'"
-        + f" '{path}/DICOM'"
-        + f" 1>> '{tempdir}/log.txt'"
-    )
-    logger.info(f"Running conversion command: {cmd}")
-    subprocess.run(cmd, shell=True).check_returncode()
-
-    for nii_file in filter(is_niifile, tempdir.iterdir()):
-        datedir = dicom_studydir.parent
-        with open(nii_file.with_suffix(".json")) as f:
-            info = json.load(f)
-        timestamp = datetime.strptime(info["AcquisitionTime"], "%H:%M:%S.%f").strftime(
-            "%H%M%S"
+    try:
+        cmd = (
+            "dcm2niix"
+            + f" -f {label}"
+            + f" -o '{tempdir}'"
+            + f" '{path}/DICOM'"
+            + f" 1>> '{tempdir}/log.txt'"
         )
-        outputname = f"{datedir.stem.replace('_', '')}_{timestamp}"
-        if "LookLocker" in nii_file.stem:
-            outputname += f"_t{info['TriggerDelayTime']}"
-
-        nii_file.rename(outputdir / f"{outputname}.nii")
+        logger.info(f"Running conversion command: {cmd}")
+        subprocess.run(cmd, shell=True).check_returncode()
+
+        uid = series_uid(path)
+        outputs = []
+        for nii_file in filter(is_niifile, tempdir.iterdir()):
+            datedir = dicom_studydir.parent
+            with open(nii_file.with_suffix(".json")) as f:
+                info = json.load(f)
+            timestamp = datetime.strptime(
+                info["AcquisitionTime"], "%H:%M:%S.%f"
+            ).strftime("%H%M%S")
+            outputname = f"{datedir.stem.replace('_', '')}_{timestamp}"
+            if "LookLocker" in nii_file.stem:
+                outputname += f"_t{info['TriggerDelayTime']}"
+
+            nii_file.rename(outputdir / f"{outputname}.nii")
+            with open(outputdir / f"{outputname}.json", "w") as f:
+                json.dump({**info, "SeriesInstanceUID": uid}, f, indent=4)
+            outputs.append(outputdir / f"{outputname}.nii")
+
+        # Marks the series as converted only after all of its files are written,
+        # such that an interrupted conversion is rerun.
+        sidecar = conversion_sidecar(outputdir, uid)
+        tmp = sidecar.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(
+                {"SeriesInstanceUID": uid, "outputs": [p.name for p in outputs]},
+                f,
+                indent=4,
+            )
+        tmp.rename(sidecar)
+    finally:
+        shutil.rmtree(tempdir)
+    return outputs
 
 
 def find_dicom_sequence_dir(dicom_studydir: Path, pattern: str) -> Path:
@@ -94,30 +206,47 @@ def study_iterator(dicom_patientdir: Path) -> list[Path]:
 if __name__ == "__main__":
     from argparse import ArgumentParser
 
+    from parkrec.settings import Settings
+
     patient_parser = ArgumentParser()
     patient_parser.add_argument(
-        "patientid", type=str, help="Patient ID on format PAT_XXX"
+        "patientids", type=str, nargs="*", help="Patient IDs on format PAT_XXX"
     )
-    patient_args, remaining_args = patient_parser.parse_known_args()
-    paths = patient_data_settings(patientid=patient_args.patientid)
-    settings = DICOMSettings(paths=paths)
-
-    """Possible to override defaults."""
-    parser = ArgumentParser()
-    parser.add_argument("--dicomdir", type=str, default=paths.dicompath)
-    parser.add_argument("--t1_outputdir", type=str, default=paths.t1raw)
-    parser.add_argument("--t2_outputdir", type=str, default=paths.t2)
-    parser.add_argument("--ll_outputdir", type=str, default=paths.looklocker)
-    args = parser.parse_args(remaining_args)
-
-    patient_dicom2nii(
-        dicom_patientdir=args.dicomdir,
-        t1dir=args.t1_outputdir,
-        t2dir=args.t2_outputdir,
-        looklockerdir=args.ll_outputdir,
-        patterns=settings.patterns,
+    patient_parser.add_argument(
+        "--all", action="store_true", help="Convert all patients in the GRIP-folder."
+    )
+    patient_parser.add_argument("--n_jobs", type=int, default=None)
+    patient_parser.add_argument(
+        "--force", action="store_true", help="Reconvert already converted sequences."
     )
+    patient_args, remaining_args = patient_parser.parse_known_args()
+    if not patient_args.patientids and not patient_args.all:
+        patient_parser.error("Give one or more patient IDs, or --all.")
+    patientids = patient_args.patientids
+    if patient_args.all:
+        patientids = sorted(
+            p.name for p in Settings().rawdata.iterdir() if re.match(r"PAT_\d{3}$", p.name)
+        )
+
+    if len(patientids) == 1:
+        paths = patient_data_settings(patientid=patientids[0])
+        settings = DICOMSettings(paths=paths)
+
+        """Possible to override defaults."""
+        parser = ArgumentParser()
+        parser.add_argument("--dicomdir", type=Path, default=paths.dicompath)
+        parser.add_argument("--t1_outputdir", type=Path, default=paths.t1raw)
+        parser.add_argument("--t2_outputdir", type=Path, default=paths.t2)
+        parser.add_argument("--ll_outputdir", type=Path, default=paths.looklocker)
+        args = parser.parse_args(remaining_args)
+        conversions = plan_patient_conversions(
+            dicom_patientdir=args.dicomdir,
+            t1dir=args.t1_outputdir,
+            t2dir=args.t2_outputdir,
+            looklockerdir=args.ll_outputdir,
+            patterns=settings.patterns,
+        )
+    else:
+        conversions = plan_batch_conversions(patientids)
 
-    for path in Path("/tmp").iterdir():
-        if "parkrec_convert" in path.stem:
-            shutil.rmtree(path)
+    run_conversions(conversions, n_jobs=patient_args.n_jobs, force=patient_args.force)
@@ -23,17 +23,52 @@ ANSORGE_T1_TIMES = {
 }
 
 
+def integer_labels(aseg: np.ndarray) -> np.ndarray:
+    """Segmentation labels as integers, usable as indices into a lookup-table.
+    NaN-voxels are treated as unlabeled (0)."""
+    if np.issubdtype(aseg.dtype, np.integer):
+        return aseg
+    return np.where(np.isnan(aseg), 0, aseg).astype(int)
+
+
+def label_lut(
+    groups: dict[str, list[int]],
+    values: dict[str, float | bool],
+    fill: float | bool = np.nan,
+    size: int = 0,
+) -> np.ndarray:
+    """Lookup-table with one entry per label, where the labels of each group
+    are assigned the group value. Later groups take precedence."""
+    size = max(size, 1 + max(label for key in values for label in groups[key]))
+    lut = np.full(size, fill)
+    for key, value in values.items():
+        lut[groups[key]] = value
+    return lut
+
+
+def apply_lut(aseg: np.ndarray, lut: np.ndarray, fill: float | bool) -> np.ndarray:
+    """Look up the value of each voxel label, using `fill` for labels beyond the
+    end of the table."""
+    labels = integer_labels(aseg)
+    if labels.max() >= lut.size:
+        lut = np.concatenate((lut, np.full(labels.max() + 1 - lut.size, fill)))
+    return lut[labels]
+
+
 def label_mask(aseg, labels: list[int]):
-    return sum([aseg == i for i in labels]) == 1
+    return apply_lut(aseg, label_lut({"mask": labels}, {"mask": True}, fill=False), False)
 
 
 def base_mask(aseg: np.array):
     return np.logical_and(~np.isnan(aseg), aseg != 0)
 
 
-def brain_mask(aseg: np.array, refine: bool = False):
-    mask = base_mask(aseg)
-    mask = remove_csf(mask, aseg, None, replacement_value=False)
+def brain_mask(aseg: np.array, refine: bool = False, csf_labels: Optional[list[int]] = None):
+    if csf_labels is None:
+        csf_labels = seg_groups.default_segmentation_groups()["csf"]
+    lut = label_lut({"csf": csf_labels}, {"csf": False}, fill=True)
+    lut[0] = False
+    mask = apply_lut(aseg, lut, True)
     if refine:
         mask = skimage.morphology.remove_small_objects(mask, 50, connectivity=2)
         mask = skimage.morphology.remove_small_holes(mask, 5, connectivity=2)
@@ -62,22 +97,30 @@ def create_t1_map(
     default_t1: float,
     dropcsf: bool = True,
     labels: Optional[dict[str, list[int]]] = None,
+    mask: Optional[np.ndarray] = None,
 ) -> np.ndarray:
+    """Assigns the values in `times` to the label groups, and `default_t1` to
+    any other voxel in the brain mask, using a single lookup into a table of
+    values per label. A precomputed (refined) brain mask may be supplied."""
     if labels is None:
         labels = {
             key: val
             for key, val in seg_groups.default_segmentation_groups().items()
             if key in times
         }
-    mask = brain_mask(aseg, refine=True)
-    im = np.where(mask, default_t1, np.nan)
-    for label, t1 in times.items():
-        mask = label_mask(aseg, labels[label])
-        im = np.where(mask, t1, im)
-
+    if mask is None:
+        mask = brain_mask(aseg, refine=True)
+    lut = label_lut(labels, times)
+    use_default = np.isnan(lut)
     if dropcsf:
-        im = remove_csf(im, aseg, csf_labels=labels["csf"])
-    return im
+        lut[labels["csf"]] = np.nan
+        use_default[labels["csf"]] = False
+    labels = integer_labels(aseg)
+    return np.where(
+        apply_lut(labels, use_default, True) & mask,
+        default_t1,
+        apply_lut(labels, lut, np.nan),
+    )
 
 
 def replace_nan(data: np.ndarray, value: float | int | bool) -> np.ndarray:
@@ -105,9 +148,43 @@ def t1map_image(aseg_file: Path, output: Path) -> Path:
     return Path(output)
 
 
-def create_segmentation(aseg):
+def create_segmentation(aseg, mask: Optional[np.ndarray] = None):
     seg_numbering = {"csf": -1, "white-matter": 1, "gray-matter": 2, "brainstem": 3}
-    return create_t1_map(aseg, seg_numbering, default_t1=0)
+    return create_t1_map(aseg, seg_numbering, default_t1=0, mask=mask)
+
+
+def aseg_volumes(
+    aseg: np.ndarray, times: Optional[dict[str, float]] = None
+) -> dict[str, np.ndarray]:
+    """Creates the T1 map, brain mask and segmentation from a segmentation,
+    refining the brain mask only once."""
+    if times is None:
+        times = {key: val.to("ms").magnitude for key, val in ANSORGE_T1_TIMES.items()}
+    refined = brain_mask(aseg, refine=True)
+    csf = label_mask(aseg, seg_groups.default_segmentation_groups()["csf"])
+    t1map = create_t1_map(aseg, times, times["white-matter"], dropcsf=True, mask=refined)
+    return {
+        "t1map": replace_nan(t1map, 0.0),
+        "brainmask": refined & ~csf,
+        "segmentation": create_segmentation(aseg, mask=refined),
+    }
+
+
+def aseg_images(
+    aseg_file: Path,
+    outputs: dict[str, Path],
+    times: Optional[dict[str, float]] = None,
+) -> dict[str, Path]:
+    """Loads the segmentation once, and writes the derived volumes
+    ('t1map', 'brainmask' and/or 'segmentation') to the given output paths."""
+    aseg = nibabel.load(aseg_file)
+    volumes = aseg_volumes(np.asarray(aseg.dataobj).astype(int), times)
+    for key, output in outputs.items():
+        if key == "brainmask":
+            np.save(output.with_suffix(".npy"), volumes[key])
+        data = volumes[key].astype(float)
+        nibabel.save(nibabel.Nifti2Image(data, aseg.affine), output)
+    return {key: Path(output) for key, output in outputs.items()}
 
 
 if __name__ == "__main__":
@@ -119,5 +196,10 @@ if __name__ == "__main__":
 
     paths = patient_data_settings(args.patientid)
     aseg = paths.patient_root / "mri/aseg.mgz"
-    t1map_image(aseg_file=aseg, output=paths.patient_root / "t1map.mgz")
-    mask_image(aseg_file=aseg, output=paths.patient_root / "brainmask.mgz")
+    aseg_images(
+        aseg,
+        {
+            "t1map": paths.patient_root / "t1map.mgz",
+            "brainmask": paths.patient_root / "brainmask.mgz",
+        },
+    )
@@ -0,0 +1,312 @@
+"""In-process pipeline runner. Each stage declares its input and output paths,
+and stages depend on each other through these paths. The content hashes of
+the inputs and the stage parameters are stored in a manifest, and stages
+whose inputs and parameters are unchanged since the last run are skipped."""
+import hashlib
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from parkrec.settings import DICOMSettings, PatientDataSettings, patient_data_settings
+from parkrec.utils import file_hash
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable[..., Any]
+    inputs: list[Path]
+    outputs: list[Path]
+    manifest: Path
+    params: dict[str, Any] = field(default_factory=dict)
+
+    def depends_on(self, other: "Stage") -> bool:
+        return any(
+            is_relative_to(inp, out) for inp in self.inputs for out in other.outputs
+        )
+
+    def run(self):
+        return self.func(**self.params)
+
+
+def is_relative_to(path: Path, other: Path) -> bool:
+    return path == other or other in path.parents
+
+
+def input_files(path: Path) -> list[Path]:
+    if path.is_dir():
+        return sorted(p for p in path.rglob("*") if p.is_file())
+    if path.exists():
+        return [path]
+    raise FileNotFoundError(f"Missing input {path}")
+
+
+class Manifest:
+    """JSON-file storing the key of each completed stage, and the content hash
+    of each input file. File hashes are only recomputed if the size or
+    modification time of the file has changed."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.data = {"stages": {}, "files": {}}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.data = json.load(f)
+
+    def file_hash(self, path: Path) -> str:
+        stat = path.stat()
+        entry = self.data["files"].get(str(path))
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha": file_hash(path)}
+            self.data["files"][str(path)] = entry
+        return entry["sha"]
+
+    def stage_key(self, stage: Stage) -> str:
+        sha = hashlib.sha256()
+        sha.update(f"{stage.func.__module__}.{stage.func.__qualname__}".encode())
+        sha.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+        for inp in stage.inputs:
+            for path in input_files(inp):
+                sha.update(str(path).encode())
+                sha.update(self.file_hash(path).encode())
+        return sha.hexdigest()
+
+    def is_up_to_date(self, stage: Stage, key: str) -> bool:
+        return self.data["stages"].get(stage.name) == key and all(
+            out.exists() for out in stage.outputs
+        )
+
+    def update(self, stage: Stage, key: str):
+        self.data["stages"][stage.name] = key
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        with open(self.path, "w") as f:
+            json.dump(self.data, f, indent=4)
+
+
+def run_stages(
+    stages: list[Stage], max_workers: Optional[int] = None, force: bool = False
+) -> dict[str, str]:
+    """Runs the stages in a process pool, as soon as all stages they depend on
+    have completed. Returns the status ('done', 'skipped', 'failed' or
+    'cancelled') of each stage."""
+    dependencies = {
+        s.name: [t.name for t in stages if t is not s and s.depends_on(t)]
+        for s in stages
+    }
+    manifests = {}
+    status = {}
+    pending = {s.name: s for s in stages}
+    running = {}
+    with ProcessPoolExecutor(max_workers) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                deps = [status.get(dep) for dep in dependencies[name]]
+                if any(dep in ("failed", "cancelled") for dep in deps):
+                    logger.error(f"Cancelling '{name}' due to failed dependencies.")
+                    status[name] = "cancelled"
+                    pending.pop(name)
+                elif all(dep in ("done", "skipped") for dep in deps):
+                    manifest = manifests.setdefault(stage.manifest, Manifest(stage.manifest))
+                    try:
+                        key = manifest.stage_key(stage)
+                    except FileNotFoundError as e:
+                        logger.error(f"Stage '{name}' failed: {e}")
+                        status[name] = "failed"
+                        pending.pop(name)
+                        continue
+                    pending.pop(name)
+                    if not force and manifest.is_up_to_date(stage, key):
+                        logger.info(f"Stage '{name}' is up to date.")
+                        status[name] = "skipped"
+                        continue
+                    logger.info(f"Running stage '{name}'")
+                    running[executor.submit(stage.run)] = (stage, manifest, key)
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, manifest, key = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Stage '{stage.name}' failed: {e!r}")
+                    status[stage.name] = "failed"
+                    continue
+                manifest.update(stage, key)
+                status[stage.name] = "done"
+                logger.info(f"Stage '{stage.name}' finished.")
+    return status
+
+
+def dicom2nii(patientid: str):
+    from parkrec.mriprocessing.multiframe_dicom import patient_dicom2nii
+
+    paths = patient_data_settings(patientid)
+    patient_dicom2nii(
+        paths.dicompath,
+        paths.t1raw,
+        paths.t2,
+        paths.looklocker,
+        DICOMSettings(paths=paths).patterns,
+    )
+
+
+def mri_convert(patientid: str):
+    from parkrec.mriprocessing.mri_convert import patient_reconstruct
+
+    paths = patient_data_settings(patientid)
+    patient_reconstruct(paths.t1raw, paths.t2, paths.resampled)
+
+
+def mri_register(patientid: str):
+    from parkrec.mriprocessing.mri_register import patient_create_template
+
+    paths = patient_data_settings(patientid)
+    patient_create_template(
+        paths.resampled, paths.registered / "template.mgz", paths.lta, paths.registered
+    )
+
+
+def t1maps(patientid: str):
+    from parkrec.mriprocessing.t1maps import aseg_images
+
+    paths = patient_data_settings(patientid)
+    aseg_images(
+        paths.patient_root / "mri/aseg.mgz",
+        {
+            "t1map": paths.patient_root / "t1map.mgz",
+            "brainmask": paths.patient_root / "brainmask.mgz",
+        },
+    )
+
+
+def normalize(patientid: str):
+    from parkrec.mriprocessing.normalize_images import normalize_subject_images
+
+    normalize_subject_images(patient_data_settings(patientid).patient_root)
+
+
+def estimatec(patientid: str, n_jobs: Optional[int] = None):
+    from parkrec.filters import is_T1_mgz
+    from parkrec.mriprocessing.estimatec import estimate_concentrations
+
+    paths = patient_data_settings(patientid)
+    paths.concentrations.mkdir(exist_ok=True)
+    estimate_concentrations(
+        sorted(filter(is_T1_mgz, paths.normalized.iterdir())),
+        paths.concentrations,
+        t1map=paths.patient_root / "t1map.mgz",
+        mask=paths.patient_root / "brainmask.mgz",
+        n_jobs=n_jobs,
+    )
+
+
+def mesh_generation(patientid: str, resolution: int):
+    from parkrec.mriprocessing.mesh_generation import create_patient_mesh
+
+    create_patient_mesh(patient_data_settings(patientid).patient_root, resolution)
+
+
+def mri2fenics(patientid: str, resolution: int):
+    from parkrec.mriprocessing.mri2fenics import patient_concentrations_to_fenics
+
+    paths = patient_data_settings(patientid)
+    patient_concentrations_to_fenics(
+        paths.patient_root, paths.patient_root / f"MESH/brain{resolution}.hdf"
+    )
+
+
+def manifest_path(paths: PatientDataSettings) -> Path:
+    return paths.patient_root / "pipeline.json"
+
+
+def preprocessing_stages(patientid: str) -> list[Stage]:
+    paths = patient_data_settings(patientid)
+    manifest = manifest_path(paths)
+    return [
+        Stage(
+            f"{patientid}/dicom2nii",
+            dicom2nii,
+            inputs=[paths.dicompath],
+            outputs=[paths.t1raw, paths.t2, paths.looklocker],
+            params={"patientid": patientid},
+            manifest=manifest,
+        ),
+        Stage(
+            f"{patientid}/mri_convert",
+            mri_convert,
+            inputs=[paths.t1raw, paths.t2],
+            outputs=[paths.resampled],
+            params={"patientid": patientid},
+            manifest=manifest,
+        ),
+        Stage(
+            f"{patientid}/mri_register",
+            mri_register,
+            inputs=[paths.resampled],
+            outputs=[paths.registered, paths.lta],
+            params={"patientid": patientid},
+            manifest=manifest,
+        ),
+    ]
+
+
+def concentration_stages(
+    patientid: str, resolution: int = 32, n_jobs: Optional[int] = None
+) -> list[Stage]:
+    """Stages following the FreeSurfer reconstruction."""
+    paths = patient_data_settings(patientid)
+    root = paths.patient_root
+    manifest = manifest_path(paths)
+    meshfile = root / f"MESH/brain{resolution}.hdf"
+    return [
+        Stage(
+            f"{patientid}/t1maps",
+            t1maps,
+            inputs=[root / "mri/aseg.mgz"],
+            outputs=[root / "t1map.mgz", root / "brainmask.mgz"],
+            params={"patientid": patientid},
+            manifest=manifest,
+        ),
+        Stage(
+            f"{patientid}/normalize",
+            normalize,
+            inputs=[paths.registered, root / "refroi.nii"],
+            outputs=[paths.normalized],
+            params={"patientid": patientid},
+            manifest=manifest,
+        ),
+        Stage(
+            f"{patientid}/estimatec",
+            estimatec,
+            inputs=[paths.normalized, root / "t1map.mgz", root / "brainmask.mgz"],
+            outputs=[paths.concentrations],
+            params={"patientid": patientid, "n_jobs": n_jobs},
+            manifest=manifest,
+        ),
+        Stage(
+            f"{patientid}/mesh_generation{resolution}",
+            mesh_generation,
+            inputs=[
+                *(root / "surf" / s for s in ("lh.pial", "rh.pial", "lh.white", "rh.white")),
+                root / "mri/wmparc.mgz",
+            ],
+            outputs=[meshfile],
+            params={"patientid": patientid, "resolution": resolution},
+            manifest=manifest,
+        ),
+        Stage(
+            f"{patientid}/mri2fenics{resolution}",
+            mri2fenics,
+            inputs=[paths.concentrations, meshfile, root / "injection_time.txt"],
+            outputs=[paths.fenics / "data.hdf"],
+            params={"patientid": patientid, "resolution": resolution},
+            manifest=manifest,
+        ),
+    ]
@@ -1,59 +1,182 @@
+import hashlib
 import json
 import shutil
+import sqlite3
 from datetime import datetime
-from functools import partial
 from itertools import chain, repeat
 from multiprocessing.pool import Pool
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, Optional
 
 import pydicom
 
 
+def file_hash(filepath: Path, blocksize: int = 2**20) -> str:
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+DICOM_INDEX_TAGS = ["ProtocolName", "SeriesInstanceUID", "StudyTime", "SeriesTime"]
+
+
+def read_dicom_header(imfile: Path) -> dict[str, str]:
+    """Reads only the tags needed for the DICOM index, without pixel data."""
+    with pydicom.dcmread(
+        imfile, stop_before_pixels=True, specific_tags=DICOM_INDEX_TAGS
+    ) as f:
+        return {tag: str(getattr(f, tag, "")) for tag in DICOM_INDEX_TAGS}
+
+
+class DicomIndex:
+    """SQLite-index of the DICOM headers of the IM-files in a study. Files are
+    only reread if their size or modification time has changed."""
+
+    def __init__(self, index_file: Path):
+        index_file.parent.mkdir(exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(index_file)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            + "path TEXT PRIMARY KEY, offset INTEGER, size INTEGER, mtime INTEGER,"
+            + " protocol TEXT, series_uid TEXT, study_time TEXT, series_time TEXT)"
+        )
+
+    def stale_files(self, imfiles: list[tuple[Path, int]]) -> list[tuple[Path, int]]:
+        indexed = {
+            path: (size, mtime)
+            for path, size, mtime in self.connection.execute(
+                "SELECT path, size, mtime FROM files"
+            )
+        }
+        current = {str(imfile) for imfile, _ in imfiles}
+        self.connection.executemany(
+            "DELETE FROM files WHERE path = ?",
+            [(path,) for path in indexed if path not in current],
+        )
+        return [
+            (imfile, offset)
+            for imfile, offset in imfiles
+            if indexed.get(str(imfile)) != file_stat(imfile)
+        ]
+
+    def update(self, imfiles: list[tuple[Path, int]], headers: list[dict[str, str]]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (str(imfile), offset, *file_stat(imfile), *(h[tag] for tag in DICOM_INDEX_TAGS))
+                for (imfile, offset), h in zip(imfiles, headers)
+            ],
+        )
+        self.connection.commit()
+
+    def records(self) -> list[tuple[Path, int, str, str]]:
+        """Returns (path, offset, protocol, study_time) for all indexed files,
+        sorted by path."""
+        return [
+            (Path(path), offset, protocol, study_time)
+            for path, offset, protocol, study_time in self.connection.execute(
+                "SELECT path, offset, protocol, study_time FROM files ORDER BY path"
+            )
+        ]
+
+    def close(self):
+        self.connection.close()
+
+
+def file_stat(path: Path) -> tuple[int, int]:
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+def default_index_dir(output_dir: Path) -> Path:
+    """Index directory next to the sorted output, and outside of it, since
+    every directory in the output is treated as a patient."""
+    output_dir = Path(output_dir)
+    return output_dir.parent / f".{output_dir.name}_dicom_index"
+
+
+def study_index_path(study_dir: Path, index_dir: Path) -> Path:
+    date_dir = study_dir.parent
+    return index_dir / date_dir.parent.stem / f"{date_dir.stem}_{study_dir.stem}.sqlite"
+
+
 def create_protocol_filemap(
-    input_dir: Path, output_dir: Path, sequences: dict[str, str], n_jobs=None
+    input_dir: Path,
+    output_dir: Path,
+    sequences: dict[str, str],
+    n_jobs=None,
+    index_dir: Optional[Path] = None,
+    chunksize: int = 256,
 ) -> dict[Path, Path]:
     """Runs through the folder structure with the MRI data we receive from the hospital, and creates a dictionary mapping a src-path sorts them according to
-    'patient - study_datetime - protocol'. Runs in parallel for each of the studies."""
-    pool = Pool(n_jobs)
-    task = partial(
-        create_study_filemap,
-        output_dir=output_dir,
-        sequences=sequences,
-    )
-    results = pool.map(task, study_iterator(input_dir))
-    return dict(chain(*(x.items() for x in results)))
+    'patient - study_datetime - protocol'. Headers of new or modified files are read in parallel in chunks of files,
+    and stored in one index per study."""
+    if index_dir is None:
+        index_dir = default_index_dir(output_dir)
+    studies = list(study_iterator(input_dir))
+    indices = [DicomIndex(study_index_path(study, index_dir)) for study in studies]
+    stale = [
+        index.stale_files(list(study_imfiles(study / "DICOM" / "DICOM")))
+        for study, index in zip(studies, indices)
+    ]
+    with Pool(n_jobs) as pool:
+        headers = pool.map(
+            read_dicom_header,
+            [imfile for files in stale for imfile, _ in files],
+            chunksize=chunksize,
+        )
+    filemap = {}
+    start = 0
+    for study, index, files in zip(studies, indices, stale):
+        index.update(files, headers[start : start + len(files)])
+        start += len(files)
+        filemap.update(study_filemap_from_index(study, output_dir, sequences, index))
+        index.close()
+    return filemap
 
 
 def create_study_filemap(
-    study_dir: Path, output_dir: Path, sequences: dict[str, str]
+    study_dir: Path,
+    output_dir: Path,
+    sequences: dict[str, str],
+    index_dir: Optional[Path] = None,
+) -> dict[Path, Path]:
+    if index_dir is None:
+        index_dir = default_index_dir(output_dir)
+    index = DicomIndex(study_index_path(study_dir, index_dir))
+    stale = index.stale_files(list(study_imfiles(study_dir / "DICOM" / "DICOM")))
+    index.update(stale, [read_dicom_header(imfile) for imfile, _ in stale])
+    filemap = study_filemap_from_index(study_dir, output_dir, sequences, index)
+    index.close()
+    return filemap
+
+
+def study_filemap_from_index(
+    study_dir: Path, output_dir: Path, sequences: dict[str, str], index: DicomIndex
 ) -> dict[Path, Path]:
     date_dir = study_dir.parent
     patient = date_dir.parent.stem
-    study_data = study_dir / "DICOM" / "DICOM"
     date = datetime.strptime(date_dir.stem, "%Y_%m_%d").strftime("%Y%m%d")
-    timestamp = find_timestamp(study_dir)
+    records = index.records()
+    first_imfile, _ = next(study_imfiles(study_dir / "DICOM" / "DICOM"))
+    timestamp = next(time for path, _, _, time in records if path == first_imfile)
     study_target = output_dir / patient / f"{date}_{timestamp}"
 
     filemap = {}
-    for imfile, offset in study_imfiles(study_data):
-        with pydicom.dcmread(imfile) as f:
-            file_protocol = f.ProtocolName
-            if file_protocol in sequences:
-                filemap[imfile] = (
-                    study_target
-                    / sequences[file_protocol]
-                    / renumber_imfile(imfile, offset)
-                )
+    for imfile, offset, file_protocol, _ in records:
+        if file_protocol in sequences:
+            filemap[imfile] = (
+                study_target / sequences[file_protocol] / renumber_imfile(imfile, offset)
+            )
     return filemap
 
 
 def find_timestamp(study_dir: Path) -> str:
     study_data_path = study_dir / "DICOM" / "DICOM"
     first_imfile, _ = next(study_imfiles(study_data_path))
-    with pydicom.dcmread(first_imfile) as f:
-        timestamp = f.StudyTime
-    return timestamp
+    return read_dicom_header(first_imfile)["StudyTime"]
 
 
 def study_imfiles(study_data_path: Path) -> Iterator[Path]:
@@ -106,8 +229,7 @@ def create_study_metadata(study_path: Path):
     for path in filter(lambda x: x.is_dir(), study_path.iterdir()):
         protocol_filelist = [p for p in path.iterdir() if is_imfile(p)]
         label_list = [int(x.stem.split("_")[1]) for x in protocol_filelist]
-        with pydicom.dcmread(protocol_filelist[0]) as f:
-            timestamp = f.SeriesTime
+        timestamp = read_dicom_header(protocol_filelist[0])["SeriesTime"]
 
         study_metadata[path.stem] = {
             "min": min(label_list),
@@ -126,15 +248,38 @@ def store_study_metadata(study_path: Path) -> None:
 
 def add_sorted_metadata(output_dir: Path) -> None:
     reorganized_study_iterator = (
-        study for patient in output_dir.iterdir() for study in patient.iterdir()
+        study
+        for patient in output_dir.iterdir()
+        if patient.is_dir() and not patient.name.startswith(".")
+        for study in patient.iterdir()
+        if study.is_dir()
     )
     for study in reorganized_study_iterator:
         store_study_metadata(study)
 
 
 if __name__ == "__main__":
-    inputdir = Path("GRIP")
-    outputdir = Path("GRIP_SORTED")
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputdir", type=Path, default=Path("GRIP"))
+    parser.add_argument("--outputdir", type=Path, default=Path("GRIP_SORTED"))
+    parser.add_argument(
+        "--study",
+        type=str,
+        default=None,
+        help="Only sort this study, given relative to the inputdir, e.g. PAT_002/2023_02_13/Zi_121304.",
+    )
+    parser.add_argument("--n_jobs", type=int, default=None)
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=256,
+        help="Number of DICOM files per task when reading new headers in parallel.",
+    )
+    args = parser.parse_args()
+    inputdir = args.inputdir
+    outputdir = args.outputdir
     sequences = {
         "WIP PDT1_3D 08mm": "T1",
         "WIP PDT1_3D 1mm": "T1",
@@ -143,9 +288,12 @@ if __name__ == "__main__":
         "WIP T2W 3D TSE TE565": "T2",
     }
 
-    filemap = create_study_filemap(
-        inputdir / "PAT_002" / "2023_02_13" / "Zi_121304", outputdir, sequences
-    )
+    if args.study is not None:
+        filemap = create_study_filemap(inputdir / args.study, outputdir, sequences)
+    else:
+        filemap = create_protocol_filemap(
+            inputdir, outputdir, sequences, n_jobs=args.n_jobs, chunksize=args.chunksize
+        )
 
     for src, dest in filemap.items():
         dest.parent.mkdir(exist_ok=True, parents=True)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("dolfin")
+pytest.importorskip("h5py")
+
+from parkrec.mriprocessing.meshprocessing import facet_markers, tetrahedron_facets
+
+
+def test_tetrahedron_facets_are_unique():
+    cells = np.array([[0, 1, 2, 3], [1, 2, 3, 4]])
+    facets = tetrahedron_facets(cells)
+    assert facets.shape == (7, 3)
+    assert len(np.unique(facets, axis=0)) == 7
+
+
+def test_facet_markers_in_any_order():
+    rng = np.random.default_rng(0)
+    facets = np.unique(np.sort(rng.integers(0, 1000, (2000, 3)), axis=1), axis=0)
+    facets = rng.permuted(facets[rng.permutation(len(facets))], axis=1)
+    marked = rng.choice(len(facets), 100, replace=False)
+    markers = rng.integers(1, 5, 100)
+
+    values = facet_markers(facets, facets[marked][:, ::-1], markers)
+    expected = np.zeros(len(facets), dtype=np.uint64)
+    expected[marked] = markers
+    assert np.array_equal(values, expected)
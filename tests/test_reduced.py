@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+df = pytest.importorskip("dolfin")
+pytest.importorskip("pantarei")
+
+from parkrec.models.reduced import pod_basis
+
+
+def mass_matrix(V):
+    u, v = df.TrialFunction(V), df.TestFunction(V)
+    return df.assemble(u * v * df.dx)
+
+
+def test_pod_basis_is_mass_orthonormal():
+    V = df.FunctionSpace(df.UnitSquareMesh(4, 4), "CG", 1)
+    M = mass_matrix(V)
+    rng = np.random.default_rng(0)
+    snapshots = []
+    for _ in range(3):
+        snapshot = df.Function(V).vector()
+        snapshot.set_local(rng.random(snapshot.local_size()))
+        snapshot.apply("insert")
+        snapshots.append(snapshot)
+    basis, _ = pod_basis(M, snapshots)
+    gram = np.array([[phi.inner(M * psi) for psi in basis] for phi in basis])
+    assert np.allclose(gram, np.eye(len(basis)))
+
+
+def test_pod_basis_zero_snapshots():
+    V = df.FunctionSpace(df.UnitSquareMesh(4, 4), "CG", 1)
+    snapshots = [df.Function(V).vector() for _ in range(3)]
+    with pytest.raises(ValueError, match="zero energy"):
+        pod_basis(mass_matrix(V), snapshots)